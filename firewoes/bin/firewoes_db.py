@@ -0,0 +1,216 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Maintenance commands for a Firewoes database
+
+import os
+import argparse
+
+import firewoes.lib.orm as fhm
+from firewoes.lib.dbutils import get_engine_session
+from firewoes.lib.knownids import KnownIds
+from firewoes.lib.garbage import Collector, select_analyses
+from firewoes.lib.migrations import upgrade, convert_ids
+from firewoes.lib import search
+from firewoes.lib import optimize as opt
+
+metadata = fhm.metadata
+
+
+def rebuild_known_ids(engine, path):
+    """
+    Replaces the known ids store at path with the ids present in the db
+    """
+    known_ids = KnownIds(path)
+    with engine.connect() as connection:
+        count = known_ids.rebuild(connection)
+    known_ids.close()
+    print("%d ids written to %s.ids" % (count, path))
+
+def gc(engine, package=None, version=None, generator=None, dry_run=False,
+       known_ids_path=None, inline_locations=False):
+    """
+    Deletes the analyses matching the criteria (see select_analyses()), then
+    the rows which aren't referenced anymore.
+    With inline_locations, the points and ranges of the locations are
+    deleted too, their coordinates being stored inline, and the db only
+    stores the coordinates inline from now on (see
+    firewoes.lib.orm.stores_inline_locations()).
+    With dry_run, everything is rolled back, and only reported.
+    """
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            collector = Collector(connection)
+            if package is generator is version is None:
+                analyses = 0
+            else:
+                analyses = collector.delete_analyses(
+                    select_analyses(package, version, generator))
+            if inline_locations:
+                fhm.store_inline_locations(connection)
+                locations = collector.inline_locations()
+            collector.collect()
+        except:
+            transaction.rollback()
+            raise
+        if dry_run:
+            transaction.rollback()
+        else:
+            transaction.commit()
+
+    print("%d analyses %s deleted" % (analyses, "would be" if dry_run
+                                      else "were"))
+    if inline_locations:
+        print("%d locations %s detached from their point or range"
+              % (locations, "would be" if dry_run else "were"))
+    print(collector.report())
+    if dry_run or not collector.freed:
+        return
+    if engine.dialect.name != "postgresql":
+        print("bytes are estimated from the size of the values")
+    if known_ids_path is not None:
+        rebuild_known_ids(engine, known_ids_path)
+    else:
+        print("the known ids stores will be rebuilt the next time they're "
+              "used")
+
+def rebuild_search(engine):
+    """
+    Refills the search table from the results
+    """
+    with engine.begin() as connection:
+        count = search.rebuild(connection)
+    print("%d results written to %s" % (count, search.t_result_search.name))
+
+def upgrade_schema(engine):
+    """
+    Upgrades the schema of a db created by an older version, and creates
+    the tables it doesn't have yet
+    """
+    metadata.create_all(engine)
+    done = upgrade(engine)
+    if done:
+        print("migrations run: %s" % ", ".join(done))
+    else:
+        print("the schema is up to date")
+
+def convert(engine, id_type):
+    """
+    Converts the ids of the db to id_type ("binary" or "hex")
+    """
+    count = convert_ids(engine, id_type == "binary")
+    if count:
+        print("%d columns converted to %s ids" % (count, id_type))
+    else:
+        print("the ids are already stored as %s" % id_type)
+
+def optimize(engine, repeat=3):
+    """
+    Creates the indexes of the searches (see the search_indexes migration),
+    updates the statistics of the planner, and reports the plans and the
+    latency of the queries of the standard searches before and after, as
+    the web app makes them with its configuration (see
+    firewoes.lib.optimize)
+    """
+    with engine.connect() as connection:
+        searches = opt.find_searches(connection)
+        before = opt.measure(connection, searches, repeat)
+    upgrade_schema(engine)
+    with engine.begin() as connection:
+        connection.execute("ANALYZE")
+    with engine.connect() as connection:
+        after = opt.measure(connection, searches, repeat)
+    print(opt.report(before, after))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance commands "
+                                     "for a Firewoes database")
+    parser.add_argument("db_url", help="URL of the database")
+    parser.add_argument("--verbose", help="outputs SQLAlchemy requests",
+                        action="store_true")
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser_known_ids = subparsers.add_parser(
+        "rebuild-known-ids", help="rebuilds the store of known ids used by "
+        "firewoes_fill_db.py --known-ids")
+    parser_known_ids.add_argument("path", help="path of the store")
+
+    parser_gc = subparsers.add_parser(
+        "gc", help="deletes analyses, and the rows referenced only by the "
+        "deleted analyses (without criteria, only deletes the rows which "
+        "aren't referenced)")
+    parser_gc.add_argument("--package", help="name of the source package")
+    parser_gc.add_argument("--version", help="version of the source package")
+    parser_gc.add_argument("--generator", help="name of the analysis tool")
+    parser_gc.add_argument("--dry-run", help="only reports how many rows "
+                           "and bytes would be deleted", action="store_true")
+    parser_gc.add_argument("--known-ids", help="path of a known ids store "
+                           "to rebuild afterwards", metavar="PATH")
+    parser_gc.add_argument("--inline-locations", help="also deletes the "
+                           "points and ranges of the locations, whose "
+                           "coordinates are stored inline, and makes the "
+                           "ingestions only store them inline from now on "
+                           "(the API then returns points and ranges "
+                           "without ids)", action="store_true")
+
+    subparsers.add_parser(
+        "rebuild-search", help="rebuilds the table of the results with the "
+        "values of the search filters, used if SEARCH_USE_FLAT_TABLE is set")
+
+    subparsers.add_parser(
+        "upgrade", help="upgrades the schema of a database created by an "
+        "older version")
+
+    parser_convert = subparsers.add_parser(
+        "convert-ids", help="converts the ids stored as hex strings to raw "
+        "bytes (binary), which halves the size of the keys and their "
+        "indexes, or back to hex strings (PostgreSQL only)")
+    parser_convert.add_argument("id_type", choices=["binary", "hex"])
+
+    parser_optimize = subparsers.add_parser(
+        "optimize", help="creates the indexes of the search filters (runs "
+        "the migrations), updates the statistics of the planner, and "
+        "reports the plans and the latency of a standard set of searches "
+        "before and after, made by the web app with its configuration "
+        "(FIREWOES_CONFIG)")
+    parser_optimize.add_argument("--repeat", type=int, default=3,
+                                 help="runs of each query, the best time "
+                                 "is reported (default: 3)")
+
+    args = parser.parse_args()
+    if args.command == "optimize" and "FIREWOES_CONFIG" not in os.environ:
+        parser.error("optimize needs the configuration of the web app "
+                     "(FIREWOES_CONFIG)")
+
+    engine, session = get_engine_session(args.db_url, echo=args.verbose)
+
+    if args.command == "rebuild-known-ids":
+        rebuild_known_ids(engine, args.path)
+    elif args.command == "gc":
+        gc(engine, args.package, args.version, args.generator,
+           dry_run=args.dry_run, known_ids_path=args.known_ids,
+           inline_locations=args.inline_locations)
+    elif args.command == "rebuild-search":
+        rebuild_search(engine)
+    elif args.command == "upgrade":
+        upgrade_schema(engine)
+    elif args.command == "convert-ids":
+        convert(engine, args.id_type)
+    elif args.command == "optimize":
+        optimize(engine, args.repeat)
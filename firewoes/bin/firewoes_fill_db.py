@@ -18,11 +18,31 @@
 
 # Reads a Firehose-related XML file and injects it to a DB
 
-import os, sys
+import os, sys, time
+import json
+import random
+import signal
 import argparse
+from itertools import islice
+from functools import partial
+from collections import deque
+from multiprocessing import Pool
 
 import firewoes.lib.orm as fhm
 from firewoes.lib.hash import idify, uniquify
+from firewoes.lib.bulk import analysis_rows, insert_rows
+from firewoes.lib.knownids import open_known_ids
+from firewoes.lib.stream import idify_streaming, iter_idified_results
+from firewoes.lib.manifest import Manifest, t_ingested_file
+from firewoes.lib.feed import stamp_analyses
+from firewoes.lib.search import index_analyses
+from firewoes.lib.staging import StagingLoader
+from firewoes.lib.cache import UniqueCache
+from firewoes.lib.report import IngestionStats
+from firewoes.lib.sources import iter_inputs, open_xml, detect_format, \
+    load_json, is_empty
+from firewoes.lib.workqueue import WorkQueue, is_transient, is_operational
+from firewoes.lib import spool
 from firewoes.lib.dbutils import get_engine_session
 
 from xml.etree.ElementTree import ParseError as XmlParseError
@@ -30,73 +50,908 @@ from xml.etree.ElementTree import ParseError as XmlParseError
 metadata = fhm.metadata
 
 
-def insert_analysis(session, xml_file):
+def prepare_analysis(xml_file, stats=None, format="auto"):
     """
-    Given a file object and a session, creates a Firehose Analysis() object
-    and inserts it to the db linked to session
+    Parses xml_file (the path of a possibly compressed file, or a Member
+    of an archive, see firewoes.lib.sources) and idifies the resulting
+    Analysis. This doesn't need any db access, so it can be run in a
+    worker process.
+    format is "xml", "json" (the JSON form of Firehose, which is faster to
+    parse, and gives the same ids), or "auto" to detect it.
+    Returns a tuple (analysis, error): analysis is None if the file can't
+    be used, in which case error is the message to report, or None if the
+    file is empty (it's then recorded as ingested without an analysis).
+    The time spent is added to stats, if an IngestionStats is given.
     """
+    if stats is None:
+        stats = IngestionStats()
     try:
-        analysis = fhm.Analysis.from_xml(xml_file)
-    except XmlParseError:
-        return # if file is empty for example
+        with stats.stage("parse"):
+            fileobj = open_xml(xml_file)
+            try:
+                if format == "auto":
+                    format = detect_format(fileobj)
+                if format == "json":
+                    analysis = fhm.Analysis.from_json(load_json(fileobj))
+                else:
+                    analysis = fhm.Analysis.from_xml(fileobj)
+            finally:
+                fileobj.close()
     except Exception as e:
-        print("ERROR while parsing xml: %s" % e)
-        return
+        # an empty file has no analysis, but a truncated one is an error
+        # (it's not recorded, so that it is ingested once fixed)
+        if isinstance(e, XmlParseError) and is_empty(xml_file):
+            return (None, None)
+        return (None, "ERROR while parsing %s: %s" % (format, e))
     
     #idify:
     try:
-        (analysis, analysishash) = idify(analysis)
+        with stats.stage("idify"):
+            (analysis, analysishash) = idify(analysis)
+            fhm.compact_traces(analysis.results)
     except Exception as e:
-        print("ERROR while idify Analysis: %s" % e)
-        import sys; sys.exit()
+        return (None, "ERROR while idify Analysis: %s" % e)
+    
+    return (analysis, None)
+
+def _prepare_analysis_timed(xml_file, format="auto"):
+    """
+    prepare_analysis() for the worker processes, which also returns the
+    times of its stages
+    """
+    stats = IngestionStats()
+    return (prepare_analysis(xml_file, stats, format), stats.times)
+
+def publish_analyses(connection, analysis_ids):
+    """
+    Adds the analyses just inserted to the search table and to the
+    ingestion sequence, at the end of the transaction which inserted them
+    """
+    index_analyses(connection, analysis_ids)
+    stamp_analyses(connection, analysis_ids)
+
+def apply_schema_options(session, results):
+    """
+    Prepares a list of idified results for the schema of the db of
+    session: when it stores the locations inline (see
+    firewoes.lib.orm.stores_inline_locations()), their points and ranges
+    are detached. The options are read once per session.
+    """
+    inline = getattr(session, '_inline_locations', None)
+    if inline is None:
+        inline = session._inline_locations = \
+            fhm.stores_inline_locations(session.connection())
+    if inline:
+        fhm.inline_locations(results)
+
+def store_analysis(session, analysis, known_ids=None, stats=None):
+    """
+    Given an idified Analysis() object and a session, inserts it to the db
+    linked to session, in its current transaction, which should be
+    committed soon, since the ingestion sequence (see firewoes.lib.feed)
+    stays locked until then.
+    The objects are always looked up in the db, since they are needed to
+    merge the tree: known_ids isn't used (see store_analysis_bulk()).
+    Returns a tuple (analysis_id, ids), where ids is always empty.
+    The measures are added to stats, if an IngestionStats is given.
+    """
+    if stats is None:
+        stats = IngestionStats()
+    analysis_id = analysis.id
+    apply_schema_options(session, analysis.results)
     
     # unicity:
     try:
-        analysis = uniquify(session, analysis)
+        with stats.stage("uniquify"):
+            analysis = uniquify(session, analysis, stats=stats)
     except Exception as e:
-        print("ERROR while uniquify Analysis: %s" % e)
-        import sys; sys.exit()
+        raise ValueError("ERROR while uniquify Analysis: %s" % e)
 
-    session.merge(analysis)
-    session.commit()
+    with stats.stage("flush"):
+        session.merge(analysis)
+        session.flush()
+        publish_analyses(session.connection(), [analysis_id])
+    
+    return (analysis_id, [])
+
+def _new_rows(rows, known_ids=None, stats=None):
+    """
+    Removes from the rows returned by analysis_rows() those listed in
+    known_ids, which are counted as existing in stats.
+    Returns the list of the (table_name, id) of the remaining rows.
+    """
+    ids = []
+    for (table, table_rows) in rows.items():
+        if known_ids is not None:
+            count = len(table_rows)
+            rows[table] = table_rows = dict(
+                (id_, row) for (id_, row) in table_rows.items()
+                if (table.name, id_) not in known_ids)
+            if stats is not None:
+                stats.add_objects(table.name,
+                                  existing=count - len(table_rows))
+        ids.extend((table.name, id_) for id_ in table_rows)
+    return ids
+
+def _add_inserted(stats, rows, inserted):
+    """
+    Counts in stats the rows which were inserted (inserted is a dict
+    {table name: number of rows}) or already existed
+    """
+    if stats is not None:
+        for (table, table_rows) in rows.items():
+            new = inserted.get(table.name, 0)
+            stats.add_objects(table.name, new=new,
+                              existing=len(table_rows) - new)
+
+def _insert_new_rows(session, rows, known_ids=None, stats=None):
+    """
+    Inserts the rows returned by analysis_rows() within the session's
+    transaction, skipping those listed in known_ids.
+    Returns the list of the (table_name, id) which were sent.
+    """
+    ids = _new_rows(rows, known_ids, stats)
+    inserted = dict()
+    insert_rows(session.connection(), rows, inserted=inserted)
+    _add_inserted(stats, rows, inserted)
+    return ids
+
+def _remember_ids(known_ids, ids):
+    """
+    Adds the committed (table_name, id) to the known_ids store
+    """
+    if known_ids is not None:
+        for (table_name, id_) in ids:
+            known_ids.add(table_name, id_)
+
+def store_analysis_bulk(session, analysis, known_ids=None, stats=None):
+    """
+    Same as store_analysis(), but the tree is written with a few multi-row
+    INSERT ... ON CONFLICT DO NOTHING per table, instead of looking up
+    each of its nodes.
+    If a KnownIds store is given, the rows it contains aren't sent.
+    """
+    if stats is None:
+        stats = IngestionStats()
+    analysis_id = analysis.id
+    apply_schema_options(session, analysis.results)
+    with stats.stage("flush"):
+        ids = _insert_new_rows(session, analysis_rows(analysis), known_ids,
+                               stats)
+        publish_analyses(session.connection(), [analysis_id])
+    return (analysis_id, ids)
+
+def insert_analysis_streaming(session, xml_file, chunk_size=1000,
+                              known_ids=None, stats=None):
+    """
+    Inserts a (possibly huge) Firehose XML file without loading it at once:
+    a first pass computes the analysis id, then the results are parsed,
+    idified and inserted again by chunks of chunk_size, each chunk in its
+    own transaction.
+    The parsing time is counted in the idify stage of stats.
+    Returns the id of the analysis, or None if the file is empty.
+    """
+    if stats is None:
+        stats = IngestionStats()
+    try:
+        with stats.stage("idify"):
+            (metadata_, customfields, analysis_id,
+             number_of_results) = idify_streaming(xml_file)
+    except Exception as e:
+        if isinstance(e, XmlParseError) and is_empty(xml_file):
+            return None
+        raise ValueError("ERROR while parsing xml: %s" % e)
+    
+    analysis = fhm.Analysis(metadata_, [], customfields)
+    analysis.id = analysis_id
+    with stats.stage("flush"):
+        ids = _insert_new_rows(session, analysis_rows(analysis), known_ids,
+                               stats)
+    with stats.stage("commit"):
+        session.commit()
+    _remember_ids(known_ids, ids)
+    
+    chunks = iter_idified_results(xml_file, chunk_size)
+    while True:
+        with stats.stage("idify"):
+            results = next(chunks, None)
+        if results is None:
+            break
+        with stats.stage("flush"):
+            rows = dict()
+            fhm.compact_traces(results)
+            apply_schema_options(session, results)
+            for result in results:
+                analysis_rows(result, rows)
+            for row in rows[fhm.t_result].values():
+                row["analysis_id"] = analysis_id
+            ids = _insert_new_rows(session, rows, known_ids, stats)
+        with stats.stage("commit"):
+            session.commit()
+        _remember_ids(known_ids, ids)
+    
+    # the results only appear in the feed and the searches once they're all
+    # inserted
+    publish_analyses(session.connection(), [analysis_id])
+    with stats.stage("commit"):
+        session.commit()
+    stats.results += number_of_results
+    return analysis_id
+
+def _load_staged(session, loader, manifest, staged, known_ids=None,
+                 stats=None):
+    """
+    Loads the analyses added to the StagingLoader, and records their files
+    in the manifest, in one transaction. staged is the list of their
+    (ManifestEntry or None, analysis_id), which is emptied.
+    Returns the number of results loaded.
+    """
+    if stats is None:
+        stats = IngestionStats()
+    ids = _new_rows(loader.rows, known_ids, stats)
+    rows = loader.rows
+    try:
+        with stats.stage("flush"):
+            results = loader.load(session.connection())
+            for (entry, analysis_id) in staged:
+                if entry is not None:
+                    manifest.record(entry, analysis_id)
+            publish_analyses(session.connection(),
+                             [analysis_id for (entry, analysis_id) in staged
+                              if analysis_id is not None])
+        with stats.stage("commit"):
+            session.commit()
+    except Exception as e:
+        session.rollback()
+        print("Error while loading %d files" % len(staged))
+        print(e)
+        stats.failed += len(staged)
+        return 0
+    finally:
+        del staged[:]
+    _add_inserted(stats, rows, loader.inserted)
+    _remember_ids(known_ids, ids)
+    stats.results += results
+    return results
+
+def insert_analysis(session, xml_file, stats=None):
+    """
+    Given a file object and a session, creates a Firehose Analysis() object
+    and inserts it to the db linked to session
+    """
+    if stats is None:
+        stats = IngestionStats()
+    (analysis, error) = prepare_analysis(xml_file, stats)
+    if error is not None:
+        print(error)
+    if analysis is not None:
+        store_analysis(session, analysis, stats=stats)
+        with stats.stage("commit"):
+            session.commit()
+        stats.results += len(analysis.results)
+        cache = getattr(session, '_unique_cache', None)
+        if cache is not None:
+            cache.trim()
+
+def _prepared_analyses(xml_files, jobs, stats=None, format="auto"):
+    """
+    Yields (xml_file, prepare_analysis(xml_file, format=format)) for each
+    file of the iterable xml_files, in order.
+    With jobs > 1, the files are parsed and idified by a pool of jobs
+    processes, while the caller stores the already hashed trees; their
+    times are then summed over the processes in stats.
+    """
+    if stats is None:
+        stats = IngestionStats()
+    if jobs <= 1:
+        for file_ in xml_files:
+            yield (file_, prepare_analysis(file_, stats, format))
+        return
     
-def read_and_create(url, xml_files, drop=False, echo=False):
+    xml_files = iter(xml_files)
+    pool = Pool(processes=jobs)
+    try:
+        while True:
+            # imap would read the whole iterable at once (e.g. all the
+            # members of an archive), so we give it a window of files
+            window = list(islice(xml_files, jobs * 32))
+            if not window:
+                break
+            # imap keeps the order of the files, and re-raises a worker's
+            # exception when its result is reached
+            for (file_, (prepared, times)) in zip(
+                window, pool.imap(partial(_prepare_analysis_timed,
+                                          format=format), window,
+                                  chunksize=8)):
+                stats.add_times(times)
+                yield (file_, prepared)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _inputs_to_ingest(manifest, paths, entries, force=False, stats=None):
+    """
+    Yields the XML documents found in paths (see iter_inputs()) which
+    aren't in the manifest, unless force is True.
+    The entries deque is filled with the (ManifestEntry or None, index of
+    its path) of each yielded file, in the same order.
+    """
+    for (index, xml_file) in iter_inputs(paths):
+        try:
+            entry = manifest.check(xml_file)
+        except (IOError, OSError):
+            entry = None # the error will be reported while parsing
+        else:
+            if entry is None and not force:
+                if stats is not None:
+                    stats.skipped += 1
+                continue
+        entries.append((entry, index))
+        yield xml_file
+
+def _cache_mark(session):
+    """
+    Returns the position of the journal of the uniquify cache of session,
+    to be given to _forget_rolled_back()
+    """
+    cache = getattr(session, '_unique_cache', None)
+    return cache.mark() if cache is not None else 0
+
+def _forget_rolled_back(session, cache_mark):
+    """
+    Removes from the uniquify cache of session the objects which were
+    added after cache_mark was taken, and have been rolled back
+    """
+    cache = getattr(session, '_unique_cache', None)
+    if cache is not None:
+        cache.rollback(cache_mark)
+
+class _Batch(object):
+    """
+    Groups the ingested files in transactions of commit_every files, or
+    of commit_bytes bytes of XML
+    """
+    def __init__(self, session, known_ids=None, commit_every=1,
+                 commit_bytes=None, stats=None):
+        self.session = session
+        self.known_ids = known_ids
+        self.stats = stats or IngestionStats()
+        self.commit_every = commit_every
+        self.commit_bytes = commit_bytes
+        self._reset()
+    
+    def _reset(self):
+        self.files = 0
+        self.bytes = 0
+        self.ids = []
+    
+    def is_grouped(self):
+        """
+        True if several files can share a transaction, in which case each
+        file is inserted in its own savepoint
+        """
+        return self.commit_every > 1 or self.commit_bytes is not None
+    
+    def add(self, size, ids):
+        """
+        Adds a file of size bytes, whose (table_name, id) are ids, to the
+        current transaction, which is committed if it is full
+        """
+        self.files += 1
+        self.bytes += size
+        self.ids.extend(ids)
+        if (self.files >= self.commit_every
+            or (self.commit_bytes is not None
+                and self.bytes >= self.commit_bytes)):
+            self.commit()
+    
+    def commit(self):
+        with self.stats.stage("commit"):
+            self.session.commit()
+        _remember_ids(self.known_ids, self.ids)
+        self._reset()
+        # the committed objects can now be evicted from the cache
+        cache = getattr(self.session, '_unique_cache', None)
+        if cache is not None:
+            cache.trim()
+
+def read_and_create(url, xml_files, drop=False, echo=False, jobs=1,
+                    bulk=False, known_ids_path=None, stream=False,
+                    chunk_size=1000, force=False, commit_every=1,
+                    commit_bytes=None, copy=False, cache_size=10000,
+                    stats_json=None, format="auto"):
+    """
+    Ingests xml_files into the db at url, whose format is "xml", "json" or
+    "auto" (see prepare_analysis()).
+    Returns the IngestionStats of the run, whose summary is printed, and
+    written as JSON to the stats_json file if given.
+    """
+    stats = IngestionStats()
     engine, session = get_engine_session(url, echo=echo)
+    session._unique_cache = cache = UniqueCache(capacity=cache_size)
+    if copy and engine.dialect.name != "postgresql":
+        raise ValueError("the COPY loader needs a PostgreSQL database")
+    if stream and format == "json":
+        raise ValueError("only XML files can be streamed")
+    if known_ids_path is not None and not (bulk or stream or copy):
+        raise ValueError("the known ids are only used by the bulk, stream "
+                         "and COPY loaders")
+    store = store_analysis_bulk if bulk else store_analysis
     
     if drop:
         metadata.drop_all(bind=engine) # cleans the table (for debugging)
         metadata.create_all(bind=engine)
     
-    number_of_files = len(xml_files)
-    for (counter, file_) in enumerate(xml_files):
+    known_ids = None
+    if known_ids_path is not None:
+        known_ids = open_known_ids(known_ids_path, engine)
+        if drop:
+            known_ids.clear()
+    
+    # files which were already ingested are skipped before parsing:
+    t_ingested_file.create(bind=engine, checkfirst=True)
+    manifest = Manifest(session)
+    entries = deque()
+    inputs = _inputs_to_ingest(manifest, xml_files, entries, force, stats)
+    
+    batch = _Batch(session, known_ids, commit_every, commit_bytes, stats)
+    if copy:
+        (loader, staged, loaded_results) = (StagingLoader(), [], 0)
+        start = time.time()
+    if stream:
+        prepared_analyses = ((file_, (None, None)) for file_ in inputs)
+    else:
+        prepared_analyses = _prepared_analyses(inputs, jobs, stats, format)
+    try:
+        for (file_, (analysis, error)) in prepared_analyses:
+            (entry, index) = entries.popleft()
+            stats.files += 1
+            if error is not None:
+                print(error)
+                stats.failed += 1
+            elif copy:
+                analysis_id = None
+                if analysis is not None:
+                    apply_schema_options(session, analysis.results)
+                    loader.add(analysis)
+                    analysis_id = analysis.id
+                staged.append((entry, analysis_id))
+                if loader.results >= chunk_size:
+                    loaded_results += _load_staged(session, loader, manifest,
+                                                   staged, known_ids, stats)
+            else:
+                if stream:
+                    # streamed files are committed by chunks
+                    batch.commit()
+                elif batch.is_grouped():
+                    session.begin_nested()
+                cache_mark = _cache_mark(session)
+                try:
+                    (analysis_id, ids) = (None, [])
+                    if stream:
+                        analysis_id = insert_analysis_streaming(
+                            session, file_, chunk_size, known_ids=known_ids,
+                            stats=stats)
+                    elif analysis is not None:
+                        (analysis_id, ids) = store(session, analysis,
+                                                   known_ids=known_ids,
+                                                   stats=stats)
+                    if entry is not None:
+                        manifest.record(entry, analysis_id)
+                    if batch.is_grouped() and not stream:
+                        session.commit() # releases the savepoint
+                except Exception as e:
+                    # only this file is rolled back
+                    session.rollback()
+                    _forget_rolled_back(session, cache_mark)
+                    print("Error in file %s" % file_)
+                    print(e)
+                    stats.failed += 1
+                else:
+                    if analysis is not None:
+                        stats.results += len(analysis.results)
+                    batch.add(entry.size if entry is not None else 0, ids)
+            
+            # % counter, of the paths given (an archive counts as one):
+            sys.stdout.write(str(int(float(index + 1)
+                                     / float(len(xml_files)) * 100)))
+            sys.stdout.write(" %")
+            sys.stdout.write("\r")
+            sys.stdout.flush()
+        
+        batch.commit()
+        sys.stdout.write("\n")
+        if stats.skipped:
+            print("%d files already ingested, skipped" % stats.skipped)
+        if cache.hits or cache.misses:
+            print("uniquify cache: %s" % cache.stats())
+        
+        if copy:
+            if staged:
+                loaded_results += _load_staged(session, loader, manifest,
+                                               staged, known_ids, stats)
+            loader.drop(session.connection())
+            session.commit()
+            elapsed = time.time() - start
+            print("%d results loaded in %.1f s (%.0f results/s)"
+                  % (loaded_results, elapsed,
+                     loaded_results / elapsed if elapsed else 0))
+    finally:
+        # the ids committed so far are saved even if the run is aborted
+        if known_ids is not None:
+            known_ids.save()
+            known_ids.close()
+    
+    session.remove()
+    
+    stats.stop()
+    print(stats.summary())
+    if stats_json is not None:
+        with open(stats_json, "w") as f:
+            json.dump(stats.as_dict(), f, indent=2, sort_keys=True)
+    return stats
+
+def _ingest_document(session, manifest, xml_file, entry, store=store_analysis,
+                     known_ids=None, stats=None, attempts=1):
+    """
+    Parses xml_file, and stores it with store along with its manifest entry
+    (if not None), in its own transaction. The transaction is retried up
+    to attempts times if it was aborted by a concurrent one (e.g.
+    deadlock), which only makes sense with store_analysis_bulk.
+    Returns the error message, or None if the file was ingested. The
+    errors which don't come from the document (see is_transient() and
+    is_operational()) are raised instead, once all the attempts failed.
+    """
+    (analysis, error) = prepare_analysis(xml_file, stats)
+    if error is not None:
+        return error
+    # the analysis is expired by the commit
+    results = len(analysis.results) if analysis is not None else 0
+    for attempt in range(attempts):
+        cache_mark = _cache_mark(session)
         try:
-            insert_analysis(session, file_)
+            (analysis_id, ids) = (None, [])
+            if analysis is not None:
+                (analysis_id, ids) = store(session, analysis,
+                                           known_ids=known_ids, stats=stats)
+            if entry is not None:
+                manifest.record(entry, analysis_id)
+            with stats.stage("commit"):
+                session.commit()
         except Exception as e:
-            print("Error in file %s" % file_)
-            print(e)
-        
-        # % counter:
-        sys.stdout.write(str(int(float(counter + 1)
-                                 / float(number_of_files) * 100)))
-        sys.stdout.write(" %")
-        sys.stdout.write("\r")
-        sys.stdout.flush()
+            session.rollback()
+            _forget_rolled_back(session, cache_mark)
+            if is_transient(e) and attempt < attempts - 1:
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+                continue
+            if is_transient(e) or is_operational(e):
+                raise
+            return "%s" % e
+        else:
+            _remember_ids(known_ids, ids)
+            cache = getattr(session, '_unique_cache', None)
+            if cache is not None:
+                cache.trim()
+            stats.results += results
+            return None
+
+def _ingest_path(session, manifest, path, store=store_analysis,
+                 known_ids=None, stats=None, force=False, attempts=1):
+    """
+    Ingests the XML documents found in path (see iter_inputs()) which
+    aren't in the manifest (unless force is True), each one with
+    _ingest_document().
+    Returns the list of the errors of the documents which failed.
+    """
+    if stats is None:
+        stats = IngestionStats()
+    errors = []
+    for (index, xml_file) in iter_inputs([path]):
+        stats.files += 1
+        try:
+            entry = manifest.check(xml_file)
+        except (IOError, OSError):
+            entry = None # the error will be reported while parsing
+        else:
+            if entry is None and not force:
+                stats.skipped += 1
+                continue
+        error = _ingest_document(session, manifest, xml_file, entry, store,
+                                 known_ids, stats, attempts)
+        if error is not None:
+            print("Error in file %s" % xml_file)
+            print(error)
+            stats.failed += 1
+            errors.append("%s: %s" % (xml_file, error))
+    # the manifest entries updated for the skipped documents
+    session.commit()
+    return errors
+
+def run_worker(url, worker=None, claim_size=10, echo=False,
+               known_ids_path=None, requeue_after=None, stats_json=None):
+    """
+    Ingests the files of the work queue of the db at url (see
+    firewoes.lib.workqueue), claim_size files at a time, until the queue
+    is empty. Several workers can run at once, on several hosts: the rows
+    are written with INSERT ... ON CONFLICT DO NOTHING, so that workers
+    inserting the same shared rows don't abort each other.
+    With requeue_after, the files claimed more than requeue_after seconds
+    ago (by dead workers) are queued again first.
+    Returns the IngestionStats of the run.
+    """
+    stats = IngestionStats()
+    engine, session = get_engine_session(url, echo=echo)
+    queue = WorkQueue(engine, worker)
+    if requeue_after is not None:
+        print("%d stale files requeued" % queue.requeue(requeue_after))
+    known_ids = None
+    if known_ids_path is not None:
+        known_ids = open_known_ids(known_ids_path, engine)
+    t_ingested_file.create(bind=engine, checkfirst=True)
+    manifest = Manifest(session)
+    session.commit() # no transaction is kept open between the files
     
-    sys.stdout.write("\n")
+    try:
+        while True:
+            paths = queue.claim(claim_size)
+            if not paths:
+                break
+            for path in paths:
+                try:
+                    errors = _ingest_path(session, manifest, path,
+                                          store_analysis_bulk, known_ids,
+                                          stats, attempts=5)
+                except Exception as e:
+                    session.rollback()
+                    errors = ["%s: %s" % (path, e)]
+                queue.finish(path, "\n".join(errors) or None)
+    finally:
+        if known_ids is not None:
+            known_ids.save()
+            known_ids.close()
     
     session.remove()
+    
+    stats.stop()
+    print("worker %s: %s" % (queue.worker, stats.summary()))
+    if stats_json is not None:
+        with open(stats_json, "w") as f:
+            json.dump(stats.as_dict(), f, indent=2, sort_keys=True)
+    return stats
+
+def _ingest_spooled(session, manifest, spool_dir, path, store=store_analysis,
+                    known_ids=None, stats=None, force=False):
+    """
+    Ingests the spooled file path, and moves it to done/, or to failed/
+    with its errors (e.g. a document which can't be parsed), which are
+    returned
+    """
+    errors = _ingest_path(session, manifest, path, store, known_ids, stats,
+                          force)
+    spool.finish(spool_dir, path, errors)
+    return errors
+
+def _watch_spool(session, manifest, spool_dir, store=store_analysis,
+                 known_ids=None, stats=None, interval=1., batch_size=100,
+                 force=False, stopping=(), max_backoff=60.):
+    """
+    Ingests the files of spool_dir as they appear (see run_spool()), until
+    the list stopping isn't empty.
+    A file whose ingestion fails because of the db or of the filesystem
+    (e.g. lost connection), rather than because of its document, is left
+    in the spool: the files are tried again after a delay, doubled after
+    each such failure, up to max_backoff seconds.
+    """
+    if stats is None:
+        stats = IngestionStats()
+    delay = interval
+    while not stopping:
+        paths = spool.spooled_files(spool_dir, interval)[:batch_size]
+        if not paths:
+            time.sleep(interval)
+            continue
+        for path in paths:
+            # the current file is always finished before stopping
+            if stopping:
+                break
+            results = stats.results
+            try:
+                errors = _ingest_spooled(session, manifest, spool_dir, path,
+                                         store, known_ids, stats, force)
+            except Exception as e:
+                try:
+                    session.rollback()
+                except Exception:
+                    pass # the connection is reopened by the next attempt
+                print("%s: %s, retrying in %g s"
+                      % (os.path.basename(path), e, delay))
+                sys.stdout.flush()
+                time.sleep(delay)
+                delay = min(delay * 2, max_backoff)
+                break
+            delay = interval
+            print("%s: %s" % (os.path.basename(path), "failed" if errors
+                              else "%d results" % (stats.results - results)))
+            sys.stdout.flush()
+
+def run_spool(url, spool_dir, bulk=False, echo=False, known_ids_path=None,
+              cache_size=10000, interval=1., batch_size=100, force=False,
+              stats_json=None):
+    """
+    Ingests the files which appear in spool_dir, until SIGTERM or SIGINT is
+    received, keeping the same engine, uniquify cache and manifest all
+    along. The files are checked for every interval seconds, and ingested
+    by batches of batch_size files, each one in its own transaction; they
+    are then moved to spool_dir/done, or to spool_dir/failed along with a
+    .error file (see firewoes.lib.spool), unless the db can't be used, in
+    which case they're retried later (see _watch_spool()).
+    Returns the IngestionStats of the run.
+    """
+    if known_ids_path is not None and not bulk:
+        raise ValueError("the known ids are only used by the bulk loader")
+    stats = IngestionStats()
+    engine, session = get_engine_session(url, echo=echo)
+    session._unique_cache = UniqueCache(capacity=cache_size)
+    store = store_analysis_bulk if bulk else store_analysis
+    known_ids = None
+    if known_ids_path is not None:
+        known_ids = open_known_ids(known_ids_path, engine)
+    t_ingested_file.create(bind=engine, checkfirst=True)
+    manifest = Manifest(session)
+    session.commit()
+    spool.make_dirs(spool_dir)
+    
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    print("watching %s" % spool_dir)
+    try:
+        _watch_spool(session, manifest, spool_dir, store, known_ids, stats,
+                     interval, batch_size, force, stopping)
+    finally:
+        if known_ids is not None:
+            known_ids.save()
+            known_ids.close()
+    
+    session.remove()
+    
+    stats.stop()
+    print(stats.summary())
+    if stats_json is not None:
+        with open(stats_json, "w") as f:
+            json.dump(stats.as_dict(), f, indent=2, sort_keys=True)
+    return stats
 
 if __name__ == "__main__":
     
     parser = argparse.ArgumentParser(description="Reads XML from standard\
     input and adds the Firehose objects into the specified database")
     parser.add_argument("db_url", help="URL of the database")
-    parser.add_argument("xml_file", help="Path of the XML file", nargs="+")
+    parser.add_argument("xml_file", help="Path of the XML file, which can be "
+                        "compressed (gzip, bzip2, xz), a tar archive of such "
+                        "files, or - for stdin", nargs="*")
     parser.add_argument("--drop", help="drops the database before filling",
                         action="store_true")
     parser.add_argument("--verbose", help="outputs SQLAlchemy requests",
                         action="store_true")
-    args = parser.parse_args()
+    parser.add_argument("--jobs", "-j", help="number of processes parsing "
+                        "and idifying the files (default: 1)",
+                        type=int, default=1)
+    parser.add_argument("--bulk", help="writes each analysis with a few "
+                        "multi-row INSERT ... ON CONFLICT DO NOTHING per "
+                        "table, instead of looking up each object",
+                        action="store_true")
+    parser.add_argument("--known-ids", help="path of the store of the ids "
+                        "known to exist in the db, whose rows aren't sent "
+                        "again with --bulk, --stream, --copy or --worker "
+                        "(see firewoes_db.py rebuild-known-ids); it's "
+                        "rebuilt if rows were deleted from the db since it "
+                        "was saved", metavar="PATH")
+    parser.add_argument("--stream", help="parses the files incrementally "
+                        "and inserts their results by chunks, for analyses "
+                        "too large to fit in memory", action="store_true")
+    parser.add_argument("--copy", help="loads the analyses by chunks with "
+                        "COPY into staging tables, merged into the real "
+                        "ones (PostgreSQL only, for full rebuilds)",
+                        action="store_true")
+    parser.add_argument("--chunk-size", help="number of results per chunk "
+                        "with --stream or --copy (default: 1000)",
+                        type=int, default=1000)
+    parser.add_argument("--force", help="ingests the files again, even if "
+                        "they were already ingested", action="store_true")
+    parser.add_argument("--commit-every", help="number of files per "
+                        "transaction, each file being inserted in its own "
+                        "savepoint (default: 1)", type=int, default=1,
+                        metavar="N")
+    parser.add_argument("--commit-bytes", help="commits the transaction "
+                        "once its files reach this size in bytes",
+                        type=int, metavar="BYTES")
+    parser.add_argument("--cache-size", help="number of objects per class "
+                        "kept in the uniquify cache between transactions "
+                        "(default: 10000)", type=int, default=10000,
+                        metavar="N")
+    parser.add_argument("--stats-json", help="writes the measures of the run "
+                        "(time per stage, new and existing objects per "
+                        "table) to this JSON file", metavar="FILE")
+    parser.add_argument("--enqueue", help="adds the files to the work queue "
+                        "of the db instead of ingesting them (their paths "
+                        "must be readable by the workers)",
+                        action="store_true")
+    parser.add_argument("--worker", help="ingests the files of the work "
+                        "queue until it is empty; several workers can run "
+                        "at once, on several hosts", action="store_true")
+    parser.add_argument("--worker-name", help="name of the worker in the "
+                        "queue (default: hostname-pid)")
+    parser.add_argument("--claim", help="number of files claimed at a time "
+                        "by the worker (default: 10)", type=int, default=10,
+                        metavar="N")
+    parser.add_argument("--requeue-after", help="queues again the files "
+                        "claimed more than SECONDS ago, by workers which "
+                        "died", type=float, metavar="SECONDS")
+    parser.add_argument("--spool", help="runs as a daemon, ingesting the "
+                        "files moved into DIR as they arrive, and moving "
+                        "them to DIR/done or DIR/failed", metavar="DIR")
+    parser.add_argument("--interval", help="seconds between two checks of "
+                        "the spool directory (default: 1)", type=float,
+                        default=1., metavar="SECONDS")
+    parser.add_argument("--format", help="format of the files: the XML or "
+                        "JSON form of Firehose, or auto to detect it "
+                        "(default: auto)", choices=["auto", "xml", "json"],
+                        default="auto")
+    # with nargs="*", the files given after an option (e.g. URL --drop
+    # FILE...) are left over: they're taken as files too
+    (args, extra) = parser.parse_known_args()
+    unknown = [arg for arg in extra if arg.startswith("-") and arg != "-"]
+    if unknown:
+        parser.error("unrecognized arguments: %s" % " ".join(unknown))
+    args.xml_file.extend(extra)
+    if args.known_ids is not None and not (args.bulk or args.stream
+                                           or args.copy or args.worker):
+        parser.error("--known-ids is only used with --bulk, --stream, "
+                     "--copy or --worker")
+    if args.spool is not None:
+        if args.xml_file or args.enqueue or args.worker:
+            parser.error("--spool takes its files from the spool directory")
+        run_spool(args.db_url, args.spool, bulk=args.bulk, echo=args.verbose,
+                  known_ids_path=args.known_ids, cache_size=args.cache_size,
+                  interval=args.interval, force=args.force,
+                  stats_json=args.stats_json)
+        sys.exit(0)
+    if args.worker:
+        if args.xml_file or args.enqueue:
+            parser.error("--worker takes its files from the queue")
+        run_worker(args.db_url, worker=args.worker_name,
+                   claim_size=args.claim, echo=args.verbose,
+                   known_ids_path=args.known_ids,
+                   requeue_after=args.requeue_after,
+                   stats_json=args.stats_json)
+        sys.exit(0)
+    if not args.xml_file:
+        parser.error("at least one xml_file is needed")
+    if args.enqueue:
+        if "-" in args.xml_file:
+            parser.error("stdin can't be queued")
+        engine, session = get_engine_session(args.db_url, echo=args.verbose)
+        count = WorkQueue(engine).enqueue(
+            [os.path.abspath(path) for path in args.xml_file])
+        print("%d files queued" % count)
+        sys.exit(0)
+    if args.stream and args.jobs > 1:
+        parser.error("--stream can't be used with --jobs")
+    if args.stream and args.copy:
+        parser.error("--stream can't be used with --copy")
+    if args.stream and args.format == "json":
+        parser.error("--stream only reads XML files")
     
-    read_and_create(args.db_url, args.xml_file, drop=args.drop, echo=args.verbose)
+    read_and_create(args.db_url, args.xml_file, drop=args.drop,
+                    echo=args.verbose, jobs=args.jobs, bulk=args.bulk,
+                    known_ids_path=args.known_ids, stream=args.stream,
+                    chunk_size=args.chunk_size, force=args.force,
+                    commit_every=args.commit_every,
+                    commit_bytes=args.commit_bytes, copy=args.copy,
+                    cache_size=args.cache_size, stats_json=args.stats_json,
+                    format=args.format)
     
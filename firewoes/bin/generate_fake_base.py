@@ -16,74 +16,282 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-# generates fake analyses into xml files
+# generates fake analyses into xml files, or directly into a database
+#
+# The corpus is entirely determined by the seed and the sizes given, so that
+# performance problems can be reproduced. Its values follow the shape of real
+# data: package sizes are Zipfian, messages are shared between packages,
+# files and functions are repeated between the results of a package, and
+# some results have ranges and traces.
 
 import os
+import json
 import argparse
 import random
-import subprocess
-from firehose.model import Analysis, Metadata, Generator, Issue, \
-    Location, Message, DebianSource, File, Function
+import bisect
+from firehose.model import Analysis, Metadata, Generator, Issue, Failure, \
+    Info, Location, Message, Notes, DebianSource, File, Function, Point, \
+    Range, Trace, State, Stats
+
+from firewoes.lib.orm import metadata, compact_traces, inline_locations, \
+    stores_inline_locations
+from firewoes.lib.hash import idify
+from firewoes.lib.bulk import analysis_rows, insert_rows
+from firewoes.lib.feed import stamp_analyses
+from firewoes.lib.search import index_analyses
+from firewoes.lib.dbutils import get_engine_session
 
 
-analysis_tools = [("coccinelle", "1.0"),
+analysis_tools = [("cppcheck", "1.61"),
                   ("coccinelle", "spatch version 1.0.0-rc15 with Python "
                    "support and with PCRE support"),
-                  ("clang", "1.2.3"),
+                  ("clang", "3.4"),
+                  ("cpychecker", "0.11"),
+                  ("pyflakes", "0.7.3"),
                   ("cool-analysis-tool", "0.1")]
 
+words = ["alloc", "buffer", "cache", "config", "data", "debug", "error",
+         "file", "hash", "init", "list", "lock", "main", "parse", "read",
+         "socket", "string", "table", "thread", "util", "write", "xml"]
+
+directories = ["", "src/", "lib/", "src/core/", "tests/", "tools/"]
+
+extensions = [".c", ".c", ".c", ".h", ".cpp", ".py"]
+
+message_templates = ["Memory leak: %s",
+                     "Uninitialized variable: %s",
+                     "Possible null pointer dereference: %s",
+                     "Variable '%s' is assigned a value that is never used",
+                     "unused variable '%s'",
+                     "Array '%s' accessed at index out of bounds",
+                     "Resource leak: %s",
+                     "'%s' imported but unused",
+                     "dereference of NULL pointer '%s'"]
+
+cwes = [None, None, None, 398, 401, 457, 476, 563, 775, 788]
+
+severities = [None, None, "style", "warning", "error", "performance"]
+
+
+class CorpusGenerator(object):
+    def __init__(self, seed=0, packages=24, generators=4, results=4,
+                 zipf=1.1, messages=500, versions=1, trace_ratio=0.2,
+                 range_ratio=0.1):
+        """
+        packages source packages (each with 1 to versions versions) are
+        analysed by the first generators tools of analysis_tools, giving
+        results results per analysis on average, the size of the packages
+        following a Zipf distribution of exponent zipf
+        """
+        self.seed = seed
+        self.packages = packages
+        self.generators = analysis_tools[:generators]
+        self.results = results
+        self.zipf = zipf
+        self.versions = versions
+        self.trace_ratio = trace_ratio
+        self.range_ratio = range_ratio
+        self._cumulative_weights = dict()
+
+        rand = random.Random(seed)
+        # the messages are shared by all the packages
+        self.messages = [rand.choice(message_templates)
+                         % self._identifier(rand)
+                         for i in range(messages)]
+        # ranks of the packages, from the biggest to the smallest
+        self.ranks = list(range(1, packages + 1))
+        rand.shuffle(self.ranks)
+        # the average number of results is kept around results
+        self.size_factor = (float(results) * packages
+                            / sum(1. / rank ** zipf for rank in self.ranks)
+                            if packages else 0)
+
+    def _zipf_index(self, rand, n):
+        """
+        Returns an index in [0, n), the first ones being the most frequent
+        """
+        cumulative = self._cumulative_weights.get(n)
+        if cumulative is None:
+            (cumulative, total) = ([], 0.)
+            for rank in range(1, n + 1):
+                total += 1. / rank ** self.zipf
+                cumulative.append(total)
+            self._cumulative_weights[n] = cumulative
+        return bisect.bisect(cumulative, rand.random() * cumulative[-1])
+
+    def _identifier(self, rand):
+        return "%s_%s" % (rand.choice(words), rand.choice(words))
 
-software = [("software 1", "1.0"),
-            ("software 1", "2.0"),
-            ("awesome app", "rc1"),
-            ("another program", "8"),
-            ("another program", "9"),
-            ("hello", "1.0")]
-
-functions = [("hello.c", "hello_world()"),
-             ("run.py", "generate_test(var=8)"),
-             ("foo.cpp", "string_from_int(integer)")]
-
-def generate_fake_bases(output_dir):
-    analyses = []
-    for tool, tool_version in analysis_tools:
-        for sut, sut_version in software:
-            issues = []
-            metadata = Metadata(Generator(tool, tool_version),
-                                DebianSource(sut, sut_version, None),
-                                None, None)
-            for i in range(random.randint(0, 4)):
-                file_, function = functions[random.randint(0, len(functions)-1)]
-                file_ = File(file_, None, None)
-                function = Function(function)
-                location = Location(file_, function)
-                try:
-                    fortune = subprocess.check_output(["fortune"])
-                except OSError:
-                    print("'fortune' is not installed and required to"
-                          "generate fake messages")
-                    import sys; sys.exit()
-                message = Message(fortune)
-                issue = Issue(None, None, location, message, None, None)
-                issues.append(issue)
-            analysis = Analysis(metadata, issues)
-            analyses.append(analysis)
-    i = 0
-    for analysis in analyses:
-        f = open(os.path.join(output_dir, "analysis" + str(i) + ".xml"), "w")
-        f.write(analysis.to_xml_bytes())
+    def _package_files(self, rand, name, size):
+        """
+        Returns the list of (file, functions) of a package, with about
+        sqrt(size) files
+        """
+        files = []
+        for i in range(max(1, int(size ** 0.5))):
+            path = "%s%s_%s%s" % (rand.choice(directories), rand.choice(words),
+                                  i, rand.choice(extensions))
+            functions = [Function("%s_%s" % (name, self._identifier(rand)))
+                         for j in range(rand.randint(1, 8))]
+            files.append((File(path, None), functions))
+        return files
+
+    def _location(self, rand, files):
+        (file_, functions) = files[self._zipf_index(rand, len(files))]
+        point = Point(rand.randint(1, 2000), rand.randint(0, 80))
+        range_ = None
+        if rand.random() < self.range_ratio:
+            point = None
+            line = rand.randint(1, 2000)
+            range_ = Range(Point(line, rand.randint(0, 40)),
+                           Point(line + rand.randint(0, 3),
+                                 rand.randint(0, 80)))
+        return Location(file_, rand.choice(functions), point, range_)
+
+    def _trace(self, rand, files):
+        states = []
+        for i in range(rand.randint(2, 6)):
+            notes = None
+            if rand.random() < 0.5:
+                notes = Notes("when %s" % self._identifier(rand))
+            states.append(State(self._location(rand, files), notes))
+        return Trace(states)
+
+    def _result(self, rand, files, generator):
+        location = self._location(rand, files)
+        message = Message(
+            self.messages[self._zipf_index(rand, len(self.messages))])
+        kind = rand.random()
+        if kind < 0.02:
+            return Failure("%s-failure" % generator, location, message, None)
+        elif kind < 0.05:
+            return Info("%s-info" % generator, location, message, None)
+
+        trace = None
+        if rand.random() < self.trace_ratio:
+            trace = self._trace(rand, files)
+        return Issue(rand.choice(cwes), "%s-%d" % (generator,
+                                                   rand.randint(1, 30)),
+                     location, message, None, trace,
+                     severity=rand.choice(severities))
+
+    def package(self, index):
+        """
+        Returns the list of the Analysis of the package index, which only
+        depends on the seed and on index
+        """
+        rand = random.Random(self.seed * 1000003 + index)
+        name = "package%d" % index
+        size = self.size_factor / self.ranks[index] ** self.zipf
+        files = self._package_files(rand, name, size)
+
+        analyses = []
+        for version in range(rand.randint(1, self.versions)):
+            sut = DebianSource(name, "%d.%d" % (version + 1,
+                                                rand.randint(0, 9)), None)
+            for (tool, tool_version) in self.generators:
+                results = [self._result(rand, files, tool) for i in
+                           range(int(round(size * rand.uniform(0.5, 1.5))))]
+                metadata = Metadata(Generator(tool, tool_version), sut, None,
+                                    Stats(round(rand.uniform(0.1, 60), 2)))
+                analyses.append(Analysis(metadata, results))
+        return analyses
+
+    def __iter__(self):
+        """
+        Yields all the analyses of the corpus
+        """
+        for index in range(self.packages):
+            for analysis in self.package(index):
+                yield analysis
+
+def generate_fake_bases(output_dir, corpus=None, format="xml"):
+    """
+    Writes the analyses of corpus (a CorpusGenerator) into output_dir, in
+    the XML or JSON form of Firehose
+    """
+    if corpus is None:
+        corpus = CorpusGenerator()
+    for (i, analysis) in enumerate(corpus):
+        f = open(os.path.join(output_dir, "analysis%d.%s" % (i, format)), "w")
+        if format == "json":
+            json.dump(analysis.to_json(), f)
+        else:
+            f.write(analysis.to_xml_bytes())
         f.write("\n")
 
         f.close()
-        i += 1
+
+def generate_fake_db(url, corpus=None, drop=False, chunk_size=1000):
+    """
+    Inserts the analyses of corpus (a CorpusGenerator) into the db at url,
+    by chunks of about chunk_size results
+    """
+    if corpus is None:
+        corpus = CorpusGenerator()
+    engine, session = get_engine_session(url)
+    if drop:
+        metadata.drop_all(bind=engine)
+    metadata.create_all(bind=engine)
+
+    (rows, analysis_ids, results) = (dict(), [], 0)
+    with engine.connect() as connection:
+        inline = stores_inline_locations(connection)
+        for analysis in corpus:
+            analysis_ids.append(idify(analysis)[1])
+            compact_traces(analysis.results)
+            if inline:
+                inline_locations(analysis.results)
+            analysis_rows(analysis, rows)
+            results += len(analysis.results)
+            if results >= chunk_size:
+                with connection.begin():
+                    insert_rows(connection, rows)
+                    index_analyses(connection, analysis_ids)
+                    stamp_analyses(connection, analysis_ids)
+                (rows, analysis_ids, results) = (dict(), [], 0)
+        with connection.begin():
+            insert_rows(connection, rows)
+            index_analyses(connection, analysis_ids)
+            stamp_analyses(connection, analysis_ids)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generates random Firehose "
                                      "analysis*.xml files")
-    parser.add_argument("output_dir",
+    parser.add_argument("output_dir", nargs="?",
                         help="folder where to save the outputted xml files")
+    parser.add_argument("--db", help="URL of a database where to insert "
+                        "the analyses, instead of writing xml files")
+    parser.add_argument("--drop", help="drops the database before filling",
+                        action="store_true")
+    parser.add_argument("--seed", help="seed of the corpus (default: 0)",
+                        type=int, default=0)
+    parser.add_argument("--packages", help="number of source packages "
+                        "(default: 24)", type=int, default=24)
+    parser.add_argument("--versions", help="maximum number of versions of "
+                        "a package (default: 1)", type=int, default=1)
+    parser.add_argument("--generators", help="number of analysis tools "
+                        "(default: 4, max: %d)" % len(analysis_tools),
+                        type=int, default=4)
+    parser.add_argument("--results", help="average number of results per "
+                        "analysis (default: 4)", type=int, default=4)
+    parser.add_argument("--zipf", help="exponent of the Zipf distributions "
+                        "of the package sizes, messages and files "
+                        "(default: 1.1)", type=float, default=1.1)
+    parser.add_argument("--messages", help="number of distinct messages "
+                        "(default: 500)", type=int, default=500)
+    parser.add_argument("--format", help="format of the files (default: "
+                        "xml)", choices=["xml", "json"], default="xml")
     args = parser.parse_args()
-    
-    generate_fake_bases(args.output_dir)
-    
+    if (args.output_dir is None) == (args.db is None):
+        parser.error("either output_dir or --db is needed")
+
+    corpus = CorpusGenerator(seed=args.seed, packages=args.packages,
+                             generators=args.generators, results=args.results,
+                             zipf=args.zipf, messages=args.messages,
+                             versions=args.versions)
+    if args.db is not None:
+        generate_fake_db(args.db, corpus, drop=args.drop)
+    else:
+        generate_fake_bases(args.output_dir, corpus, args.format)
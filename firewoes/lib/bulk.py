@@ -0,0 +1,139 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Set-based insertion of idified Firehose trees.
+
+Since the ids are content hashes, a row which already exists in the db is
+identical to the one we would insert: the tree can be flattened into rows
+and written with a few INSERT ... ON CONFLICT DO NOTHING per table, without
+asking the db what it already contains.
+"""
+
+from sqlalchemy.sql.expression import Insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import object_mapper
+from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY
+
+from firewoes.lib.orm import metadata, computed_columns
+
+
+class InsertIgnore(Insert):
+    """
+    An INSERT which silently skips the rows whose primary key already
+    exists in the table.
+    """
+    pass
+
+@compiles(InsertIgnore, 'postgresql')
+def _insert_ignore_postgresql(insert, compiler, **kwargs):
+    return compiler.visit_insert(insert, **kwargs) + " ON CONFLICT DO NOTHING"
+
+@compiles(InsertIgnore, 'sqlite')
+def _insert_ignore_sqlite(insert, compiler, **kwargs):
+    return compiler.visit_insert(insert, **kwargs).replace(
+        "INSERT", "INSERT OR IGNORE", 1)
+
+def analysis_rows(obj, rows=None):
+    """
+    Flattens an idified Firehose tree into table rows.
+    Returns a dict {Table: {id: row}}, where row is a dict
+    (column name -> value). If rows is provided, it is filled instead.
+    """
+    if rows is None:
+        rows = dict()
+
+    # (object, foreign keys set by its parent), e.g. the analysis_id of a
+    # result, which isn't set on the result itself
+    stack = [(obj, dict())]
+    while stack:
+        (obj, parent_keys) = stack.pop()
+        mapper = object_mapper(obj)
+        table = mapper.local_table
+
+        row = dict((column.name, None) for column in table.c)
+        if mapper.polymorphic_on is not None:
+            row[mapper.polymorphic_on.name] = mapper.polymorphic_identity
+
+        for prop in mapper.iterate_properties:
+            value = getattr(obj, prop.key, None)
+            if isinstance(prop, ColumnProperty):
+                # several properties can share a column (e.g. Failure's
+                # failureid and testid): like the ORM, we write the one the
+                # mapper flushes
+                column = prop.columns[0]
+                if value is not None and \
+                        mapper.get_property_by_column(column) is prop:
+                    row[column.name] = value
+
+            elif isinstance(prop, RelationshipProperty) and value is not None:
+                if prop.direction is MANYTOONE:
+                    for (local, remote) in prop.local_remote_pairs:
+                        row[local.name] = getattr(value, remote.key)
+                    stack.append((value, dict()))
+
+                elif prop.direction is ONETOMANY:
+                    for child in value:
+                        stack.append((child, dict(
+                            (remote.name, getattr(obj, local.key))
+                            for (local, remote) in prop.local_remote_pairs)))
+
+        if mapper.class_ in computed_columns:
+            row.update(computed_columns[mapper.class_](obj))
+        row.update(parent_keys)
+        rows.setdefault(table, dict())[row["id"]] = row
+
+    return rows
+
+# maximum number of bound parameters of a statement, per dialect: 999 is
+# the default SQLITE_MAX_VARIABLE_NUMBER of the sqlite versions before
+# 3.32, the PostgreSQL protocol allows 65535
+_max_params = dict(sqlite=999)
+
+def insert_rows(connection, rows, chunk_size=1000, inserted=None,
+                max_params=None):
+    """
+    Inserts the rows returned by analysis_rows(), with one multi-row
+    INSERT ... ON CONFLICT DO NOTHING per table (and per chunk_size rows,
+    fewer if they would need more than max_params bound parameters, by
+    default the limit of the dialect), in the order of the foreign keys
+    dependencies.
+    The rows of a table are sent in the order of their ids, so that
+    concurrent writers lock the existing rows in the same order instead of
+    deadlocking each other.
+    If a dict is given as inserted, the numbers of rows actually inserted
+    (i.e. which didn't exist) are added to it per table name.
+    Returns the number of rows sent to the db.
+    """
+    if max_params is None:
+        max_params = _max_params.get(connection.dialect.name, 65535)
+    count = 0
+    for table in metadata.sorted_tables:
+        table_rows = rows.get(table, dict())
+        table_rows = [table_rows[id_] for id_ in sorted(table_rows)]
+        # (each row has a value for every column)
+        size = max(1, min(chunk_size, max_params // len(table.c)))
+        for i in range(0, len(table_rows), size):
+            chunk = table_rows[i:i + size]
+            result = connection.execute(InsertIgnore(table).values(chunk))
+            count += len(chunk)
+            if inserted is not None:
+                inserted[table.name] = (inserted.get(table.name, 0)
+                                        + result.rowcount)
+    return count
@@ -0,0 +1,145 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Bounded cache of the objects already uniquified in a session.
+"""
+
+from collections import OrderedDict
+
+from firewoes.lib.orm import Generator, Sut
+
+
+class UniqueCache(object):
+    """
+    Maps (class, id) keys to ORM objects, with one LRU per class.
+
+    The objects of the pinned classes (few distinct values, seen in every
+    analysis) are kept in a separate dict and never evicted; once it holds
+    pinned_capacity objects, the new ones go to the LRU of their class.
+
+    Entries are only evicted by trim(), which must be called between
+    transactions: an object flushed in the current transaction has to stay
+    in the cache until it is committed (see uniquify()). The keys added
+    since then are journaled, so that those of a rolled back transaction
+    or savepoint can be forgotten (see mark() and rollback()).
+    """
+    def __init__(self, capacity=10000, capacities=None,
+                 pinned=(Generator, Sut), pinned_capacity=1000):
+        """
+        capacity is the number of objects kept per class, unless given in
+        the dict capacities {class: capacity}
+        """
+        self.capacity = capacity
+        self.capacities = capacities or dict()
+        self.pinned_classes = set(pinned)
+        self.pinned_capacity = pinned_capacity
+        self.pinned = dict()
+        self.lrus = dict()
+        # keys added since the last trim(), in order
+        self.journal = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lru(self, cls):
+        lru = self.lrus.get(cls)
+        if lru is None:
+            lru = self.lrus[cls] = OrderedDict()
+        return lru
+
+    def __contains__(self, key):
+        return key in self.pinned or key in self.lrus.get(key[0], ())
+
+    def __getitem__(self, key):
+        if key in self.pinned:
+            return self.pinned[key]
+        lru = self.lrus[key[0]]
+        # moves key to the most recently used end
+        value = lru[key] = lru.pop(key)
+        return value
+
+    def get(self, key, default=None):
+        """
+        Returns the object cached for key, or default, and counts the
+        hit or miss
+        """
+        if key in self:
+            self.hits += 1
+            return self[key]
+        self.misses += 1
+        return default
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.journal.append(key)
+        if key[0] in self.pinned_classes and (
+            key in self.pinned or len(self.pinned) < self.pinned_capacity):
+            self.pinned[key] = value
+            return
+        lru = self._lru(key[0])
+        lru.pop(key, None)
+        lru[key] = value
+
+    def __delitem__(self, key):
+        if key in self.pinned:
+            del self.pinned[key]
+        else:
+            del self.lrus[key[0]][key]
+
+    def __iter__(self):
+        for key in self.pinned:
+            yield key
+        for lru in self.lrus.values():
+            for key in lru:
+                yield key
+
+    def __len__(self):
+        return len(self.pinned) + sum(len(lru) for lru in self.lrus.values())
+
+    def mark(self):
+        """
+        Returns the position of the journal, to be given to rollback()
+        """
+        return len(self.journal)
+
+    def rollback(self, mark=0):
+        """
+        Removes the keys added since mark was taken, whose objects have
+        been rolled back
+        """
+        for key in self.journal[mark:]:
+            if key in self:
+                del self[key]
+        del self.journal[mark:]
+
+    def trim(self):
+        """
+        Evicts the least recently used objects of the classes which are
+        over their capacity, once the transaction is committed
+        """
+        del self.journal[:]
+        for (cls, lru) in self.lrus.items():
+            capacity = self.capacities.get(cls, self.capacity)
+            while len(lru) > capacity:
+                lru.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return ("%d hits, %d misses, %d evictions, %d objects cached"
+                % (self.hits, self.misses, self.evictions, len(self)))
@@ -16,11 +16,57 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, LargeBinary
+from sqlalchemy.engine import reflection, Connection
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 def _get_engine(url, echo):
-    return create_engine(url, echo=echo)
+    engine = create_engine(url, echo=echo)
+    if engine.dialect.name == "sqlite":
+        _fix_sqlite_transactions(engine)
+    _detect_binary_ids(engine)
+    return engine
+
+def stores_binary_ids(bind):
+    """
+    True if the ids of the db of bind (an engine or a connection) are
+    stored as raw bytes rather than as hex strings (see
+    firewoes.lib.orm.HashId), i.e. if its analysis.id column is binary
+    """
+    inspector = reflection.Inspector.from_engine(bind)
+    if "analysis" not in inspector.get_table_names():
+        return False
+    return any(isinstance(column["type"], LargeBinary)
+               for column in inspector.get_columns("analysis")
+               if column["name"] == "id")
+
+def _detect_binary_ids(engine):
+    """
+    Sets binary_ids on the dialect of engine, unless it's already set, when
+    the first connection to the db is made: creating the engine (e.g. when
+    the web app is imported) doesn't connect to the db
+    """
+    @event.listens_for(engine, "first_connect")
+    def do_first_connect(dbapi_connection, connection_record):
+        if getattr(engine.dialect, "binary_ids", None) is None:
+            # the same kind of connection as the one the dialect is
+            # initialized with
+            connection = Connection(engine, connection=dbapi_connection,
+                                    _has_events=False)
+            engine.dialect.binary_ids = stores_binary_ids(connection)
+
+def _fix_sqlite_transactions(engine):
+    """
+    pysqlite doesn't emit BEGIN before a SAVEPOINT, which breaks
+    session.begin_nested(): we let SQLAlchemy emit it instead
+    """
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(connection):
+        connection.execute("BEGIN")
 
 def get_engine_session(url, echo=False):
     """
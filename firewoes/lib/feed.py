@@ -0,0 +1,111 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Ingestion sequence of the analyses, from which consumers can fetch the
+results first seen after a given point.
+
+Each new analysis gets the next number of a counter (analysis.seq), at
+the end of the transaction which inserts it: the row of the counter stays
+locked until the commit, so the numbers are given in the order of the
+commits, and a consumer which has seen a number has seen all the smaller
+ones.
+"""
+
+import re
+import time
+
+from sqlalchemy import Table, Column, String, BigInteger, DDL, event, \
+    select, and_, or_
+
+from firewoes.lib.orm import metadata, t_analysis, t_result
+
+
+_id_re = re.compile(r"^([0-9a-f]{2})+$")
+
+t_ingest_sequence = \
+    Table('ingest_sequence', metadata,
+          Column('name', String, primary_key=True, autoincrement=False),
+          Column('value', BigInteger, nullable=False),
+          )
+event.listen(t_ingest_sequence, "after_create", DDL(
+        "INSERT INTO ingest_sequence (name, value) VALUES ('analysis', 0)"))
+
+
+def stamp_analyses(connection, analysis_ids, now=None):
+    """
+    Gives the next numbers of the sequence, and the ingestion time now
+    (default: the current time), to those of the analyses of analysis_ids
+    which don't have any yet. This has to be done at the end of the
+    transaction which inserted them, since it locks the sequence until
+    the commit.
+    Returns the number of analyses stamped.
+    """
+    t = t_analysis
+    if now is None:
+        now = time.time()
+    ids = sorted(set(analysis_ids))
+    unstamped = []
+    for i in range(0, len(ids), 500):
+        unstamped.extend(row.id for row in connection.execute(
+                select([t.c.id]).where(and_(t.c.id.in_(ids[i:i + 500]),
+                                            t.c.seq == None))))
+    if not unstamped:
+        return 0
+    unstamped.sort()
+
+    s = t_ingest_sequence
+    connection.execute(s.update().where(s.c.name == "analysis")
+                       .values(value=s.c.value + len(unstamped)))
+    last = connection.execute(select([s.c.value])
+                              .where(s.c.name == "analysis")).scalar()
+    first = last - len(unstamped) + 1
+    for (i, analysis_id) in enumerate(unstamped):
+        connection.execute(t.update().where(t.c.id == analysis_id)
+                           .values(seq=first + i, ingested_at=now))
+    return len(unstamped)
+
+def make_token(seq, result_id=None):
+    """
+    Returns the cursor of the results after the result result_id of the
+    analysis seq (after all its results if result_id is None)
+    """
+    if result_id is None:
+        return "%d" % seq
+    return "%d-%s" % (seq, result_id)
+
+def parse_token(token):
+    """
+    Returns the tuple (seq, result_id) of a cursor given by make_token().
+    Raises ValueError if it's invalid.
+    """
+    (seq, _, result_id) = token.partition("-")
+    if result_id and not _id_re.match(result_id):
+        raise ValueError("invalid result id: %s" % result_id)
+    return (int(seq), result_id or None)
+
+def since_condition(token):
+    """
+    Returns the condition on t_analysis and t_result of the results after
+    the cursor token, to be ordered by analysis.seq, result.id
+    """
+    (seq, result_id) = parse_token(token)
+    if result_id is None:
+        return t_analysis.c.seq > seq
+    return or_(t_analysis.c.seq > seq,
+               and_(t_analysis.c.seq == seq, t_result.c.id > result_id))
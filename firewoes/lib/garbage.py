@@ -0,0 +1,211 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Deletion of analyses, and garbage collection of the rows they alone
+referenced.
+
+Most rows are shared by content hash between analyses: once analyses are
+deleted, the rows which aren't referenced anymore are deleted table by
+table, each table with one DELETE ... WHERE NOT EXISTS (...), the tables
+being visited from the referencing ones to the referenced ones.
+"""
+
+from sqlalchemy import select, exists, and_, or_, func, literal_column, \
+    DDL, event
+
+from firewoes.lib.orm import metadata, t_analysis, t_metadata, t_sut, \
+    t_generator, t_result, t_state, t_intfield, t_strfield, t_location
+from firewoes.lib.manifest import t_ingested_file
+from firewoes.lib.search import t_result_search
+from firewoes.lib.feed import t_ingest_sequence
+
+
+# tables whose rows are a part of the content of a row of another table
+# (its owner), with the column referencing the owner: they are deleted
+# along with their owner, and don't keep it alive
+owned_tables = {t_result: t_result.c.analysis_id,
+                t_state: t_state.c.trace_id,
+                t_intfield: t_intfield.c.customfields_id,
+                t_strfield: t_strfield.c.customfields_id}
+
+
+def select_analyses(package=None, version=None, generator=None):
+    """
+    Returns a select of the ids of the analyses whose sut has the name
+    package and the version version, and whose generator is named
+    generator (None matches everything)
+    """
+    query = select([t_analysis.c.id]).select_from(
+        t_analysis.join(t_metadata).outerjoin(t_sut).join(t_generator))
+    if package is not None:
+        query = query.where(t_sut.c.name == package)
+    if version is not None:
+        query = query.where(t_sut.c.version == version)
+    if generator is not None:
+        query = query.where(t_generator.c.name == generator)
+    return query
+
+# the dbs created before the counter get its row at the first collection
+event.listen(t_ingest_sequence, "after_create", DDL(
+        "INSERT INTO ingest_sequence (name, value) VALUES ('collections', 0)"))
+
+def collection_count(connection):
+    """
+    Returns the number of the transactions which deleted rows with a
+    Collector: a known ids store (see firewoes.lib.knownids) saved at
+    another count can list rows which don't exist anymore
+    """
+    s = t_ingest_sequence
+    return connection.execute(select([s.c.value])
+                              .where(s.c.name == "collections")).scalar() or 0
+
+def _count_collection(connection):
+    s = t_ingest_sequence
+    if not connection.execute(s.update().where(s.c.name == "collections")
+                              .values(value=s.c.value + 1)).rowcount:
+        connection.execute(s.insert().values(name="collections", value=1))
+
+def _owner(table):
+    column = owned_tables.get(table)
+    if column is None:
+        return table
+    return _owner(list(column.foreign_keys)[0].column.table)
+
+def _references(table):
+    """
+    Returns the columns which keep the rows of table alive
+    """
+    return [fk.parent for referencing in metadata.sorted_tables
+            for fk in referencing.foreign_keys
+            if fk.column.table is table
+            and fk.parent is not owned_tables.get(referencing)]
+
+def collection_order():
+    """
+    Returns the shared tables, each one after all the tables (or their
+    owned tables) which reference it
+    """
+    shared = [table for table in metadata.sorted_tables
+              if "id" in table.c and table not in owned_tables
+              and table is not t_analysis]
+    referencing = dict((table, set()) for table in shared)
+    for table in shared:
+        for column in _references(table):
+            owner = _owner(column.table)
+            if owner in referencing and owner is not table:
+                referencing[table].add(owner)
+
+    order = []
+    def visit(table):
+        if table not in order:
+            for owner in referencing[table]:
+                visit(owner)
+            order.append(table)
+    for table in shared:
+        visit(table)
+    return order
+
+def _size(connection, table):
+    """
+    Returns an expression of the size in bytes of a row of table
+    """
+    if connection.dialect.name == "postgresql":
+        return func.pg_column_size(literal_column('"%s".*' % table.name))
+    # approximation: size of the values
+    return sum(func.coalesce(func.length(column), 0) for column in table.c)
+
+class Collector(object):
+    def __init__(self, connection, chunk_size=500):
+        """
+        The deletions happen in the current transaction of connection, which
+        is left to the caller
+        """
+        self.connection = connection
+        self.chunk_size = chunk_size
+        # table name -> [rows, bytes]
+        self.freed = dict()
+        self._counted = False
+
+    def _delete(self, table, condition):
+        (rows, size) = self.connection.execute(
+            select([func.count(), func.sum(_size(self.connection, table))])
+            .select_from(table).where(condition)).first()
+        if rows:
+            if not self._counted:
+                _count_collection(self.connection)
+                self._counted = True
+            self.connection.execute(table.delete().where(condition))
+            freed = self.freed.setdefault(table.name, [0, 0])
+            freed[0] += rows
+            freed[1] += size or 0
+        return rows
+
+    def delete_analyses(self, query):
+        """
+        Deletes the analyses selected by query (a select of their ids), with
+        their results (and their rows in result_search) and their manifest
+        entries.
+        Returns the number of analyses deleted.
+        """
+        ids = [row[0] for row in self.connection.execute(query)]
+        for i in range(0, len(ids), self.chunk_size):
+            chunk = ids[i:i + self.chunk_size]
+            self._delete(t_ingested_file,
+                         t_ingested_file.c.analysis_id.in_(chunk))
+            self._delete(t_result_search,
+                         t_result_search.c.analysis_id.in_(chunk))
+            self._delete(t_result, t_result.c.analysis_id.in_(chunk))
+            self._delete(t_analysis, t_analysis.c.id.in_(chunk))
+        return len(ids)
+
+    def inline_locations(self):
+        """
+        Detaches the locations from their point or range, whose coordinates
+        are stored inline, so that the point and range rows can be
+        collected.
+        Returns the number of locations detached.
+        """
+        t = t_location
+        return self.connection.execute(
+            t.update().where(and_(t.c.start_line != None,
+                                  or_(t.c.point_id != None,
+                                      t.c.range_id != None)))
+            .values(point_id=None, range_id=None)).rowcount
+
+    def collect(self):
+        """
+        Deletes the rows of the shared tables which aren't referenced anymore
+        """
+        for table in collection_order():
+            orphan = and_(*[~exists().where(column == table.c.id)
+                            for column in _references(table)])
+            for (owned, column) in owned_tables.items():
+                if column.references(table.c.id):
+                    self._delete(owned, column.in_(
+                            select([table.c.id]).where(orphan)))
+            self._delete(table, orphan)
+
+    def report(self):
+        lines = ["  %-16s %9s %12s" % ("table", "rows", "bytes")]
+        for (table_name, (rows, size)) in sorted(self.freed.items()):
+            lines.append("  %-16s %9d %12d" % (table_name, rows, size))
+        lines.append("  %-16s %9d %12d" % (
+                "total", sum(rows for (rows, size) in self.freed.values()),
+                sum(size for (rows, size) in self.freed.values())))
+        return "\n".join(lines)
@@ -18,13 +18,24 @@
 
 import hashlib
 from firehose.model import _string_type
+from sqlalchemy.orm import class_mapper
+
+from firewoes.lib.cache import UniqueCache
+
+def new_hasher():
+    """
+    Returns a hashlib object for the cryptographic hash used for the ids.
+    This allows to easily change the hash algorithm.
+    """
+    return hashlib.sha1()
 
 def strhash(string):
     """
     Returns the cryptographic hash of a string.
-    This allows to easily change the hash algorithm.
     """
-    return hashlib.sha1(string).hexdigest()
+    hasher = new_hasher()
+    hasher.update(string)
+    return hasher.hexdigest()
 
 def get_attrs(obj):
     """
@@ -33,105 +44,230 @@ def get_attrs(obj):
     """
     return [(attr.name, getattr(obj, attr.name)) for attr in obj.attrs]
 
-def idify(obj, debug=False):
+def _is_leaf(obj):
+    return obj is None or type(obj) in (int, float, str, _string_type)
+
+def _leaf_hash(obj, memo):
+    """
+    Returns the hash of None or of a value, memoized by value in memo
+    """
+    key = (type(obj), obj)
+    try:
+        return memo[key]
+    except KeyError:
+        pass
+    if obj is None:
+        hash_ = strhash("")
+    else:
+        hash_ = strhash(str(obj))
+    memo[key] = hash_
+    return hash_
+
+def idify(obj, debug=False, memo=None):
     """
     Performs a bottom-up browsing of a Firehose tree, to add to each
     object its id, which is its cryptographic hash.
-    Acts recursively.
-    Returns a tuple: (object_with_id, object_id(=object_hash))
+    Returns a tuple: (object_with_id, object_id(=object_hash)), or a list
+    of such tuples if obj is a list.
     
     The hash is calculated with the concatenation of node's children, e.g.:
         hash(Generator) =
         hash("name [Generator.name.hash] version [Generator.version.hash]")
+    
+    The tree is browsed without recursion (deep trees can't reach the
+    recursion limit), each node's hash is fed incrementally with its
+    children's hashes, and the hashes are memoized: the nodes by identity
+    during the call, and in memo, a dict which can be shared between calls
+    (e.g. for all the results of an analysis), the values (strings,
+    numbers) and the nodes by their class and children's hashes, so that
+    equal subtrees are only hashed once.
     """
-    def hashtoken(attr_name, obj_tuple):
-        """
-        Returns the string chunk used to hash a tree node, e.g.:
-        hashtoken("Generator", (Generator(foobar), "54fd24ec..."))
-             = "Generator 54fd24ec"
-        """
-        return attr_name + " " + obj_tuple[1] + " "
+    if memo is None:
+        memo = dict()
     
     if debug:
         print("ENTERING " + str(obj)[:60])
     
-    if obj is None:
-        return (None, strhash(""))
-    
-    elif type(obj) in [int, float, str, _string_type]:
-        return (obj, strhash(str(obj)))
+    if _is_leaf(obj):
+        return (obj, _leaf_hash(obj, memo))
     
     elif isinstance(obj, list):
-        result = [idify(item) for item in obj]
-        return result
+        return [idify(item, debug=debug, memo=memo) for item in obj]
     
-    else:
-        objhash = ""
-        for (attr_name, attr) in get_attrs(obj):
-            res = idify(attr)
+    # hashes of the already idified nodes, by identity
+    # (the nodes are kept in the values, so that their id() isn't reused)
+    done = dict()
+    # attributes of the nodes whose children are being idified
+    expanded = dict()
+    
+    def hash_of(child):
+        if _is_leaf(child):
+            return _leaf_hash(child, memo)
+        return done[id(child)][1]
+    
+    stack = [obj]
+    while stack:
+        node = stack[-1]
+        if id(node) in done:
+            stack.pop()
+            continue
+        
+        if id(node) not in expanded:
+            # first visit: the children have to be hashed before the node
+            attrs = expanded[id(node)] = get_attrs(node)
+            for (attr_name, attr) in reversed(attrs):
+                items = attr if isinstance(attr, list) else [attr]
+                stack.extend(item for item in reversed(items)
+                             if not _is_leaf(item) and id(item) not in done)
+            continue
+        
+        # the attributes are left untouched: assigning them again would
+        # be expensive for the mapped relationships (e.g. Analysis.results)
+        children = []
+        for (attr_name, attr) in expanded.pop(id(node)):
             if debug:
-                print("SETATTR %s // %s" % (str(obj)[:40], attr_name))
+                print("HASH %s // %s" % (str(node)[:40], attr_name))
             
-            if isinstance(res, list):
-                # we get the objects:
-                items_without_hashes = [item[0] for item in res]
-                # we add their hashes:
-                for item in res:
-                    objhash += hashtoken(attr_name, item)
-                
-                # and we update the attribute:
-                setattr(obj, attr_name, items_without_hashes)
+            if isinstance(attr, list):
+                children.extend((attr_name, hash_of(item)) for item in attr)
             else:
-                # we add the hash:
-                objhash += hashtoken(attr_name, res)
-                
-                # and update the attribute:
-                setattr(obj, attr_name, res[0])
+                children.append((attr_name, hash_of(attr)))
         
-        # final hash is the id:
-        obj.id = strhash(objhash)
+        key = (node.__class__, tuple(children))
+        hash_ = memo.get(key)
+        if hash_ is None:
+            hasher = new_hasher()
+            for (attr_name, child_hash) in children:
+                hasher.update(attr_name + " " + child_hash + " ")
+            hash_ = memo[key] = hasher.hexdigest()
         
-        return (obj, obj.id)
+        # final hash is the id:
+        node.id = hash_
+        done[id(node)] = (node, node.id)
+        stack.pop()
+    
+    return (obj, obj.id)
 
-def uniquify(session, obj, debug=False):
+def _children(obj):
+    """
+    Returns the list of tuples (attribute_name, attribute) of a Firehose
+    object, for attributes which are Firehose objects or lists of them
+    """
+    return [(attr_name, attr) for (attr_name, attr) in get_attrs(obj)
+            if isinstance(attr, list)
+            or (type(attr) not in (int, float, str, _string_type)
+                and attr is not None)]
+
+def ids_by_class(obj):
+    """
+    Returns a dict {class: set(ids)} of all the nodes of an idified
+    Firehose tree
+    """
+    ids = dict()
+    stack = [obj]
+    while stack:
+        node = stack.pop()
+        ids.setdefault(node.__class__, set()).add(node.id)
+        for (attr_name, attr) in _children(node):
+            if isinstance(attr, list):
+                stack.extend(attr)
+            else:
+                stack.append(attr)
+    return ids
+
+def _existing_objects(session, ids, chunk_size=500):
+    """
+    Given a dict {class: set(ids)}, returns a dict {(class, id): object}
+    of the objects which already exist in the db, with one
+    "id IN (...)" query per class (and per chunk_size ids)
+    """
+    existing = dict()
+    for (cls, cls_ids) in ids.items():
+        cls_ids = list(cls_ids)
+        for i in range(0, len(cls_ids), chunk_size):
+            for res in (session.query(cls)
+                        .filter(cls.id.in_(cls_ids[i:i + chunk_size]))):
+                existing[(cls, res.id)] = res
+    return existing
+
+def uniquify(session, obj, debug=False, stats=None):
     """
     Renders a Firehose tree unique, regarding an SQLAlchemy session.
     Inspired by http://www.sqlalchemy.org/trac/wiki/UsageRecipes/UniqueObject
-    """
-    if debug:
-        print("UNIQUIFY: %s" % str(obj)[:60])
     
+    The existence of the nodes is resolved in two phases: the ids of the
+    tree are first collected per class, and checked with one query per
+    class; the tree is then rebuilt from the answers.
+    
+    If an IngestionStats is given, the distinct objects of the tree which
+    are new or already exist are counted per table.
+    """
     # we kep objetcs in cache for better performances
     cache = getattr(session, '_unique_cache', None)
     if cache is None:
-        session._unique_cache = cache = {}
+        session._unique_cache = cache = UniqueCache()
+    
+    with session.no_autoflush:
+        ids = dict()
+        for (cls, cls_ids) in ids_by_class(obj).items():
+            cls_ids = set(id_ for id_ in cls_ids if (cls, id_) not in cache)
+            if cls_ids:
+                ids[cls] = cls_ids
+        existing = _existing_objects(session, ids)
+        
+        # (class, id) -> True if the object is new
+        new = dict()
+        obj = _uniquify_node(session, obj, existing, cache, debug=debug,
+                             new=new)
+    
+    if stats is not None:
+        counts = dict()
+        for ((cls, id_), is_new) in new.items():
+            counts.setdefault(cls, [0, 0])[0 if is_new else 1] += 1
+        for (cls, (new_count, existing_count)) in counts.items():
+            stats.add_objects(class_mapper(cls).local_table.name,
+                              new=new_count, existing=existing_count)
+    return obj
+
+def _uniquify_node(session, obj, existing, cache, debug=False, new=None):
+    """
+    Recursive part of uniquify(): existing is the dict returned by
+    _existing_objects() for the whole tree. The new dict is filled with
+    (class, id) -> whether the object is new.
+    """
+    if debug:
+        print("UNIQUIFY: %s" % str(obj)[:60])
     
+    if new is None:
+        new = dict()
     key = (obj.__class__, obj.id)
-    if key in cache:
-        return cache[key]
+    res = cache.get(key)
+    if res is not None:
+        new.setdefault(key, False)
+        return res
     else:
-        with session.no_autoflush:
-            res = (session.query(obj.__class__)
-                   .filter(obj.__class__.id == obj.id).first())
-            if not res:
-                # the object doesn't exist in the db,
-                # we check recursively its attributes and add it
-                res = obj
-                
-                # recursion
-                for (attr_name, attr) in get_attrs(res):
-                    if isinstance(attr, list):
-                        # if it's a list we do this for each item
-                        setattr(res,
-                                attr_name,
-                                [uniquify(session, item) for item in attr])
-                            
-                    elif (type(attr) not in (int, float, str, _string_type)
-                          and attr is not None):
-                        setattr(res, attr_name, uniquify(session, attr))
-                
-                # we finally add it
-                session.add(res)
+        res = existing.get(key)
+        new[key] = res is None
+        if res is None:
+            # the object doesn't exist in the db,
+            # we check recursively its attributes and add it
+            res = obj
+            
+            # recursion
+            for (attr_name, attr) in _children(res):
+                if isinstance(attr, list):
+                    # if it's a list we do this for each item
+                    setattr(res, attr_name,
+                            [_uniquify_node(session, item, existing, cache,
+                                            new=new)
+                             for item in attr])
+                else:
+                    setattr(res, attr_name,
+                            _uniquify_node(session, attr, existing, cache,
+                                           new=new))
+            
+            # we finally add it
+            session.add(res)
         # update the cache
         cache[key] = res
         
@@ -0,0 +1,288 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Persistent set of the (table, id) pairs known to exist in the db, so that
+ingestion doesn't have to ask the db again about the objects inserted by
+a previous run.
+
+It is stored in two files next to each other:
+  - PATH.ids: the exact set, one "id table" line per pair, sorted
+  - PATH.bloom: a Bloom filter of the same set, which answers most of the
+    "not known" questions without reading PATH.ids, after a header giving
+    its size, the collection count and the number of lines of PATH.ids
+
+The store can be rebuilt from the db at any time with rebuild(). It
+records the collection count of the db it was saved for (see
+firewoes.lib.garbage.collection_count()): open_known_ids() rebuilds it if
+rows were deleted from the db since, instead of trusting ids which may not
+exist anymore.
+"""
+
+import os
+import math
+import mmap
+import heapq
+import zlib
+import tempfile
+
+from sqlalchemy import select
+
+from firewoes.lib.orm import metadata
+from firewoes.lib.garbage import collection_count
+
+
+def content_tables():
+    """
+    Returns the tables whose rows are identified by a content hash
+    """
+    return [table for table in metadata.sorted_tables if "id" in table.c]
+
+class KnownIds(object):
+    def __init__(self, path, error_rate=0.01):
+        """
+        Opens the store saved at path (PATH.ids and PATH.bloom), which
+        is empty if these files don't exist yet.
+        """
+        self.path = path
+        self.error_rate = error_rate
+        self.pending = set()
+        # collection count of the db when the store was saved
+        self.generation = 0
+        # number of lines of PATH.ids
+        self.count = 0
+        self._ids_file = None
+        self._ids_map = None
+        self._load()
+
+    def _load(self):
+        self.close()
+        try:
+            with open(self.path + ".bloom", "rb") as f:
+                header = [int(x) for x in f.readline().split()]
+                self.bloom = bytearray(f.read())
+            (self.bits, self.hashes) = header[:2]
+            # older stores don't have the generation nor the count
+            self.generation = header[2] if len(header) > 2 else 0
+            self.count = header[3] if len(header) > 3 else None
+        except IOError:
+            (self.bits, self.hashes, self.count) = (0, 0, None)
+            self.bloom = bytearray()
+
+        size = 0
+        if os.path.exists(self.path + ".ids"):
+            size = os.path.getsize(self.path + ".ids")
+        if size > 0:
+            self._ids_file = open(self.path + ".ids", "rb")
+            self._ids_map = mmap.mmap(self._ids_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        if self.count is None:
+            # at most one line per "id table" of the shortest table name
+            self.count = size // (42 + min(len(table.name)
+                                           for table in content_tables()))
+
+    def close(self):
+        if self._ids_map is not None:
+            self._ids_map.close()
+            self._ids_file.close()
+        self._ids_file = None
+        self._ids_map = None
+
+    ### Bloom filter ###
+
+    def _positions(self, line, bits, hashes):
+        """
+        Returns the bits of the Bloom filter for a "id table" line.
+        The ids are already cryptographic hashes, so we use them directly
+        (double hashing with two slices of the id, salted by the table).
+        """
+        h1 = int(line[0:8], 16)
+        h2 = int(line[8:16], 16) ^ (zlib.crc32(line[41:]) & 0xffffffff)
+        return [(h1 + i * h2) % bits for i in range(hashes)]
+
+    def _bloom_add(self, bloom, line, bits, hashes):
+        for pos in self._positions(line, bits, hashes):
+            bloom[pos >> 3] |= 1 << (pos & 7)
+
+    def _bloom_contains(self, line):
+        if not self.bits:
+            return False
+        for pos in self._positions(line, self.bits, self.hashes):
+            if not self.bloom[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def _bloom_size(self, count):
+        """
+        Returns the (bits, hashes) of a Bloom filter holding count items
+        with self.error_rate false positives
+        """
+        count = max(count, 1)
+        bits = int(math.ceil(-count * math.log(self.error_rate)
+                             / math.log(2) ** 2))
+        bits = max(8, (bits + 7) // 8 * 8)
+        hashes = max(1, int(round(float(bits) / count * math.log(2))))
+        return (bits, hashes)
+
+    ### exact sorted file ###
+
+    def _ids_contains(self, line):
+        """
+        Binary search of line in the sorted PATH.ids
+        """
+        if self._ids_map is None:
+            return False
+        data = self._ids_map
+        (low, high) = (0, len(data))
+        while low < high:
+            middle = (low + high) // 2
+            # beginning of the line containing middle:
+            start = data.rfind("\n", 0, middle) + 1
+            end = data.find("\n", start)
+            if end == -1:
+                end = len(data)
+            current = data[start:end]
+            if current == line:
+                return True
+            elif current < line:
+                low = end + 1
+            else:
+                high = start
+        return False
+
+    ### public API ###
+
+    @staticmethod
+    def _line(table_name, id_):
+        return "%s %s" % (id_, table_name)
+
+    def __contains__(self, table_id):
+        """
+        (table_name, id) in known_ids
+        """
+        line = self._line(*table_id)
+        if line in self.pending:
+            return True
+        return self._bloom_contains(line) and self._ids_contains(line)
+
+    def add(self, table_name, id_):
+        """
+        Records that the row id_ exists in table_name. It is kept in
+        memory until save() is called.
+        """
+        self.pending.add(self._line(table_name, id_))
+
+    def save(self):
+        """
+        Merges the pending ids into PATH.ids, and regenerates PATH.bloom
+        """
+        if not self.pending and os.path.exists(self.path + ".bloom"):
+            return
+        pending = sorted(self.pending)
+        if self._ids_map is not None:
+            self._ids_map.seek(0)
+            saved = (line.rstrip("\n")
+                     for line in iter(self._ids_map.readline, ""))
+        else:
+            saved = iter([])
+        self._write(heapq.merge(saved, pending), len(pending) + self.count)
+        self.pending = set()
+
+    def _temporary_file(self, suffix):
+        """
+        Returns a tuple (file open for writing, its path) of a new file
+        next to PATH+suffix, which is then renamed to it, so that processes
+        saving the same store don't write into the same file
+        """
+        (fd, path) = tempfile.mkstemp(
+            prefix=os.path.basename(self.path + suffix) + ".",
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        return (os.fdopen(fd, "wb"), path)
+
+    def _write(self, sorted_lines, count):
+        """
+        Writes the sorted (possibly duplicated) lines to PATH.ids and
+        their Bloom filter, sized for count lines, to PATH.bloom, then
+        reloads the store
+        """
+        (bits, hashes) = self._bloom_size(count)
+        bloom = bytearray(bits // 8)
+        (ids_file, ids_path) = self._temporary_file(".ids")
+        (bloom_file, bloom_path) = self._temporary_file(".bloom")
+        try:
+            (previous, written) = (None, 0)
+            with ids_file:
+                for line in sorted_lines:
+                    if line == previous:
+                        continue
+                    ids_file.write(line + "\n")
+                    self._bloom_add(bloom, line, bits, hashes)
+                    (previous, written) = (line, written + 1)
+            with bloom_file:
+                bloom_file.write("%d %d %d %d\n" % (bits, hashes,
+                                                     self.generation,
+                                                     written))
+                bloom_file.write(bloom)
+            self.close()
+            os.rename(ids_path, self.path + ".ids")
+            os.rename(bloom_path, self.path + ".bloom")
+        except:
+            for path in (ids_path, bloom_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        self._load()
+
+    def clear(self):
+        """
+        Empties the store (e.g. when the db is dropped)
+        """
+        self.pending = set()
+        self.generation = 0
+        self._write([], 0)
+
+    def rebuild(self, connection, tables=None):
+        """
+        Replaces the content of the store with the ids found in tables
+        (default: content_tables()) of the db of connection, so that it
+        can't drift from the db permanently.
+        """
+        if tables is None:
+            tables = content_tables()
+        self.generation = collection_count(connection)
+        lines = []
+        for table in tables:
+            for (id_,) in connection.execute(select([table.c.id])):
+                lines.append(self._line(table.name, id_))
+        lines.sort()
+        self.pending = set()
+        self._write(lines, len(lines))
+        return len(lines)
+
+def open_known_ids(path, engine):
+    """
+    Opens the store saved at path, after rebuilding it from the db of
+    engine if rows were deleted from the db since it was saved
+    """
+    known_ids = KnownIds(path)
+    with engine.connect() as connection:
+        if known_ids.generation != collection_count(connection):
+            print("rows were deleted from the db since the known ids were "
+                  "saved, rebuilding %s" % path)
+            known_ids.rebuild(connection)
+    return known_ids
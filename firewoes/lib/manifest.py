@@ -0,0 +1,140 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Manifest of the input files which were already ingested, so that a new
+run can skip them before parsing.
+
+A file is identified by the digest of its raw content; its path, size and
+mtime are also recorded, which allows to skip an unchanged file without
+even reading it. The members of archives are recorded the same way, under
+the name "archive:member"; the documents read from stdin can only be
+recognized by their digest.
+"""
+
+import os
+
+from sqlalchemy import Table, Column, String, Integer, Float, ForeignKey, \
+    Index, select
+
+from firewoes.lib.orm import metadata, HashId
+from firewoes.lib.hash import new_hasher
+from firewoes.lib.bulk import InsertIgnore
+from firewoes.lib.sources import Member
+
+
+t_ingested_file = \
+    Table('ingested_file', metadata,
+          Column('digest', String, primary_key=True, autoincrement=False),
+          Column('path', String, nullable=False),
+          Column('size', Integer, nullable=False),
+          Column('mtime', Float, nullable=False),
+          # NULL if the file didn't contain any analysis (e.g. empty file)
+          Column('analysis_id', HashId, ForeignKey('analysis.id')),
+          )
+Index('ix_ingested_file_path', t_ingested_file.c.path)
+Index('ix_ingested_file_analysis_id', t_ingested_file.c.analysis_id)
+
+
+def file_digest(path, block_size=1 << 16):
+    """
+    Returns the digest of the raw content of a file
+    """
+    hasher = new_hasher()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+class ManifestEntry(object):
+    def __init__(self, path, size, mtime, digest):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+
+class Manifest(object):
+    def __init__(self, session):
+        """
+        Loads the manifest of the db linked to session
+        """
+        self.session = session
+        self.by_path = dict()
+        self.digests = dict()
+        t = t_ingested_file
+        for row in session.execute(select([t.c.path, t.c.size, t.c.mtime,
+                                           t.c.digest])):
+            self.by_path[row.path] = (row.size, row.mtime)
+            self.digests[row.digest] = row.path
+
+    def check(self, xml_file):
+        """
+        Returns None if xml_file (a path or a Member, see
+        firewoes.lib.sources) was already ingested, or its ManifestEntry,
+        to be recorded once it is.
+        A file already ingested under another path or mtime is updated in
+        the current transaction of the session, committed by the caller.
+        """
+        if isinstance(xml_file, Member):
+            entry = self._check_member(xml_file)
+            if entry is None:
+                return None
+        else:
+            stat = os.stat(xml_file)
+            if self.by_path.get(xml_file) == (stat.st_size, stat.st_mtime):
+                return None
+            entry = ManifestEntry(xml_file, stat.st_size, stat.st_mtime,
+                                  file_digest(xml_file))
+        if entry.digest in self.digests:
+            # same content, seen under another path or mtime: we update the
+            # manifest, so that the next run doesn't need to read it
+            self._update(entry)
+            return None
+        return entry
+
+    def _check_member(self, member):
+        size = len(member.data)
+        if member.mtime is not None and \
+                self.by_path.get(member.name) == (size, member.mtime):
+            return None
+        hasher = new_hasher()
+        hasher.update(member.data)
+        return ManifestEntry(member.name, size, member.mtime or 0,
+                             hasher.hexdigest())
+
+    def _update(self, entry):
+        t = t_ingested_file
+        self.session.execute(
+            t.update().where(t.c.digest == entry.digest).values(
+                path=entry.path, size=entry.size, mtime=entry.mtime))
+        self.session.flush()
+        self._remember(entry)
+
+    def _remember(self, entry):
+        self.by_path[entry.path] = (entry.size, entry.mtime)
+        self.digests[entry.digest] = entry.path
+
+    def record(self, entry, analysis_id):
+        """
+        Records the file of entry as ingested, producing analysis_id.
+        This is done in the current transaction of the session.
+        """
+        self.session.execute(InsertIgnore(t_ingested_file).values(
+                digest=entry.digest, path=entry.path, size=entry.size,
+                mtime=entry.mtime, analysis_id=analysis_id))
+        self._remember(entry)
@@ -0,0 +1,276 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Upgrades of the schema of the databases created by older versions
+(firewoes_db.py URL upgrade).
+
+Each migration looks at the schema to find out whether it's needed, so
+that they can all be run on any db, in order; the dbs created from
+scratch (metadata.create_all()) don't need any.
+
+The conversion of the ids between hex strings and raw bytes (see
+firewoes.lib.orm.HashId) is done separately, by convert_ids().
+"""
+
+from sqlalchemy import select, bindparam, exists, func, and_, or_
+from sqlalchemy.engine import reflection
+from sqlalchemy.orm import Session, subqueryload
+
+from firewoes.lib.orm import metadata, HashId, Trace, encode_states, \
+    t_analysis, t_result, t_metadata, t_location, t_point, t_range, \
+    t_trace, t_state
+from firewoes.lib.feed import t_ingest_sequence
+from firewoes.lib import search
+from firewoes.lib.dbutils import stores_binary_ids
+from firewoes.lib.staging import StagingLoader
+
+
+# list of (name, function(connection)), in order: function returns False
+# if there was nothing to do
+migrations = []
+
+def migration(function):
+    migrations.append((function.__name__, function))
+    return function
+
+def _columns(connection, table_name):
+    inspector = reflection.Inspector.from_engine(connection)
+    return set(column["name"]
+               for column in inspector.get_columns(table_name))
+
+def _index(table, name):
+    return [index for index in table.indexes if index.name == name][0]
+
+def _has_index(connection, table_name, name):
+    if connection.dialect.name == "postgresql":
+        # the inspector skips the indexes on expressions
+        return connection.execute(
+            "SELECT 1 FROM pg_indexes WHERE indexname = %(name)s",
+            name=name).first() is not None
+    inspector = reflection.Inspector.from_engine(connection)
+    return name in [index["name"]
+                    for index in inspector.get_indexes(table_name)]
+
+
+@migration
+def analysis_seq(connection):
+    """
+    Ingestion sequence of the analyses (see firewoes.lib.feed): the
+    existing analyses are numbered by id
+    """
+    if "seq" in _columns(connection, "analysis"):
+        return False
+    connection.execute("ALTER TABLE analysis ADD COLUMN seq BIGINT")
+    connection.execute("ALTER TABLE analysis ADD COLUMN ingested_at FLOAT")
+    t_ingest_sequence.create(bind=connection, checkfirst=True)
+
+    t = t_analysis
+    ids = [row.id for row in connection.execute(
+            select([t.c.id]).order_by(t.c.id))]
+    for i in range(0, len(ids), 1000):
+        connection.execute(
+            t.update().where(t.c.id == bindparam("_id"))
+            .values(seq=bindparam("_seq")),
+            [dict(_id=id_, _seq=i + j + 1)
+             for (j, id_) in enumerate(ids[i:i + 1000])])
+    s = t_ingest_sequence
+    connection.execute(s.update().where(s.c.name == "analysis")
+                       .values(value=len(ids)))
+    _index(t_analysis, "ix_analysis_seq").create(bind=connection)
+    _index(t_result, "ix_result_analysis_id_id").create(bind=connection)
+    return True
+
+@migration
+def inline_coordinates(connection):
+    """
+    Coordinates of the points and ranges of the locations, stored inline
+    (see firewoes.lib.orm.location_coordinates())
+    """
+    if "start_line" in _columns(connection, "location"):
+        return False
+    for name in ("start_line", "start_column", "end_line", "end_column"):
+        connection.execute("ALTER TABLE location ADD COLUMN %s INTEGER" % name)
+
+    (l, p, r) = (t_location, t_point, t_range)
+    def coordinate(name, range_point_id):
+        """ the coordinate of the point, or of one end of the range """
+        return func.coalesce(
+            select([p.c[name]]).where(p.c.id == l.c.point_id).as_scalar(),
+            select([p.c[name]]).where(and_(r.c.id == l.c.range_id,
+                                           p.c.id == range_point_id))
+            .as_scalar())
+    connection.execute(
+        l.update().where(or_(l.c.point_id != None, l.c.range_id != None))
+        .values(start_line=coordinate("line", r.c.start_id),
+                start_column=coordinate("column", r.c.start_id),
+                end_line=coordinate("line", r.c.end_id),
+                end_column=coordinate("column", r.c.end_id)))
+    return True
+
+@migration
+def result_search(connection):
+    """
+    Fills the search table (see firewoes.lib.search), which has just been
+    created empty
+    """
+    search.t_result_search.create(bind=connection, checkfirst=True)
+    if connection.execute(select([exists().select_from(
+                    search.t_result_search)])).scalar() \
+            or not connection.execute(select([exists().select_from(
+                    t_result)])).scalar():
+        return False
+    search.rebuild(connection)
+    return True
+
+@migration
+def search_indexes(connection):
+    """
+    Indexes of the search filters and of the joins of the locations, and
+    on PostgreSQL, indexes of the md5 of the texts instead of the texts
+    themselves (see firewoes.lib.orm.text_index())
+    """
+    done = False
+    for (table, name) in [(t_metadata, "ix_metadata_file_id"),
+                          (t_result, "ix_result_type_testid"),
+                          (t_location, "ix_location_point_id"),
+                          (t_location, "ix_location_range_id")]:
+        if not _has_index(connection, table.name, name):
+            _index(table, name).create(bind=connection)
+            done = True
+    for table_name in ("message", "notes"):
+        name = "ix_%s_text" % table_name
+        if connection.dialect.name != "postgresql":
+            # (dropped by a previous version of this migration)
+            if not _has_index(connection, table_name, name):
+                connection.execute("CREATE INDEX %s ON %s (text)"
+                                   % (name, table_name))
+                done = True
+            continue
+        if _has_index(connection, table_name, name):
+            connection.execute("DROP INDEX %s" % name)
+            done = True
+        name = "ix_%s_text_md5" % table_name
+        if not _has_index(connection, table_name, name):
+            connection.execute("CREATE INDEX %s ON %s (md5(text))"
+                               % (name, table_name))
+            done = True
+    return done
+
+@migration
+def compact_states(connection):
+    """
+    Compact form of the traces (see firewoes.lib.orm.compact_traces()): the
+    states of the existing traces are moved to trace.compact_states, in the
+    order they were displayed in, and their rows are deleted (the locations
+    and notes which only they referenced are left to firewoes_db.py URL gc)
+    """
+    if "compact_states" in _columns(connection, "trace"):
+        return False
+    connection.execute("ALTER TABLE trace ADD COLUMN compact_states TEXT")
+    compact_stored_traces(connection)
+    return True
+
+
+def compact_stored_traces(connection):
+    """
+    Moves the states of the traces stored in rows of the table state to
+    trace.compact_states, and deletes these rows
+    """
+    t = t_trace
+    ids = [row.id for row in connection.execute(
+            select([t.c.id])
+            .where(exists().where(t_state.c.trace_id == t.c.id))
+            .order_by(t.c.id))]
+    session = Session(bind=connection)
+    for i in range(0, len(ids), 500):
+        traces = (session.query(Trace).options(subqueryload(Trace.states))
+                  .filter(Trace.id.in_(ids[i:i + 500])))
+        connection.execute(
+            t.update().where(t.c.id == bindparam("_id"))
+            .values(compact_states=bindparam("_states")),
+            [dict(_id=trace.id, _states=encode_states(trace.states))
+             for trace in traces])
+        session.expunge_all()
+    session.close()
+    connection.execute(t_state.delete())
+
+
+def upgrade(engine):
+    """
+    Runs the migrations needed by the db of engine, each one in its own
+    transaction.
+    Returns the names of the migrations which were run.
+    """
+    done = []
+    for (name, function) in migrations:
+        with engine.begin() as connection:
+            if function(connection) is not False:
+                done.append(name)
+    return done
+
+def _quoted(names):
+    return ", ".join('"%s"' % name for name in names)
+
+def convert_ids(engine, binary):
+    """
+    Converts the ids of the PostgreSQL db of engine to raw bytes (if binary
+    is True) or to hex strings, in one transaction: the foreign keys are
+    dropped, and created again once all the columns are converted.
+    Returns the number of columns converted.
+    """
+    if engine.dialect.name != "postgresql":
+        raise ValueError("the ids can only be converted on PostgreSQL")
+    if stores_binary_ids(engine) == binary:
+        return 0
+    if binary:
+        (type_, using) = ("bytea", "decode(\"%s\", 'hex')")
+    else:
+        (type_, using) = ("varchar", "encode(\"%s\", 'hex')")
+
+    inspector = reflection.Inspector.from_engine(engine)
+    existing = set(inspector.get_table_names())
+    columns = dict()
+    for table in metadata.sorted_tables:
+        if table.name in existing:
+            names = _columns(engine, table.name)
+            columns[table] = [column.name for column in table.c
+                              if isinstance(column.type, HashId)
+                              and column.name in names]
+    tables = [table for table in columns if columns[table]]
+    foreign_keys = [(table.name, fk) for table in tables
+                    for fk in inspector.get_foreign_keys(table.name)]
+
+    with engine.begin() as connection:
+        # they're created LIKE the real tables, and would be out of date
+        StagingLoader().drop(connection)
+        for (table_name, fk) in foreign_keys:
+            connection.execute('ALTER TABLE "%s" DROP CONSTRAINT "%s"'
+                               % (table_name, fk["name"]))
+        for table in tables:
+            connection.execute('ALTER TABLE "%s" %s' % (table.name, ", ".join(
+                        'ALTER COLUMN "%s" TYPE %s USING %s'
+                        % (name, type_, using % name)
+                        for name in columns[table])))
+        for (table_name, fk) in foreign_keys:
+            connection.execute(
+                'ALTER TABLE "%s" ADD CONSTRAINT "%s" FOREIGN KEY (%s) '
+                'REFERENCES "%s" (%s)'
+                % (table_name, fk["name"], _quoted(fk["constrained_columns"]),
+                   fk["referred_table"], _quoted(fk["referred_columns"])))
+    return sum(len(names) for names in columns.values())
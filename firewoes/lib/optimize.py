@@ -0,0 +1,192 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Plans and latency of the queries of a standard set of searches, to see
+the effect of the indexes on a db (firewoes_db.py URL optimize).
+
+The queries are those the web app runs for /search/ (see
+Result_app.filter() in firewoes.web.app.frontend.models, and the Menu of
+firewoes.web.app.frontend.filters), with its configuration, e.g.
+SEARCH_USE_FLAT_TABLE: they are recorded while the search is made on the
+db, then run again one by one.
+"""
+
+import re
+import time
+import urllib
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+# arguments of /search/ of the standard searches: their values are the
+# most frequent ones in the db
+standard_searches = [
+    [],
+    ["type"],
+    ["generator_name"],
+    ["generator_name", "testid"],
+    ["sut_name"],
+    ["sut_name", "location_file"],
+    ]
+
+_explain = dict(postgresql="EXPLAIN ", sqlite="EXPLAIN QUERY PLAN ")
+
+
+@contextmanager
+def _app_session(connection):
+    """
+    with _app_session(connection) as (app, statements): the session of the
+    web app is bound to connection in the block, and the (statement,
+    parameters) of the queries it executes are appended to the list
+    statements (not the BEGIN of its transaction, see
+    firewoes.lib.dbutils)
+    """
+    # the web app is only needed by this command
+    from firewoes.web.app import app, session
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+    bind = session.session_factory.kw.get("bind")
+    session.remove()
+    session.configure(bind=connection)
+    event.listen(connection, "before_cursor_execute", record)
+    try:
+        yield (app, statements)
+    finally:
+        event.remove(connection, "before_cursor_execute", record)
+        session.remove()
+        session.configure(bind=bind)
+
+def _label(statement):
+    """
+    Returns the label of a statement run by a search: "count" and "page"
+    for its results, "menu COLUMN" for the items of a drill-down menu
+    """
+    group_by = re.search(r"GROUP BY (\S+)", statement)
+    label = "menu " + group_by.group(1) if group_by else "page"
+    if statement.lstrip().startswith("SELECT count(*)"):
+        label = "count" if group_by is None else label + " count"
+    return label
+
+def search_queries(connection, args):
+    """
+    Returns the list of (label, statement, parameters) executed by the web
+    app for the search of the arguments args ({name: value})
+    """
+    from firewoes.web.app.frontend.models import Result_app
+    with _app_session(connection) as (app, statements):
+        Result_app().filter(args)
+    return [(_label(statement), statement, parameters)
+            for (statement, parameters) in statements]
+
+def search_url(args):
+    return "/search/?" + urllib.urlencode(sorted(args.items()))
+
+def find_searches(connection):
+    """
+    Returns the arguments ({name: value}) of the standard searches which
+    have results in the db of connection, taken from the menus of the web
+    app
+    """
+    from firewoes.web.app import session
+    from firewoes.web.app.frontend.filters import Menu
+    with _app_session(connection) as (app, statements):
+        flat = app.config["SEARCH_USE_FLAT_TABLE"]
+        res = []
+        for names in standard_searches:
+            args = dict()
+            for name in names:
+                menu = Menu(args, flat=flat)
+                items = [filter_.get(session, args, clauses=menu.clauses,
+                                     max_items=1)["items"]
+                         for filter_ in menu.filters if filter_.name == name]
+                if not items or not items[0] or items[0][0]["value"] is None:
+                    break
+                args[name] = items[0][0]["value"]
+            else:
+                res.append(args)
+    return res
+
+def explain(connection, statement, parameters):
+    """
+    Returns the lines of the plan of statement, or [] if the dialect of
+    connection isn't supported
+    """
+    prefix = _explain.get(connection.dialect.name)
+    if prefix is None:
+        return []
+    return [row[-1] for row in _execute(connection, prefix + statement,
+                                        parameters)]
+
+def _execute(connection, statement, parameters):
+    # on the DB-API cursor, since the statements are already compiled
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(statement, parameters)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+def measure(connection, searches, repeat=3):
+    """
+    Runs the queries of each search of searches (see search_queries())
+    repeat times.
+    Returns a list of (url, label, seconds, plan): seconds is the best time
+    of the query.
+    """
+    res = []
+    for args in searches:
+        for (label, statement, parameters) in search_queries(connection,
+                                                             args):
+            times = []
+            for i in range(repeat):
+                start = time.time()
+                _execute(connection, statement, parameters)
+                times.append(time.time() - start)
+            res.append((search_url(args), label, min(times),
+                        explain(connection, statement, parameters)))
+    return res
+
+def report(before, after):
+    """
+    Returns the comparison of two measures of the same searches, as text:
+    the latency of each query, and its plans if they differ
+    """
+    lines = []
+    totals = [0., 0.]
+    url = None
+    for ((url_, label, seconds, plan),
+         (_, _, seconds_after, plan_after)) in zip(before, after):
+        if url_ != url:
+            url = url_
+            lines.append(url)
+        lines.append("  %-40s %9.1f ms -> %9.1f ms"
+                     % (label, seconds * 1000, seconds_after * 1000))
+        totals[0] += seconds
+        totals[1] += seconds_after
+        if plan != plan_after:
+            lines.append("    plan before:")
+            lines.extend("      " + line for line in plan)
+            lines.append("    plan after:")
+            lines.extend("      " + line for line in plan_after)
+    lines.append("%-42s %9.1f ms -> %9.1f ms"
+                 % ("total", totals[0] * 1000, totals[1] * 1000))
+    return "\n".join(lines)
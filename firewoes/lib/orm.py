@@ -18,17 +18,79 @@
 #   USA
 
 
+import binascii
+import json
+
 from sqlalchemy import Table, MetaData, Column, \
-    ForeignKey, Integer, String, Float, ForeignKeyConstraint, \
-    event, DDL, Index
+    ForeignKey, Integer, BigInteger, String, Text, Float, \
+    ForeignKeyConstraint, event, DDL, Index, LargeBinary, select
 from sqlalchemy.orm import mapper, relationship, polymorphic_union, \
-    sessionmaker, column_property
+    sessionmaker, column_property, object_mapper
+from sqlalchemy.orm.properties import RelationshipProperty
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.schema import Sequence
+from sqlalchemy.types import TypeDecorator
+
+from firewoes.lib.sources import _native_strings
 
 metadata = MetaData()
 
 from firehose.model import *
 
+
+############################################################################
+# Types
+############################################################################
+
+class HashId(TypeDecorator):
+    """
+    An id, i.e. the hex digest of a hash (see firewoes.lib.hash).
+    It's stored as a string, or as the raw bytes of the digest in the
+    databases whose ids were converted (firewoes_db.py URL convert-ids
+    binary), whose dialect has binary_ids set (see firewoes.lib.dbutils).
+    The ids are always hex strings on the Python side.
+    """
+    impl = String
+
+    def load_dialect_impl(self, dialect):
+        if getattr(dialect, "binary_ids", False):
+            return dialect.type_descriptor(LargeBinary())
+        return dialect.type_descriptor(String())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not getattr(dialect, "binary_ids", False):
+            return value
+        try:
+            return binascii.unhexlify(value)
+        except (TypeError, ValueError):
+            # not a hex digest: it can't be stored, and matches no row
+            return None
+
+    def process_result_value(self, value, dialect):
+        if value is None or not getattr(dialect, "binary_ids", False):
+            return value
+        return binascii.hexlify(value)
+
+def _not_postgresql(ddl, target, bind, **kw):
+    return bind.dialect.name != "postgresql"
+
+def text_index(table):
+    """
+    Indexes the text column of table. On PostgreSQL, the md5 of the texts
+    is indexed instead: a btree of the texts themselves is as big as the
+    table, and can't hold the texts longer than a third of a page (the
+    lookups then have to be written func.md5(table.c.text) ==
+    func.md5(text)). The other dialects don't have md5(), and keep the
+    plain index ix_<table>_text.
+    """
+    event.listen(table, "after_create", DDL(
+            "CREATE INDEX ix_%(table)s_text_md5 ON %(table)s (md5(text))")
+                 .execute_if(dialect="postgresql"))
+    event.listen(table, "after_create", DDL(
+            "CREATE INDEX ix_%(table)s_text ON %(table)s (text)")
+                 .execute_if(callable_=_not_postgresql))
+
 # imported from firehose-orm/orm.py:
 
 ############################################################################
@@ -37,17 +99,22 @@ from firehose.model import *
 
 t_analysis = \
     Table('analysis', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
-          Column('metadata_id', String,
+          Column('id', HashId, primary_key=True, autoincrement=False),
+          Column('metadata_id', HashId,
                  ForeignKey('metadata.id'), nullable=False),
-          Column('customfields_id', String,
+          Column('customfields_id', HashId,
                  ForeignKey('customfields.id')),
+          # position in the order of ingestion, and time of the ingestion
+          # (see firewoes.lib.feed)
+          Column('seq', BigInteger),
+          Column('ingested_at', Float),
           )
 Index('ix_analysis_metadata_id', t_analysis.c.metadata_id)
+Index('ix_analysis_seq', t_analysis.c.seq, unique=True)
 
 t_generator = \
     Table('generator', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
+          Column('id', HashId, primary_key=True, autoincrement=False),
           Column('name', String),
           Column('version', String), # optional in RNG
           )
@@ -55,19 +122,20 @@ Index('ix_generator_name_version', t_generator.c.name, t_generator.c.version)
 
 t_metadata = \
     Table('metadata', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
-          Column('generator_id', String,
+          Column('id', HashId, primary_key=True, autoincrement=False),
+          Column('generator_id', HashId,
                  ForeignKey('generator.id'), nullable=False),
-          Column('sut_id', String, ForeignKey('sut.id')),
-          Column('file_id', String, ForeignKey('file.id')),
-          Column('stats_id', String, ForeignKey('stats.id')),
+          Column('sut_id', HashId, ForeignKey('sut.id')),
+          Column('file_id', HashId, ForeignKey('file.id')),
+          Column('stats_id', HashId, ForeignKey('stats.id')),
           )
 Index('ix_metadata_generator_id', t_metadata.c.generator_id)
 Index('ix_metadata_sut_id', t_metadata.c.sut_id)
+Index('ix_metadata_file_id', t_metadata.c.file_id)
 
 t_stats = \
     Table('stats', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
+          Column('id', HashId, primary_key=True, autoincrement=False),
           Column('wallclocktime', Float, nullable=False),
           )
 Index('ix_metadata_wallclocktime', t_stats.c.wallclocktime)
@@ -75,7 +143,7 @@ Index('ix_metadata_wallclocktime', t_stats.c.wallclocktime)
 # For the Sut hierarchy we use joined-table inheritance
 t_sut = \
     Table('sut', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
+          Column('id', HashId, primary_key=True, autoincrement=False),
           Column('type', String(20), nullable=False),
           Column('name', String, nullable=False),
           Column('version', String, nullable=False),
@@ -101,24 +169,28 @@ Index('ix_sut_name_version_release_buildarch',
 
 t_result = \
     Table('result', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
+          Column('id', HashId, primary_key=True, autoincrement=False),
           Column('type', String(10), nullable=False),
-          Column('analysis_id', String,
+          Column('analysis_id', HashId,
                  ForeignKey('analysis.id'), nullable=False),
           Column('cwe', Integer),
           Column('testid', String),
           Column('severity', String),
-          Column('message_id', String,
+          Column('message_id', HashId,
                  ForeignKey('message.id')), # not nullable for 'issue' type
-          Column('notes_id', String, ForeignKey('notes.id')),
-          Column('location_id', String, ForeignKey('location.id')), #  idem
-          Column('trace_id', String, ForeignKey('trace.id')),
-          Column('customfields_id', String,
+          Column('notes_id', HashId, ForeignKey('notes.id')),
+          Column('location_id', HashId, ForeignKey('location.id')), #  idem
+          Column('trace_id', HashId, ForeignKey('trace.id')),
+          Column('customfields_id', HashId,
                  ForeignKey('customfields.id')),
           )
 Index('ix_result_testid', t_result.c.testid)
 Index('ix_result_message_id', t_result.c.message_id)
 Index('ix_result_location_id', t_result.c.location_id)
+# also serves the lookups by analysis_id alone
+Index('ix_result_analysis_id_id', t_result.c.analysis_id, t_result.c.id)
+# the "type" filter, and the "testid" one under it
+Index('ix_result_type_testid', t_result.c.type, t_result.c.testid)
 
 # t_failure = \
 #     Table('failure', metadata,
@@ -150,59 +222,71 @@ Index('ix_result_location_id', t_result.c.location_id)
 
 t_message = \
     Table('message', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
+          Column('id', HashId, primary_key=True, autoincrement=False),
           Column('text', String),
           )
-Index('ix_message_text', t_message.c.text)
+text_index(t_message)
 
 t_notes = \
     Table('notes', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
+          Column('id', HashId, primary_key=True, autoincrement=False),
           Column('text', String),
           )
-Index('ix_notes_text', t_notes.c.text)
+text_index(t_notes)
 
 t_trace = \
     Table('trace', metadata,
-          Column('id', String, primary_key=True, autoincrement=False)
+          Column('id', HashId, primary_key=True, autoincrement=False),
+          # the states, in order, instead of the state rows (see
+          # compact_traces())
+          Column('compact_states', Text),
           )
 
 t_state = \
     Table('state', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
-          Column('trace_id', String, ForeignKey('trace.id')),
-          Column('location_id', String,
+          Column('id', HashId, primary_key=True, autoincrement=False),
+          Column('trace_id', HashId, ForeignKey('trace.id')),
+          Column('location_id', HashId,
                  ForeignKey('location.id'), nullable=False),
-          Column('notes_id', String, ForeignKey('notes.id')),
+          Column('notes_id', HashId, ForeignKey('notes.id')),
           # annotation (key/value) pairs -> why not CustomFields here?
           )
 Index('ix_state_trace_id', t_state.c.trace_id)
 
 t_location = \
     Table('location', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
-          Column('file_id', String, ForeignKey('file.id'), nullable=False),
-          Column('function_id', String, ForeignKey('function.id')),
+          Column('id', HashId, primary_key=True, autoincrement=False),
+          Column('file_id', HashId, ForeignKey('file.id'), nullable=False),
+          Column('function_id', HashId, ForeignKey('function.id')),
           # either a point or a range:
-          Column('point_id', String, ForeignKey('point.id')),
-          Column('range_id', String, ForeignKey('range.id')),
+          Column('point_id', HashId, ForeignKey('point.id')),
+          Column('range_id', HashId, ForeignKey('range.id')),
+          # coordinates of the point, or of the start and the end of the
+          # range, so that they can be read without the joins (see
+          # location_coordinates())
+          Column('start_line', Integer),
+          Column('start_column', Integer),
+          Column('end_line', Integer),
+          Column('end_column', Integer),
           )
 Index('ix_location_file_id_function_id',
       t_location.c.file_id,
       t_location.c.function_id)
+Index('ix_location_point_id', t_location.c.point_id)
+Index('ix_location_range_id', t_location.c.range_id)
 
 t_file = \
     Table('file', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
+          Column('id', HashId, primary_key=True, autoincrement=False),
           Column('givenpath', String, nullable=False),
           Column('abspath', String),
-          Column('hash_id', String, ForeignKey('hash.id')),
+          Column('hash_id', HashId, ForeignKey('hash.id')),
           )
 Index('ix_file_givenpath', t_file.c.givenpath)
 
 t_hash = \
     Table('hash', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
+          Column('id', HashId, primary_key=True, autoincrement=False),
           Column('alg', String, nullable=False),
           Column('hexdigest', String, nullable=False),
           )
@@ -210,14 +294,14 @@ Index('ix_hash_hexdigest', t_hash.c.hexdigest)
 
 t_function = \
     Table('function', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
+          Column('id', HashId, primary_key=True, autoincrement=False),
           Column('name', String, nullable=False),
           )
 Index('ix_function_name', t_function.c.name)
 
 t_point = \
     Table('point', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
+          Column('id', HashId, primary_key=True, autoincrement=False),
           Column('line', Integer, nullable=False),
           Column('column', Integer, nullable=False),
           )
@@ -225,22 +309,22 @@ Index('ix_point_line_column', t_point.c.line, t_point.c.column)
 
 t_range = \
     Table('range', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
-          Column('start_id', String,
+          Column('id', HashId, primary_key=True, autoincrement=False),
+          Column('start_id', HashId,
                  ForeignKey('point.id'), nullable=False),
-          Column('end_id', String,
+          Column('end_id', HashId,
                  ForeignKey('point.id'), nullable=False),
           )
 Index('ix_range_start_id_end_id', t_range.c.start_id, t_range.c.end_id)
 
 t_customfields = \
     Table('customfields', metadata,
-          Column('id', String, primary_key=True, autoincrement=False))
+          Column('id', HashId, primary_key=True, autoincrement=False))
 
 t_intfield = \
     Table('intfield', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
-          Column('customfields_id', String,
+          Column('id', HashId, primary_key=True, autoincrement=False),
+          Column('customfields_id', HashId,
                  ForeignKey('customfields.id'), nullable=False),
           Column('name', String, nullable=False),
           Column('value', Integer, nullable=False),
@@ -249,14 +333,22 @@ Index('ix_intfield_name', t_intfield.c.name)
 
 t_strfield = \
     Table('strfield', metadata,
-          Column('id', String, primary_key=True, autoincrement=False),
-          Column('customfields_id', String,
+          Column('id', HashId, primary_key=True, autoincrement=False),
+          Column('customfields_id', HashId,
                  ForeignKey('customfields.id'), nullable=False),
           Column('name', String, nullable=False),
           Column('value', String, nullable=False),
           )
 Index('ix_strfield_name', t_strfield.c.name)
 
+# options of the schema of a db, which all its writers follow (see
+# stores_inline_locations())
+t_schema_option = \
+    Table('schema_option', metadata,
+          Column('name', String, primary_key=True, autoincrement=False),
+          Column('value', String, nullable=False),
+          )
+
 
 ############################################################################
 # Mappers
@@ -305,8 +397,9 @@ mapper(Notes, t_notes)
 
 mapper(Trace, t_trace,
        properties={
+        # only the traces stored before compact_states have state rows
         'states': relationship(
-            State, order_by=t_state.c.id, lazy='joined')
+            State, order_by=t_state.c.id, lazy='select')
         }
        )
 
@@ -390,3 +483,151 @@ mapper(Range, t_range,
        )
 
 mapper(CustomFields, t_customfields)
+
+
+############################################################################
+# Computed columns
+############################################################################
+
+def location_coordinates(location):
+    """
+    Returns the inline coordinates of a Location, a dict {column name: value}
+    """
+    if location.point is not None:
+        (start, end) = (location.point, location.point)
+    elif location.range_ is not None:
+        (start, end) = (location.range_.start, location.range_.end)
+    else:
+        # already inline (see inline_locations()), or none
+        return dict((key, getattr(location, key, None)) for key in
+                    ("start_line", "start_column", "end_line", "end_column"))
+    return dict(start_line=getattr(start, "line", None),
+                start_column=getattr(start, "column", None),
+                end_line=getattr(end, "line", None),
+                end_column=getattr(end, "column", None))
+
+# columns whose values are computed from the other attributes of the
+# objects of a class when they're inserted: {class: function(object)
+# returning a dict {column name: value}}
+computed_columns = {
+    Location: location_coordinates,
+    }
+
+def _set_computed_columns(mapper, connection, target):
+    for (key, value) in computed_columns[mapper.class_](target).items():
+        setattr(target, key, value)
+
+for cls in computed_columns:
+    event.listen(cls, "before_insert", _set_computed_columns)
+
+def stores_inline_locations(connection):
+    """
+    True if the db of connection stores the coordinates of the locations
+    inline only, without point nor range rows (see inline_locations())
+    """
+    t = t_schema_option
+    if not connection.dialect.has_table(connection, t.name):
+        return False
+    return connection.execute(select([t.c.value])
+                              .where(t.c.name == "locations")).scalar() \
+        == "inline"
+
+def store_inline_locations(connection):
+    """
+    Makes the db of connection store the coordinates of the locations
+    inline only, from now on
+    """
+    t = t_schema_option
+    t.create(bind=connection, checkfirst=True)
+    if not connection.execute(t.update().where(t.c.name == "locations")
+                              .values(value="inline")).rowcount:
+        connection.execute(t.insert().values(name="locations",
+                                             value="inline"))
+
+def inline_locations(results):
+    """
+    Stores the coordinates of the locations of a list of idified results
+    inline, and detaches the locations from their point or range, which
+    then aren't stored as rows. The ids are left as they are.
+    """
+    for result in results:
+        location = getattr(result, "location", None)
+        if location is None or (location.point is None
+                                and location.range_ is None):
+            continue
+        for (key, value) in location_coordinates(location).items():
+            setattr(location, key, value)
+        location.point = None
+        location.range_ = None
+
+
+############################################################################
+# Compact traces
+############################################################################
+
+def encode_states(states):
+    """
+    Returns the compact form of a list of States: their JSON form (see
+    firehose.model), in order
+    """
+    return json.dumps([state.to_json() for state in states],
+                      sort_keys=True, separators=(",", ":"))
+
+def _set_foreign_keys(obj):
+    """
+    Sets the foreign keys of an idified tree of objects from its many-to-one
+    relationships, as they are when the objects are loaded
+    """
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        for prop in object_mapper(obj).iterate_properties:
+            if not (isinstance(prop, RelationshipProperty)
+                    and prop.direction is MANYTOONE):
+                continue
+            value = getattr(obj, prop.key)
+            if value is not None:
+                for (local, remote) in prop.local_remote_pairs:
+                    setattr(obj, local.key, getattr(value, remote.key))
+                stack.append(value)
+
+def decode_states(value, trace_id=None):
+    """
+    Returns the list of States of a value given by encode_states(), as if
+    they were loaded from rows: with their ids (the same content hashes),
+    their foreign keys, trace_id, and the inline coordinates of their
+    locations
+    """
+    # firewoes.lib.hash imports this module
+    from firewoes.lib.hash import idify
+    states = [State.from_json(jsonobj) for jsonobj in
+              json.loads(value, object_hook=_native_strings)]
+    memo = dict()
+    for state in states:
+        idify(state, memo=memo)
+        _set_foreign_keys(state)
+        state.trace_id = trace_id
+        for (key, coordinate) in \
+                location_coordinates(state.location).items():
+            setattr(state.location, key, coordinate)
+    return states
+
+def compact_traces(results):
+    """
+    Moves the states of the traces of a list of idified results to
+    trace.compact_states: a trace is then stored in one row, and its
+    states, with their locations and notes, aren't stored as rows.
+    The ids are left as they are.
+    """
+    for result in results:
+        trace = getattr(result, "trace", None)
+        if trace is not None and trace.compact_states is None:
+            trace.compact_states = encode_states(trace.states)
+            trace.states = []
+
+def _load_compact_states(trace, context):
+    if trace.compact_states is not None:
+        set_committed_value(trace, "states",
+                            decode_states(trace.compact_states, trace.id))
+
+event.listen(Trace, "load", _load_compact_states)
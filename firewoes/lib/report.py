@@ -0,0 +1,107 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Measures of an ingestion run: where the time goes, and how many of the
+objects of the analyses were already in the db.
+"""
+
+import time
+from contextlib import contextmanager
+
+
+# in the order of the ingestion of a file
+stages = ["parse", "idify", "uniquify", "flush", "commit"]
+
+
+class IngestionStats(object):
+    def __init__(self):
+        self.start = time.time()
+        self.elapsed = None
+        self.times = dict((stage, 0.) for stage in stages)
+        # table name -> [new rows, existing rows]
+        self.objects = dict()
+        self.files = 0
+        self.failed = 0
+        self.skipped = 0
+        self.results = 0
+
+    @contextmanager
+    def stage(self, name):
+        """
+        with stats.stage("parse"): adds the wall time of the block to the
+        stage
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.) + time.time() - start
+
+    def add_times(self, times):
+        """
+        Adds a dict {stage: seconds}, e.g. measured in another process
+        """
+        for (name, seconds) in times.items():
+            self.times[name] = self.times.get(name, 0.) + seconds
+
+    def add_objects(self, table_name, new=0, existing=0):
+        counts = self.objects.setdefault(table_name, [0, 0])
+        counts[0] += new
+        counts[1] += existing
+
+    def stop(self):
+        self.elapsed = time.time() - self.start
+
+    def as_dict(self):
+        elapsed = self.elapsed
+        if elapsed is None:
+            elapsed = time.time() - self.start
+        return dict(seconds=elapsed,
+                    files=self.files,
+                    failed=self.failed,
+                    skipped=self.skipped,
+                    results=self.results,
+                    stages=dict(self.times),
+                    objects=dict((table_name, dict(new=new, existing=existing))
+                                 for (table_name, (new, existing))
+                                 in self.objects.items()))
+
+    def summary(self):
+        """
+        Returns a human-readable report of the run
+        """
+        stats = self.as_dict()
+        lines = ["%d files (%d failed, %d skipped), %d results in %.1f s"
+                 % (self.files, self.failed, self.skipped, self.results,
+                    stats["seconds"])]
+        names = stages + sorted(set(self.times) - set(stages))
+        for name in names:
+            seconds = self.times.get(name, 0.)
+            lines.append("  %-10s %8.2f s %5.1f %%"
+                         % (name, seconds, 100 * seconds / stats["seconds"]
+                            if stats["seconds"] else 0))
+        if self.objects:
+            lines.append("  %-16s %9s %9s %7s" % ("table", "new", "existing",
+                                                  "dedupe"))
+            for (table_name, (new, existing)) in sorted(self.objects.items()):
+                lines.append("  %-16s %9d %9d %6.1f %%"
+                             % (table_name, new, existing,
+                                100. * existing / (new + existing)
+                                if new + existing else 0))
+        return "\n".join(lines)
@@ -0,0 +1,112 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Flat table of the results with the values of all the search filters
+(result_search), so that the searches and their drill-down menus don't
+need to join the 7 tables those values come from.
+
+The table is only derived from the others: it's filled when analyses are
+inserted, and can be rebuilt at any time (firewoes_db.py URL
+rebuild-search). Its columns are named after the arguments of /search/.
+"""
+
+from sqlalchemy import Table, Column, String, Integer, ForeignKey, Index, \
+    select, exists, and_
+
+from firewoes.lib.orm import metadata, HashId, t_result, t_analysis, \
+    t_metadata, t_generator, t_sut, t_location, t_file, t_function
+
+
+t_result_search = \
+    Table('result_search', metadata,
+          Column('result_id', HashId, ForeignKey('result.id'),
+                 primary_key=True, autoincrement=False),
+          Column('analysis_id', HashId, nullable=False),
+          Column('type', String(10), nullable=False),
+          Column('testid', String),
+          Column('generator_name', String),
+          Column('generator_version', String),
+          Column('sut_type', String(20)),
+          Column('sut_name', String),
+          Column('sut_version', String),
+          Column('sut_release', String),
+          Column('sut_buildarch', String),
+          Column('location_file', String),
+          Column('location_function', String),
+          # line of the point, or of the start of the range
+          Column('location_line', Integer),
+          )
+Index('ix_result_search_analysis_id', t_result_search.c.analysis_id)
+Index('ix_result_search_sut_name_version', t_result_search.c.sut_name,
+      t_result_search.c.sut_version)
+Index('ix_result_search_generator_name_testid',
+      t_result_search.c.generator_name, t_result_search.c.testid)
+Index('ix_result_search_location_file', t_result_search.c.location_file)
+
+
+def _select_rows(condition=None):
+    """
+    Returns a select of the rows of result_search of the results matching
+    condition (all of them if None), in the order of its columns
+    """
+    query = select([
+            t_result.c.id, t_result.c.analysis_id, t_result.c.type,
+            t_result.c.testid,
+            t_generator.c.name, t_generator.c.version,
+            t_sut.c.type, t_sut.c.name, t_sut.c.version, t_sut.c.release,
+            t_sut.c.buildarch,
+            t_file.c.givenpath, t_function.c.name,
+            t_location.c.start_line,
+            ]).select_from(
+        t_result.join(t_analysis).join(t_metadata).join(t_generator)
+        .outerjoin(t_sut)
+        .outerjoin(t_location).outerjoin(t_file).outerjoin(t_function))
+    if condition is not None:
+        query = query.where(condition)
+    return query
+
+def _insert(connection, condition=None):
+    t = t_result_search
+    return connection.execute(t.insert().from_select(
+            [column.name for column in t.c],
+            _select_rows(condition))).rowcount
+
+def index_analyses(connection, analysis_ids, chunk_size=500):
+    """
+    Adds the results of the analyses of analysis_ids to result_search, in
+    the current transaction of connection (those already there are left
+    as they are).
+    Returns the number of results added.
+    """
+    ids = sorted(set(analysis_ids))
+    count = 0
+    for i in range(0, len(ids), chunk_size):
+        count += _insert(connection, and_(
+                t_result.c.analysis_id.in_(ids[i:i + chunk_size]),
+                ~exists().where(t_result_search.c.result_id == t_result.c.id)))
+    return count
+
+def rebuild(connection):
+    """
+    Refills result_search from scratch, in the current transaction of
+    connection.
+    Returns the number of results.
+    """
+    connection.execute(t_result_search.delete())
+    return _insert(connection)
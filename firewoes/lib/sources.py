@@ -0,0 +1,245 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Inputs of the ingestion: plain or compressed (gzip, bzip2, xz) XML or JSON
+files, tar archives of such files, and the standard input ("-").
+
+The compression is detected from the content, and decompressed on the fly;
+the members of the archives are read one at a time, without extracting
+them to the disk.
+"""
+
+import sys
+import bz2
+import json
+import zlib
+import tarfile
+from cStringIO import StringIO
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+_magics = [("\x1f\x8b", "gzip"),
+           ("BZh", "bzip2"),
+           ("\xfd7zXZ\x00", "xz")]
+
+def _decompressor(compression):
+    if compression == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == "bzip2":
+        return bz2.BZ2Decompressor()
+    elif lzma is None:
+        raise IOError("reading xz files needs the lzma module "
+                      "(backports.lzma with Python 2)")
+    return lzma.LZMADecompressor()
+
+class _Stream(object):
+    """
+    Read-only file object over fileobj, which is decompressed by
+    decompressor if given
+    """
+    def __init__(self, fileobj, prefix="", decompressor=None,
+                 block_size=1 << 16):
+        self.fileobj = fileobj
+        self.decompressor = decompressor
+        self.block_size = block_size
+        self.buffer = ""
+        self.position = 0
+        # data read after buffer, joined to it only when it's needed (so
+        # that reading the whole stream is linear)
+        self.chunks = []
+        self.available = 0
+        self.eof = False
+        self._append(prefix)
+
+    def _append(self, data):
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        if data:
+            self.chunks.append(data)
+            self.available += len(data)
+
+    def _fill(self, size):
+        while not self.eof and (size < 0 or self.available < size):
+            data = self.fileobj.read(self.block_size)
+            if data:
+                self._append(data)
+            else:
+                self.eof = True
+                if hasattr(self.decompressor, "flush"):
+                    data = self.decompressor.flush()
+                    if data:
+                        self.chunks.append(data)
+                        self.available += len(data)
+        if self.chunks:
+            self.chunks.insert(0, self.buffer[self.position:])
+            self.buffer = "".join(self.chunks)
+            self.position = 0
+            self.chunks = []
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            end = len(self.buffer)
+        else:
+            end = self.position + size
+        data = self.buffer[self.position:end]
+        self.position += len(data)
+        self.available -= len(data)
+        return data
+
+    def peek(self, size):
+        """
+        Returns the next size bytes, without consuming them
+        """
+        self._fill(size)
+        return self.buffer[self.position:self.position + size]
+
+    def close(self):
+        if self.fileobj is not sys.stdin:
+            self.fileobj.close()
+
+def _open_stream(fileobj):
+    """
+    Returns a _Stream over fileobj, decompressed if it starts with the
+    magic bytes of a supported compression
+    """
+    prefix = fileobj.read(6)
+    for (magic, compression) in _magics:
+        if prefix.startswith(magic):
+            return _Stream(fileobj, prefix, _decompressor(compression))
+    return _Stream(fileobj, prefix)
+
+def open_input(path):
+    """
+    Opens the file at path ("-" for stdin), decompressing it if needed
+    """
+    if path == "-":
+        return _open_stream(sys.stdin)
+    return _open_stream(open(path, "rb"))
+
+class Member(object):
+    """
+    An XML document read from an archive or from stdin, whose (possibly
+    compressed) content is kept in memory until it is ingested
+    """
+    def __init__(self, name, data, mtime=None):
+        self.name = name
+        self.data = data
+        self.mtime = mtime
+
+    def __str__(self):
+        return self.name
+
+def open_xml(xml_file):
+    """
+    Returns a file object of the XML document xml_file, which is either the
+    path of a (possibly compressed) file, or a Member
+    """
+    if isinstance(xml_file, Member):
+        return _open_stream(StringIO(xml_file.data))
+    return open_input(xml_file)
+
+def is_empty(xml_file, block_size=1 << 16):
+    """
+    True if the document xml_file (see open_xml()) has no content but
+    whitespace
+    """
+    fileobj = open_xml(xml_file)
+    try:
+        for block in iter(lambda: fileobj.read(block_size), ""):
+            if block.strip():
+                return False
+        return True
+    finally:
+        fileobj.close()
+
+def detect_format(stream):
+    """
+    Returns "json" if the document of stream (as returned by open_xml())
+    is in the JSON form of Firehose, "xml" otherwise
+    """
+    for size in (64, 4096):
+        start = stream.peek(size).lstrip()
+        if start:
+            break
+    return "json" if start.startswith("{") else "xml"
+
+def _native_strings(jsonobj):
+    # ElementTree gives str for ASCII text with Python 2, and the ids given
+    # by idify() depend on it
+    for (key, value) in jsonobj.items():
+        if isinstance(value, unicode):
+            try:
+                jsonobj[key] = value.encode("ascii")
+            except UnicodeEncodeError:
+                pass
+    return jsonobj
+
+def load_json(fileobj):
+    """
+    Returns the JSON document of fileobj, with the same types of strings
+    as the XML parser
+    """
+    return json.load(fileobj, object_hook=_native_strings)
+
+def _is_tar(stream):
+    header = stream.peek(512)
+    return len(header) == 512 and header[257:262] == "ustar"
+
+def _iter_tar(path, stream):
+    archive = tarfile.open(fileobj=stream, mode="r|")
+    for info in archive:
+        if info.isfile():
+            yield Member("%s:%s" % (path, info.name),
+                         archive.extractfile(info).read(), info.mtime)
+        # the headers of the members already read aren't kept
+        archive.members = []
+
+def iter_inputs(paths):
+    """
+    Yields tuples (index, xml_file) for the XML documents found in paths,
+    where index is the position of the path they come from: xml_file is
+    the path itself for a (possibly compressed) file, or a Member for the
+    files of a tar archive and for stdin.
+    """
+    for (index, path) in enumerate(paths):
+        try:
+            stream = open_input(path)
+            is_tar = _is_tar(stream)
+        except (IOError, OSError, EOFError, zlib.error):
+            # the error will be reported while parsing
+            yield (index, path)
+            continue
+        try:
+            if is_tar:
+                for member in _iter_tar(path, stream):
+                    yield (index, member)
+            elif path == "-":
+                yield (index, Member("-", stream.read()))
+            else:
+                yield (index, path)
+        finally:
+            stream.close()
@@ -0,0 +1,139 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Spool directory of the files waiting to be ingested by
+firewoes_fill_db.py --spool.
+
+The files are written under a name starting with "." and renamed once
+complete; the daemon moves them to the done/ subdirectory once ingested,
+or to failed/ along with a .error file.
+"""
+
+import os
+import re
+import time
+import uuid
+import zlib
+
+
+DONE = "done"
+FAILED = "failed"
+
+_ticket_re = re.compile(r"^[0-9a-f]{32}$")
+
+
+def spooled_files(spool_dir, settle=0):
+    """
+    Returns the paths of the files of spool_dir, the oldest first. Those
+    whose name starts with "." are considered as still being written, as
+    well as those modified less than settle seconds ago.
+    """
+    paths = []
+    newest = time.time() - settle
+    for name in os.listdir(spool_dir):
+        path = os.path.join(spool_dir, name)
+        if not name.startswith(".") and os.path.isfile(path):
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue # removed meanwhile
+            if mtime <= newest:
+                paths.append((mtime, path))
+    return [path for (mtime, path) in sorted(paths)]
+
+def finish(spool_dir, path, errors=None):
+    """
+    Moves the spooled file path to done/, or to failed/ if there are errors
+    (a list of messages, written to a .error file)
+    """
+    name = os.path.basename(path)
+    if not errors:
+        os.rename(path, os.path.join(spool_dir, DONE, name))
+        return
+    with open(os.path.join(spool_dir, FAILED, name + ".error"), "w") as f:
+        f.write("\n".join(errors) + "\n")
+    os.rename(path, os.path.join(spool_dir, FAILED, name))
+
+def make_dirs(spool_dir):
+    for directory in (spool_dir, os.path.join(spool_dir, DONE),
+                      os.path.join(spool_dir, FAILED)):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+def _looks_like_xml(block, compressed):
+    if compressed:
+        block = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(block)
+    return block.lstrip().startswith(b"<")
+
+def submit(spool_dir, stream, max_size=None, block_size=1 << 16):
+    """
+    Writes the content of the file object stream, an XML document which
+    can be gzip-compressed, into spool_dir, durably and atomically.
+    Returns the ticket of the file. Raises ValueError if it's empty,
+    doesn't look like XML, or is bigger than max_size bytes, in which case
+    nothing is written.
+    """
+    block = stream.read(block_size)
+    compressed = block.startswith(b"\x1f\x8b")
+    try:
+        if not _looks_like_xml(block, compressed):
+            raise ValueError("not an XML document")
+    except zlib.error:
+        raise ValueError("invalid gzip data")
+    ticket = uuid.uuid4().hex
+    name = ticket + (".xml.gz" if compressed else ".xml")
+    tmp_path = os.path.join(spool_dir, "." + name)
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            while block:
+                size += len(block)
+                if max_size is not None and size > max_size:
+                    raise ValueError("bigger than %d bytes" % max_size)
+                f.write(block)
+                block = stream.read(block_size)
+            f.flush()
+            os.fsync(f.fileno())
+    except:
+        os.remove(tmp_path)
+        raise
+    os.rename(tmp_path, os.path.join(spool_dir, name))
+    return ticket
+
+def ticket_status(spool_dir, ticket):
+    """
+    Returns a tuple (status, error) of the file of ticket: status is one
+    of "pending", "done", "failed", or None if there's no such file.
+    """
+    if not _ticket_re.match(ticket):
+        return (None, None)
+    for suffix in (".xml", ".xml.gz"):
+        name = ticket + suffix
+        if os.path.exists(os.path.join(spool_dir, name)):
+            return ("pending", None)
+        if os.path.exists(os.path.join(spool_dir, DONE, name)):
+            return ("done", None)
+        failed = os.path.join(spool_dir, FAILED, name)
+        if os.path.exists(failed):
+            try:
+                with open(failed + ".error") as f:
+                    return ("failed", f.read().strip())
+            except IOError:
+                return ("failed", None)
+    return (None, None)
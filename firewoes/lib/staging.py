@@ -0,0 +1,167 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+COPY-based loading of idified analyses into PostgreSQL, for full rebuilds.
+
+The rows of many analyses are serialized into one tab-separated stream per
+table, COPYed into unlogged staging tables, and merged into the real tables
+with one de-duplicating INSERT ... SELECT per table.
+"""
+
+from cStringIO import StringIO
+
+from firewoes.lib.orm import metadata, HashId
+from firewoes.lib.bulk import analysis_rows
+
+
+def _escape(value):
+    """
+    Returns value in the text format of COPY
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, float):
+        value = repr(value)
+    elif isinstance(value, unicode):
+        value = value.encode("utf-8")
+    else:
+        value = str(value)
+    return (value.replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+def _bytea(value):
+    """
+    Returns the bytea literal of an id, for the dbs which store them as
+    raw bytes (see HashId)
+    """
+    if value is None:
+        return None
+    return "\\x" + value
+
+def tsv(table, rows, binary_ids=False):
+    """
+    Serializes rows (dicts column name -> value) of table into a
+    tab-separated string, with the columns in the order of table.c
+    """
+    columns = [(column.name,
+                _bytea if binary_ids and isinstance(column.type, HashId)
+                else None)
+               for column in table.c]
+    return "".join("\t".join(_escape(convert(row[name]) if convert
+                                     else row[name])
+                             for (name, convert) in columns) + "\n"
+                   for row in rows)
+
+def _columns(table):
+    return ", ".join('"%s"' % column.name for column in table.c)
+
+def staging_name(table):
+    return "staging_" + table.name
+
+class StagingLoader(object):
+    """
+    Accumulates the rows of analyses, and loads them into a PostgreSQL db.
+    The connections given to its methods are SQLAlchemy connections, whose
+    transactions are left to the caller.
+    """
+    def __init__(self):
+        self.tables = [table for table in metadata.sorted_tables
+                       if "id" in table.c]
+        self.rows = dict()
+        self.results = 0
+        # table name -> number of rows actually inserted by the last load()
+        self.inserted = dict()
+        self._created = False
+
+    def add(self, analysis):
+        """
+        Adds the rows of an idified Analysis to the next load()
+        """
+        analysis_rows(analysis, self.rows)
+        self.results += len(analysis.results)
+
+    def create(self, connection):
+        """
+        Creates the staging tables, which are unlogged: they are only
+        written once, and emptied after each merge
+        """
+        for table in self.tables:
+            connection.execute(
+                'CREATE UNLOGGED TABLE IF NOT EXISTS "%s" (LIKE "%s")'
+                % (staging_name(table), table.name))
+        self._created = True
+
+    def drop(self, connection):
+        for table in self.tables:
+            connection.execute('DROP TABLE IF EXISTS "%s"'
+                                    % staging_name(table))
+        self._created = False
+
+    def load(self, connection):
+        """
+        COPYs the added rows into the staging tables, then merges them into
+        the real tables, in the order of the foreign keys dependencies.
+        The added rows are discarded, even if the load fails.
+        Returns the number of results loaded.
+        """
+        self.inserted = dict()
+        try:
+            if not self._created:
+                self.create(connection)
+            self._copy(connection)
+            self._merge(connection)
+        except:
+            # the staging tables may have been created in the transaction
+            # which will be rolled back
+            self._created = False
+            raise
+        finally:
+            results = self.results
+            self.rows = dict()
+            self.results = 0
+        return results
+
+    def _copy(self, connection):
+        cursor = connection.connection.cursor()
+        try:
+            for table in self.tables:
+                table_rows = self.rows.get(table)
+                if table_rows:
+                    cursor.copy_expert(
+                        'COPY "%s" (%s) FROM STDIN'
+                        % (staging_name(table), _columns(table)),
+                        StringIO(tsv(table, table_rows.values(), getattr(
+                                    connection.dialect, "binary_ids",
+                                    False))))
+        finally:
+            cursor.close()
+
+    def _merge(self, connection):
+        for table in self.tables:
+            if self.rows.get(table):
+                columns = _columns(table)
+                result = connection.execute(
+                    'INSERT INTO "%s" (%s) SELECT DISTINCT ON (id) %s '
+                    'FROM "%s" ON CONFLICT DO NOTHING'
+                    % (table.name, columns, columns, staging_name(table)))
+                self.inserted[table.name] = (
+                    self.inserted.get(table.name, 0) + result.rowcount)
+        connection.execute(
+            "TRUNCATE %s" % ", ".join('"%s"' % staging_name(table)
+                                      for table in self.tables))
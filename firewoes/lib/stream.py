@@ -0,0 +1,130 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Incremental parsing of Firehose XML files, for analyses too large to be
+loaded at once with Analysis.from_xml().
+"""
+
+from xml.etree.ElementTree import iterparse
+
+from firehose.model import Metadata, Issue, Failure, Info, CustomFields
+
+from firewoes.lib.hash import idify, strhash
+from firewoes.lib.sources import open_xml
+
+
+# same dispatch as Analysis.from_xml()
+result_classes = dict(issue=Issue, failure=Failure, info=Info)
+
+# the memo of the hashes shared by the results of a file is emptied once it
+# holds more entries, so that it doesn't grow with the file
+memo_size = 10000
+
+def iter_analysis(xml_file):
+    """
+    Parses a Firehose XML file (a path or a Member, see
+    firewoes.lib.sources) incrementally, and yields tuples (kind, object)
+    in the order of the file, where kind is one of "metadata", "result"
+    and "customfields".
+    Each result is freed once it has been yielded.
+    """
+    fileobj = open_xml(xml_file)
+    try:
+        for item in _iter_analysis(fileobj):
+            yield item
+    finally:
+        fileobj.close()
+
+def _iter_analysis(fileobj):
+    depth = 0
+    results_node = None
+    for (event, node) in iterparse(fileobj, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 2 and node.tag == "results":
+                results_node = node
+            continue
+
+        depth -= 1
+        if depth == 1:
+            if node.tag == "metadata":
+                yield ("metadata", Metadata.from_xml(node))
+            elif node.tag == "custom-fields":
+                yield ("customfields", CustomFields.from_xml(node))
+        elif depth == 2 and results_node is not None:
+            if node.tag in result_classes:
+                yield ("result", result_classes[node.tag].from_xml(node))
+            # we don't keep the already parsed results
+            results_node.remove(node)
+
+def analysis_hash(metadata_hash, results_hashes, customfields_hash):
+    """
+    Returns the id idify() would give to an Analysis, from the ids of its
+    attributes (see the concatenation in idify())
+    """
+    return strhash("metadata " + metadata_hash + " "
+                   + "".join("results " + result_hash + " "
+                             for result_hash in results_hashes)
+                   + "customfields " + customfields_hash + " ")
+
+def idify_streaming(xml_file):
+    """
+    First pass on a Firehose XML file: computes the id of its Analysis
+    without keeping its results in memory.
+    Returns a tuple (idified metadata, idified customfields, analysis id,
+    number of results).
+    """
+    metadata = None
+    memo = dict()
+    (customfields, customfields_hash) = idify(None)
+    results_hashes = []
+    for (kind, obj) in iter_analysis(xml_file):
+        if kind == "metadata":
+            (metadata, metadata_hash) = idify(obj, memo=memo)
+        elif kind == "customfields":
+            (customfields, customfields_hash) = idify(obj, memo=memo)
+        else:
+            results_hashes.append(idify(obj, memo=memo)[1])
+            if len(memo) > memo_size:
+                memo.clear()
+
+    if metadata is None:
+        raise ValueError("no metadata in %s" % xml_file)
+
+    return (metadata, customfields,
+            analysis_hash(metadata_hash, results_hashes, customfields_hash),
+            len(results_hashes))
+
+def iter_idified_results(xml_file, chunk_size):
+    """
+    Second pass on a Firehose XML file: yields lists of at most chunk_size
+    idified results
+    """
+    chunk = []
+    memo = dict()
+    for (kind, obj) in iter_analysis(xml_file):
+        if kind == "result":
+            chunk.append(idify(obj, memo=memo)[0])
+            if len(memo) > memo_size:
+                memo.clear()
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
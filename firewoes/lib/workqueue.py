@@ -0,0 +1,181 @@
+# Copyright (C) 2014  Clement Schreiner <clement@mux.me>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Queue of the input files to ingest, shared through the db by workers
+running on several hosts (the paths must be readable by all of them, e.g.
+on a shared filesystem).
+
+A worker claims a few pending files at a time; on PostgreSQL, the rows
+are locked with SELECT ... FOR UPDATE SKIP LOCKED, so that concurrent
+workers claim different files without waiting for each other.
+"""
+
+import os
+import time
+import socket
+
+from sqlalchemy import Table, Column, String, Float, Text, Index, select, \
+    text, func, and_, or_
+from sqlalchemy.exc import DBAPIError, OperationalError, InterfaceError
+
+from firewoes.lib.orm import metadata
+from firewoes.lib.bulk import InsertIgnore
+
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+t_ingest_queue = \
+    Table('ingest_queue', metadata,
+          Column('path', String, primary_key=True, autoincrement=False),
+          Column('status', String, nullable=False),
+          Column('worker', String),
+          Column('claimed_at', Float),
+          Column('finished_at', Float),
+          Column('error', Text),
+          )
+Index('ix_ingest_queue_status', t_ingest_queue.c.status)
+
+_claim_postgresql = text("""
+UPDATE ingest_queue SET status = :claimed, worker = :worker,
+                        claimed_at = :now
+WHERE path IN (SELECT path FROM ingest_queue WHERE status = :pending
+               ORDER BY path LIMIT :limit FOR UPDATE SKIP LOCKED)
+RETURNING path""")
+
+
+def default_worker_name():
+    return "%s-%d" % (socket.gethostname(), os.getpid())
+
+def is_transient(error):
+    """
+    True if error is a DBAPIError after which the transaction can be
+    retried: deadlock or serialization failure (PostgreSQL), or locked
+    database (sqlite)
+    """
+    if not isinstance(error, DBAPIError):
+        return False
+    if getattr(error.orig, "pgcode", None) in ("40P01", "40001"):
+        return True
+    return "database is locked" in str(error.orig)
+
+def is_operational(error):
+    """
+    True if error is a DBAPIError which doesn't come from the data being
+    written: the connection to the db was lost or couldn't be opened, or
+    the db can't be used for now
+    """
+    return isinstance(error, DBAPIError) and (
+        error.connection_invalidated
+        or isinstance(error, (OperationalError, InterfaceError)))
+
+class WorkQueue(object):
+    def __init__(self, engine, worker=None):
+        """
+        The queue of the db of engine, as seen by the worker named worker
+        (default: hostname-pid)
+        """
+        self.engine = engine
+        self.worker = worker or default_worker_name()
+        t_ingest_queue.create(bind=engine, checkfirst=True)
+
+    def enqueue(self, paths):
+        """
+        Adds paths to the queue, those already queued being left as they are.
+        Returns the number of paths added.
+        """
+        count = 0
+        with self.engine.begin() as connection:
+            for i in range(0, len(paths), 1000):
+                result = connection.execute(
+                    InsertIgnore(t_ingest_queue).values(
+                        [dict(path=path, status=PENDING)
+                         for path in paths[i:i + 1000]]))
+                count += result.rowcount
+        return count
+
+    def claim(self, limit=10):
+        """
+        Marks up to limit pending paths as claimed by this worker, and
+        returns them
+        """
+        now = time.time()
+        with self.engine.begin() as connection:
+            if self.engine.dialect.name == "postgresql":
+                return sorted(row.path for row in connection.execute(
+                        _claim_postgresql, claimed=CLAIMED,
+                        worker=self.worker, now=now, pending=PENDING,
+                        limit=limit))
+            # the other dbs lock the whole table for the update anyway
+            t = t_ingest_queue
+            pending = select([t.c.path]).where(t.c.status == PENDING) \
+                .order_by(t.c.path).limit(limit)
+            connection.execute(t.update().where(t.c.path.in_(pending))
+                               .values(status=CLAIMED, worker=self.worker,
+                                       claimed_at=now))
+            return [row.path for row in connection.execute(
+                    select([t.c.path]).where(and_(
+                            t.c.status == CLAIMED,
+                            t.c.worker == self.worker,
+                            t.c.claimed_at == now)).order_by(t.c.path))]
+
+    def finish(self, path, error=None):
+        """
+        Marks path as done, or as failed with the message error
+        """
+        t = t_ingest_queue
+        with self.engine.begin() as connection:
+            connection.execute(
+                t.update().where(t.c.path == path).values(
+                    status=DONE if error is None else FAILED,
+                    finished_at=time.time(), error=error))
+
+    def requeue(self, older_than=None, failed=False):
+        """
+        Puts back into the queue the paths claimed more than older_than
+        seconds ago (by workers which presumably died), and the failed
+        ones if failed is True.
+        Returns the number of paths requeued.
+        """
+        t = t_ingest_queue
+        conditions = []
+        if older_than is not None:
+            conditions.append(and_(t.c.status == CLAIMED,
+                                   t.c.claimed_at < time.time() - older_than))
+        if failed:
+            conditions.append(t.c.status == FAILED)
+        if not conditions:
+            return 0
+        with self.engine.begin() as connection:
+            return connection.execute(
+                t.update().where(or_(*conditions))
+                .values(status=PENDING, worker=None, claimed_at=None,
+                        error=None)).rowcount
+
+    def counts(self):
+        """
+        Returns a dict {status: number of paths}
+        """
+        t = t_ingest_queue
+        with self.engine.connect() as connection:
+            return dict(connection.execute(
+                    select([t.c.status, func.count()]).group_by(t.c.status))
+                        .fetchall())
@@ -23,6 +23,7 @@ from firewoes.lib.orm import Analysis, Issue, Failure, Info, Result, \
     Generator, Sut, Metadata, Message, Location, File, Point, Range, Function
 from firewoes.lib.debianutils import DebianPackagePeopleMapping, \
     emails_for_person
+from firewoes.lib.search import t_result_search
 
 from sqlalchemy import func, desc, and_
 
@@ -32,11 +33,13 @@ class Menu(object):
     It permits to obtain a drill-down menu, as long as an SQLAlchemy
     filter to query the results.
     """
-    def __init__(self, active_filters_dict):
+    def __init__(self, active_filters_dict, flat=False):
         """
         Creates a menu.
         The active_filters_dict contains the already activated filters,
         in the form name=value, e.g. generator_name="coccinelle".
+        If flat is True, the filters query the result_search table instead
+        of the Firehose tables.
         """
         self.filters = []
         self.clauses = []
@@ -53,16 +56,20 @@ class Menu(object):
                 new_filter = filter_[1](
                     value=self.active_filters_dict[filter_[0]],
                     active=True,
-                    name=filter_[0])
+                    name=filter_[0],
+                    flat=flat)
             
             else: # it's an inactive one
-                new_filter = filter_[1](active=False, name=filter_[0])
+                new_filter = filter_[1](active=False, name=filter_[0],
+                                        flat=flat)
             # avoids adding non-relevant filters regarding the context:
             if new_filter.is_relevant(
                 active_keys=self.active_filters_dict.keys()):
                 
                 self.filters.append(new_filter)
-                if new_filter.is_active():
+                if new_filter.is_active() and flat:
+                    self.clauses += new_filter.get_search_clauses()
+                elif new_filter.is_active():
                     self.clauses += new_filter.get_clauses()
             else:
                 # if there was an irrelevant filter in active_filters_dict,
@@ -99,10 +106,11 @@ class Menu(object):
 class Filter(object):
     _cool_name = None
     
-    def __init__(self, value=None, active=False, name=None):
+    def __init__(self, value=None, active=False, name=None, flat=False):
         """
         Creates a new filter.
         value is its value in case active=True
+        flat: whether to query the result_search table
         """
         self.value = value
         self.active = active
@@ -110,6 +118,7 @@ class Filter(object):
             self.items = []
             self.is_sliced = False # sliced if max_items > number of items
         self.name = name
+        self.flat = flat
     
     def get_clauses(self):
         """
@@ -123,6 +132,18 @@ class Filter(object):
         """
         raise NotImplementedError
     
+    def get_search_clauses(self):
+        """
+        Returns the SQLAlchemy clauses for this filter, on result_search.
+        """
+        raise NotImplementedError
+    
+    def get_search_items(self, session, clauses=None, max_items=None):
+        """
+        Returns the subitems of the menu, from result_search.
+        """
+        raise NotImplementedError
+    
     def get(self, session, active_filters_dict, clauses=None, max_items=None):
         """
         Returns the filter with its attributes.
@@ -131,8 +152,9 @@ class Filter(object):
                    name=self._cool_name or self.name)
         
         if not self.active:
-            res["items"] = self.get_items(session, clauses=clauses,
-                                          max_items=max_items)
+            get_items = self.get_search_items if self.flat else self.get_items
+            res["items"] = get_items(session, clauses=clauses,
+                                     max_items=max_items)
             res["is_sliced"] = self.is_sliced
             
             # for each item we add its link:
@@ -192,8 +214,9 @@ class FilterFirehoseAttribute(Filter):
                .group_by(attribute)
                .order_by(desc("count"))
                  )
-
-        # slicing
+        return self._slice(query, max_items)
+    
+    def _slice(self, query, max_items=None):
         if max_items is not None:
             number_of_all_results = query.count()
             if number_of_all_results > max_items:
@@ -201,6 +224,23 @@ class FilterFirehoseAttribute(Filter):
                 self.is_sliced = True
         
         return query.all()
+    
+    # the columns of result_search are named after the filters
+    def get_search_clauses(self):
+        return [(t_result_search.c[self.name] == self.value)]
+    
+    def get_search_items(self, session, clauses=None, max_items=None):
+        column = t_result_search.c[self.name]
+        query = session.query(column.label("value"),
+                              func.count(t_result_search.c.result_id)
+                              .label("count"))
+        if clauses is not None:
+            query = query.filter(and_(*clauses))
+        query = (query
+               .group_by(column)
+               .order_by(desc("count"))
+                 )
+        return to_dict(self._slice(query, max_items))
 
 ##################################################
 # real world filters:
@@ -423,6 +463,15 @@ class FilterByMaintainerPackages(Filter):
     def get_items(self, session, clauses=None, max_items=None):
         return []
     
+    def get_search_clauses(self):
+        return [(DebianPackagePeopleMapping.maintainer_email.in_(
+                 emails_for_person(self.value))),
+                (t_result_search.c.sut_name ==
+                 DebianPackagePeopleMapping.package_name)]
+    
+    def get_search_items(self, session, clauses=None, max_items=None):
+        return []
+    
     def is_relevant(self, active_keys=None):
         return True
 
@@ -17,8 +17,10 @@
 
 
 from firewoes.lib.orm import Analysis, Issue, Failure, Info, Result, \
-    Generator, Sut, Metadata, Message, Location, File, Point, Range, Function
+    Generator, Sut, Metadata, Message, Location, File, Range, Function
 from firewoes.lib.debianutils import DebianPackagePeopleMapping, DebianMaintainer
+from firewoes.lib.feed import make_token, since_condition
+from firewoes.lib.search import t_result_search
 
 from sqlalchemy import and_, func, desc
 
@@ -34,6 +36,10 @@ class Http404Error(Exception): pass
 ### MODEL CLASSES ###
 
 
+# attributes which are a detail of the storage, not part of the API
+# (the states of a compact trace are returned in trace.states)
+hidden_attrs = set(["compact_states"])
+
 def to_dict(elem):
     """
     serializes a SQLAchemy response into a dict
@@ -56,6 +62,8 @@ def to_dict(elem):
         res = dict()
         cls = type(elem)
         for attr_name in cls._sa_class_manager.local_attrs:
+                if attr_name in hidden_attrs:
+                    continue
                 attr = getattr(elem, attr_name)
                 #if type(attr) in [int, float, str, unicode]:#_string_type]
                 #    res[attr_name] = attr
@@ -64,6 +72,39 @@ def to_dict(elem):
         return res
 
 
+def _point_dict(line, column, id_):
+    return dict(line=line, column=column, id=id_)
+
+def _set_point_range(res):
+    """
+    Replaces the inline coordinates of the location of a search result (a
+    dict, see Result_app.filter()) by its "Point" and "Range", with the ids
+    of their rows. The dbs which store the locations inline (see
+    firewoes.lib.orm.stores_inline_locations()) have no such rows: their
+    points and ranges have no ids, and a range whose ends are the same is
+    returned as a point.
+    """
+    loc = dict((key, res.pop("location_" + key)) for key in (
+            "start_line", "start_column", "end_line", "end_column",
+            "point_id", "range_id", "range_start_id", "range_end_id"))
+    res["Point"] = res["Range"] = None
+    if loc["start_line"] is None:
+        return
+    if loc["range_id"] is None and (loc["point_id"] is not None or (
+            (loc["start_line"], loc["start_column"])
+            == (loc["end_line"], loc["end_column"]))):
+        res["Point"] = _point_dict(loc["start_line"], loc["start_column"],
+                                   loc["point_id"])
+        return
+    res["Range"] = dict(
+        start=_point_dict(loc["start_line"], loc["start_column"],
+                          loc["range_start_id"]),
+        end=_point_dict(loc["end_line"], loc["end_column"],
+                        loc["range_end_id"]),
+        start_id=loc["range_start_id"], end_id=loc["range_end_id"],
+        id=loc["range_id"])
+
+
 class FHGeneric(object):
     def all(self):
         elem = session.query(self.fh_class).all()
@@ -244,7 +285,14 @@ class Result_app(FHGeneric):
                 Function.name.label("location_function"),
                 Message.text.label("message_text"),
                 Message.id.label("message_id"),
-                Point, Range,
+                Location.start_line.label("location_start_line"),
+                Location.start_column.label("location_start_column"),
+                Location.end_line.label("location_end_line"),
+                Location.end_column.label("location_end_column"),
+                Location.point_id.label("location_point_id"),
+                Location.range_id.label("location_range_id"),
+                Range.start_id.label("location_range_start_id"),
+                Range.end_id.label("location_range_end_id"),
                 Sut.name.label("sut_name"),
                 Sut.version.label("sut_version"),
                 Sut.type.label("sut_type"),
@@ -255,12 +303,21 @@ class Result_app(FHGeneric):
                 Result.testid.label("testid"),
                 Result.analysis_id.label("analysis_id"),
             )
-            .outerjoin(Location, File, Function, Point, Analysis,
+            .outerjoin(Location, File, Function, Analysis,
                        Metadata, Generator, Sut, Message)
-            .outerjoin(Range, Location.range_id==Range.id)
+            # only the start and end ids of the ranges need a join
+            .outerjoin(Range, Location.range_id == Range.id)
                  )
-        menu = filters.Menu(args_without_page)
-        query = menu.filter_sqla_query(query)
+        
+        # with the flat table, only the results of the page need the joins
+        flat = app.config["SEARCH_USE_FLAT_TABLE"]
+        menu = filters.Menu(args_without_page, flat=flat)
+        if flat:
+            ids_query = menu.filter_sqla_query(
+                session.query(t_result_search.c.result_id)
+                .order_by(t_result_search.c.result_id))
+        else:
+            query = menu.filter_sqla_query(query)
         
         # we get the page number and the offset
         try:  page = int(request_args["page"])
@@ -275,8 +332,17 @@ class Result_app(FHGeneric):
         
         menu=menu.get(session,
                       max_items=app.config["SEARCH_MENU_MAX_NUMBER_OF_ELEMENTS"])
-        results_all_count = query.count()
-        results=to_dict(query.slice(start, end).all())
+        if flat:
+            results_all_count = ids_query.count()
+            ids = [row.result_id for row in ids_query.slice(start, end)]
+            elems = query.filter(Result.id.in_(ids)).all() if ids else []
+            elems.sort(key=lambda elem: ids.index(elem.id))
+        else:
+            results_all_count = query.count()
+            elems = query.slice(start, end).all()
+        results=to_dict(elems)
+        for res in results:
+            _set_point_range(res)
         
         # do we need to suggest things?
         if len(results) == 0:
@@ -295,6 +361,50 @@ class Result_app(FHGeneric):
                     suggestions=suggestions,
                     )
 
+    def since(self, token, limit=None):
+        """
+        Returns the results first seen after the cursor token (see
+        firewoes.lib.feed), in the order of ingestion, along with the cursor
+        of the following ones
+        
+        limit: maximum number of results (at most FEED_MAX_RESULTS)
+        """
+        max_results = app.config["FEED_MAX_RESULTS"]
+        if limit is None or not 0 < limit <= max_results:
+            limit = max_results
+        try:
+            condition = since_condition(token)
+        except ValueError:
+            raise Http404Error("Invalid cursor: %s" % token)
+        
+        query = (session.query(
+                Result.id,
+                Result.type.label("result_type"),
+                File.givenpath.label("location_file"),
+                Function.name.label("location_function"),
+                Location.start_line.label("location_line"),
+                Message.text.label("message_text"),
+                Sut.name.label("sut_name"),
+                Sut.version.label("sut_version"),
+                Generator.name.label("generator_name"),
+                Result.analysis_id.label("analysis_id"),
+                Analysis.seq.label("seq"),
+                Analysis.ingested_at.label("ingested_at"),
+            )
+            .join(Analysis, Result.analysis_id == Analysis.id)
+            .outerjoin(Location, File, Function, Message)
+            .outerjoin(Metadata, Analysis.metadata_id == Metadata.id)
+            .outerjoin(Generator, Metadata.generator_id == Generator.id)
+            .outerjoin(Sut, Metadata.sut_id == Sut.id)
+            .filter(condition)
+            .order_by(Analysis.seq, Result.id)
+            .limit(limit)
+                 )
+        results = to_dict(query.all())
+        if results:
+            token = make_token(results[-1]["seq"], results[-1]["id"])
+        return dict(results=results, next=token)
+
 class Report(object):
     def __init__(self, package_id):
         self.package_id = package_id
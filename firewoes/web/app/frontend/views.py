@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import hmac
 
 from flask import render_template, jsonify, request, Blueprint, url_for, \
     redirect
@@ -28,6 +29,7 @@ from models import Http404Error, Http500Error
 
 import firewoes.lib.fedorautils as fedorautils
 import firewoes.lib.debianutils as debianutils
+from firewoes.lib import spool
 
 static_folder = "static"
 template_folder = "templates"
@@ -184,6 +186,21 @@ mod.add_url_rule('/api/search/', view_func=SearchView.as_view(
         err_func=lambda e, **kwargs: deal_error(e, mode='json', **kwargs)
         ))
 
+### FEED ###
+
+# the results in the order of ingestion, after a cursor ("0" for all of them)
+class SinceView(GeneralView):
+    def get_objects(self, token):
+        try: limit = int(request.args["limit"])
+        except: limit = None
+        return Result_app().since(token, limit=limit)
+
+mod.add_url_rule('/api/results/since/<token>/', view_func=SinceView.as_view(
+        'results_since_json',
+        render_func=jsonify,
+        err_func=lambda e, **kwargs: deal_error(e, mode='json', **kwargs)
+        ))
+
 ### REPORT ###
 
 # redirects the searches
@@ -234,3 +251,52 @@ mod.add_url_rule('/api/report/<package_name>/', view_func=ReportView.as_view(
         render_func=jsonify,
         err_func=lambda e, **kwargs: deal_error(e, mode='json', **kwargs)
         ))
+
+### INGESTION ###
+
+def ingest_authorized():
+    """ checks the token of the "Authorization: Token <token>" header """
+    (scheme, _, token) = request.headers.get("Authorization", "").partition(
+        " ")
+    if scheme.lower() not in ("token", "bearer") or not token:
+        return False
+    return any(hmac.compare_digest(str(token), str(allowed))
+               for allowed in app.config["INGEST_TOKENS"])
+
+def ingest_error(http, message=None):
+    return jsonify(dict(error=http, message=message)), http
+
+# the analysis is only written to the spool directory, a daemon ingests it
+@mod.route('/api/analysis/', methods=['POST'])
+def post_analysis():
+    spool_dir = app.config["INGEST_SPOOL_DIR"]
+    if not spool_dir:
+        return ingest_error(404)
+    if not ingest_authorized():
+        return ingest_error(401)
+    max_size = app.config["INGEST_MAX_SIZE"]
+    if request.content_length is not None \
+            and request.content_length > max_size:
+        return ingest_error(413)
+    try:
+        ticket = spool.submit(spool_dir, request.stream, max_size=max_size)
+    except ValueError as e:
+        return ingest_error(400, str(e))
+    status_url = url_for('.analysis_status', ticket=ticket, _external=True)
+    response = jsonify(dict(ticket=ticket, status="pending",
+                            status_url=status_url))
+    response.status_code = 202
+    response.headers["Location"] = status_url
+    return response
+
+@mod.route('/api/analysis/<ticket>/')
+def analysis_status(ticket):
+    spool_dir = app.config["INGEST_SPOOL_DIR"]
+    if not spool_dir:
+        return ingest_error(404)
+    if not ingest_authorized():
+        return ingest_error(401)
+    (status, error) = spool.ticket_status(spool_dir, ticket)
+    if status is None:
+        return ingest_error(404)
+    return jsonify(dict(ticket=ticket, status=status, error=error))
@@ -40,6 +40,13 @@ SEARCH_MENU_MAX_NUMBER_OF_CHARS = 28
 # The number of results to display (per default) on a search results page
 SEARCH_RESULTS_OFFSET = 10
 
+# Whether the searches query the result_search table, which has to be filled
+# first on the existing databases (firewoes_db.py URL upgrade)
+SEARCH_USE_FLAT_TABLE = False
+
+# The maximum number of results returned by /api/results/since/<cursor>/
+FEED_MAX_RESULTS = 1000
+
 # the url pattern used to generate urls to point on source code
 DEBIAN_SOURCES_URL = "http://sources.debian.net/src/{package}/{version}-{release}/{path}?msg={message}&hl={lines_range}#L{anchor}"
 
@@ -52,3 +59,15 @@ FEDORA_EMBEDDED_SOURCES_URL = "http://foo.bar"
 
 # where one can find the source code of the app
 GITWEB_URL = ""
+
+# the analyses POSTed to /api/analysis/ are written into this directory, to
+# be ingested by firewoes_fill_db.py --spool (the endpoint is disabled if
+# empty)
+INGEST_SPOOL_DIR = ""
+
+# the tokens accepted in the "Authorization: Token <token>" header of the
+# requests to /api/analysis/
+INGEST_TOKENS = []
+
+# the maximum size in bytes of a POSTed analysis (possibly gzip-compressed)
+INGEST_MAX_SIZE = 64 * 1024 * 1024
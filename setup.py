@@ -15,7 +15,8 @@ setup(
     version=__version__,
     packages=find_packages(),
     include_package_data=True,
-    scripts=["firewoes/bin/firewoes_fill_db.py"],
+    scripts=["firewoes/bin/firewoes_fill_db.py",
+             "firewoes/bin/firewoes_db.py"],
     install_requires=install_requires,
     zip_safe=False,
     author="Matthieu Caneill",
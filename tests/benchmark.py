@@ -0,0 +1,200 @@
+# Ingestion throughput benchmarks
+#
+# Generates corpora of several sizes with generate_fake_base.py, in the XML
+# and JSON forms of Firehose, and ingests each of them with
+# read_and_create(), first into an empty db (cold), then again with 10% of
+# new analyses (warm, mostly duplicates).
+# Each run is done in a freshly executed process, so that its peak RSS
+# doesn't include the pages of the benchmark itself (a forked process shares
+# them, and ru_maxrss even keeps the peak of the process before exec).
+# The results are written as JSON, along with the git commit, so that runs
+# can be compared across commits.
+#
+# usage: python tests/benchmark.py [--sizes small,medium] [--formats xml]
+#                                  [--output FILE]
+
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import argparse
+import platform
+import tempfile
+import resource
+import subprocess
+from itertools import product
+
+testsdir = os.path.dirname(os.path.abspath(__file__))
+
+from firewoes.bin.generate_fake_base import CorpusGenerator, \
+    generate_fake_bases
+from firewoes.bin.firewoes_fill_db import read_and_create, prepare_analysis
+
+# name: (packages, results per analysis)
+sizes = dict(small=(20, 10),
+             medium=(200, 20),
+             large=(1000, 30))
+
+# name: read_and_create() options
+modes = dict(orm=dict(),
+             bulk=dict(bulk=True))
+
+formats = ["xml", "json"]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=testsdir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def generate_corpus(directory, packages, results, seed, format="xml"):
+    """
+    Writes a corpus into directory, and returns the list of its files
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+        generate_fake_bases(directory, CorpusGenerator(
+                seed=seed, packages=packages, results=results), format)
+    return sorted(glob.glob(os.path.join(directory, "*." + format)))
+
+def count_results(files):
+    return sum(len(analysis.results) for (analysis, error) in
+               (prepare_analysis(file_) for file_ in files)
+               if analysis is not None)
+
+def peak_rss_kb():
+    """
+    Returns the peak RSS of the current process, in kB: VmHWM on Linux,
+    which starts again at exec, unlike ru_maxrss
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _run_child():
+    """
+    Child process (benchmark.py --child): ingests the files given as JSON
+    on stdin, and writes its measures as JSON on stdout
+    """
+    (url, files, options) = json.load(sys.stdin)
+    (stdout, sys.stdout) = (sys.stdout, open(os.devnull, "w"))
+    try:
+        start = time.time()
+        stats = read_and_create(url, files, **options)
+        seconds = time.time() - start
+    finally:
+        sys.stdout = stdout
+    json.dump(dict(seconds=seconds,
+                   stages=stats.times,
+                   objects=stats.as_dict()["objects"],
+                   peak_rss_kb=peak_rss_kb()), stdout)
+
+def run(url, files, results, **options):
+    # the child finds the modules where we found them
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            path for path in sys.path if path))
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+        close_fds=True)
+    (output, _) = process.communicate(json.dumps([url, files, options]))
+    if process.returncode != 0:
+        raise RuntimeError("the ingestion of %d files failed" % len(files))
+    measures = json.loads(output)
+    measures.update(files=len(files), results=results,
+                    files_per_s=len(files) / measures["seconds"],
+                    results_per_s=results / measures["seconds"])
+    return measures
+
+def benchmark(size_names, mode_names, workdir, db_url=None, seed=0,
+              format_names=formats):
+    runs = []
+    for (size_name, format) in product(size_names, format_names):
+        (packages, results) = sizes[size_name]
+        corpus = generate_corpus(
+            os.path.join(workdir, "%s-%d-%s" % (size_name, seed, format)),
+            packages, results, seed, format)
+        new = generate_corpus(
+            os.path.join(workdir, "%s-%d-%s-new" % (size_name, seed, format)),
+            max(1, packages // 10), results, seed + 1, format)
+        corpus_results = count_results(corpus)
+        new_results = count_results(new)
+
+        for mode_name in mode_names:
+            url = db_url
+            if url is None:
+                db_path = os.path.join(workdir, "benchmark.db")
+                if os.path.exists(db_path):
+                    os.remove(db_path)
+                url = "sqlite:///" + db_path
+            for (phase, files, results, options) in [
+                ("cold", corpus, corpus_results, dict(drop=True)),
+                ("warm", corpus + new, corpus_results + new_results,
+                 dict(force=True))]:
+                options.update(modes[mode_name])
+                measures = run(url, files, results, **options)
+                measures.update(size=size_name, mode=mode_name, phase=phase,
+                                format=format)
+                runs.append(measures)
+                print("%-6s %-4s %-4s %s: %5d files, %7d results, %7.1f s, "
+                      "%7.1f files/s, %8.1f results/s, %6d MB"
+                      % (size_name, format, mode_name, phase,
+                         measures["files"],
+                         measures["results"], measures["seconds"],
+                         measures["files_per_s"], measures["results_per_s"],
+                         measures["peak_rss_kb"] // 1024))
+    return runs
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--child"]:
+        _run_child()
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Benchmarks the ingestion "
+                                     "of generated corpora")
+    parser.add_argument("--sizes", help="comma-separated sizes among %s "
+                        "(default: small,medium)" % ", ".join(sorted(sizes)),
+                        default="small,medium")
+    parser.add_argument("--modes", help="comma-separated modes among %s "
+                        "(default: all)" % ", ".join(sorted(modes)),
+                        default=",".join(sorted(modes)))
+    parser.add_argument("--formats", help="comma-separated formats among "
+                        "%s (default: all)" % ", ".join(formats),
+                        default=",".join(formats))
+    parser.add_argument("--db", help="URL of the database to use, which is "
+                        "dropped (default: a temporary sqlite db)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="where to keep the generated "
+                        "corpora between runs (default: a temporary dir)")
+    parser.add_argument("--output", help="JSON file of the results "
+                        "(default: benchmark.json)", default="benchmark.json")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="firewoes-benchmark-")
+    try:
+        runs = benchmark(args.sizes.split(","), args.modes.split(","),
+                         workdir, db_url=args.db, seed=args.seed,
+                         format_names=args.formats.split(","))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    with open(args.output, "w") as f:
+        json.dump(dict(commit=git_commit(),
+                       date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       python=platform.python_version(),
+                       db=args.db or "sqlite",
+                       seed=args.seed,
+                       runs=runs), f, indent=2, sort_keys=True)
+    print("results written to %s" % args.output)
@@ -1,13 +1,38 @@
 import os
 import sys
 import unittest
+import subprocess
 import json
+import gzip
+import bz2
+import tarfile
+import shutil
+import tempfile
+from cStringIO import StringIO
+from contextlib import closing
 from glob import glob
+from sqlalchemy import select, event
+from sqlalchemy.exc import OperationalError
 
 testsdir = os.path.dirname(os.path.abspath(__file__))
 
 from firewoes.lib import orm
+from firewoes.lib.hash import idify, uniquify, ids_by_class
+from firewoes.lib.bulk import analysis_rows, insert_rows
+from firewoes.lib import stream
+from firewoes.lib.stream import idify_streaming
+from firewoes.lib.cache import UniqueCache
+from firewoes.lib.garbage import Collector
+from firewoes.lib.workqueue import WorkQueue
+from firewoes.lib import spool
+from firewoes.lib import optimize
+from firewoes.lib.migrations import upgrade, compact_stored_traces
+from firewoes.lib.manifest import Manifest, t_ingested_file
+from firewoes.lib.knownids import KnownIds
+from firewoes.lib.sources import Member
+from firewoes.lib.dbutils import get_engine_session
 from firewoes.bin import firewoes_fill_db
+import firewoes.web.app
 from firewoes.web.app import app
 
 class FirewoesTestCase(unittest.TestCase):
@@ -145,5 +170,857 @@ class FirewoesTestCase(unittest.TestCase):
             ]
         assert rv["results"][0]["package"]["name"] == "python-ethtool"
 
+    def test_search_flat(self):
+        url = ('/api/search/?sut_name=python-ethtool'
+               '&location_file=python-ethtool%2Fethtool.c&offset=100')
+        responses = []
+        for flat in (False, True):
+            self.config["SEARCH_USE_FLAT_TABLE"] = flat
+            try:
+                rv = json.loads(self.app.get(url).data)
+            finally:
+                self.config["SEARCH_USE_FLAT_TABLE"] = False
+            # the flat table doesn't list the values without results
+            menu = [sorted((item["value"], item["count"])
+                           for item in filter_.get("items", [])
+                           if item["count"] > 0)
+                    for filter_ in rv["menu"]]
+            responses.append((rv["results_all_count"], menu,
+                              sorted(rv["results"], key=lambda r: r["id"])))
+        assert responses[0] == responses[1]
+        assert responses[0][0] == 18
+
+    def test_results_since(self):
+        ids = []
+        token = "0"
+        while True:
+            rv = json.loads(self.app.get('/api/results/since/%s/?limit=5'
+                                         % token).data)
+            if not rv["results"]:
+                assert rv["next"] == token
+                break
+            assert len(rv["results"]) <= 5
+            ids.extend(result["id"] for result in rv["results"])
+            token = rv["next"]
+        assert len(ids) == len(set(ids)) == 18
+        seq = int(token.split("-")[0])
+        rv = json.loads(self.app.get('/api/results/since/%d/' % seq).data)
+        assert rv["results"] == []
+        rv = json.loads(self.app.get('/api/results/since/foo/').data)
+        assert rv["error"] == 404
+
+class IdifyTestCase(unittest.TestCase):
+    # ids given by the original, recursive implementation of idify()
+    analysis_ids = [
+        ("0bb1de0f8aab43df2f613082aa8d1fc18d8c01b1.xml",
+         "00f62063e0805a14190c10dbacf66e9a489f236d"),
+        ("0eda945826402f9d93ebb10f8542fa37ed134ff4.xml",
+         "e14570f4daa05ec28a97893e2bb5b5290bb7828e"),
+        ("1eae3b5cbd1f52e278866ded6650640b576911c9.xml",
+         "7b9536bdc216f094ca7ca37090bbe32d5280c94b"),
+        ("2e32c857885f9e34f98a48ee5d31f1ee09adc226.xml",
+         "d1cd655ff5d68df54e98d858c5e6c096587badad"),
+        ("4a3fbb229ef6612fee5fac7a6b7416b0ecbf7351.xml",
+         "54918a2d664b2bf993b5d031290c88045eb848fa"),
+        ("5c9e38724b70fea0d30c106ec01ce19f73a7f342.xml",
+         "358cc920b9a18e1601e9750b5cf4920725420c7d"),
+        ]
+    
+    def test_idify_ids(self):
+        for (filename, analysis_id) in self.analysis_ids:
+            analysis = orm.Analysis.from_xml(
+                os.path.join(testsdir, "data", filename))
+            assert idify(analysis) == (analysis, analysis_id)
+            assert analysis.id == analysis_id
+    
+    def test_idify_nodes(self):
+        analysis = orm.Analysis.from_xml(
+            os.path.join(testsdir, "data", self.analysis_ids[4][0]))
+        idify(analysis)
+        results = dict((result.id, result) for result in analysis.results)
+        result = results["e137be9fe3e6f9ab042f4cfd1e8074446b556fa7"]
+        assert result.message.id == "eea211bacf3c996e3e8c0d3364384da5b299ba14"
+        assert result.location.point.id == \
+            "b9a229d8cb6e8d80bbe64739c6d8e5287efc0ec6"
+    
+    def test_idify_equal_subtrees(self):
+        from firewoes.lib import hash as hash_module
+        def result():
+            return orm.Issue(None, None, orm.Location(
+                    orm.File("foo.c", None, None), orm.Function("main"),
+                    orm.Point(10, 4)), orm.Message("bar"), None, None)
+        hashers = []
+        def new_hasher():
+            hashers.append(None)
+            return orig_new_hasher()
+        (orig_new_hasher, hash_module.new_hasher) = (hash_module.new_hasher,
+                                                     new_hasher)
+        try:
+            id_ = idify(result())[1]
+            hashed = len(hashers)
+            ids = [id_ for (result_, id_)
+                   in idify([result() for i in range(10)], memo=dict())]
+        finally:
+            hash_module.new_hasher = orig_new_hasher
+        # the same ids as a tree hashed alone, each node hashed once
+        assert ids == [id_] * 10
+        assert len(hashers) == 2 * hashed
+    
+    def test_idify_streaming_ids(self):
+        for (filename, analysis_id) in self.analysis_ids:
+            res = idify_streaming(os.path.join(testsdir, "data", filename))
+            assert res[2] == analysis_id
+    
+    def test_streaming_memo_size(self):
+        analysis = orm.Analysis.from_xml(
+            os.path.join(testsdir, "data", self.analysis_ids[4][0]))
+        analysis.results = [
+            orm.Info("info-%d" % i, None, orm.Message("message %d" % i),
+                     None)
+            for i in range(2000)]
+        path = os.path.join(tempfile.mkdtemp(), "large.xml")
+        with open(path, "w") as f:
+            f.write(analysis.to_xml_bytes())
+        sizes = []
+        def idify_recording(obj, memo=None):
+            ret = idify(obj, memo=memo)
+            sizes.append(len(memo or ()))
+            return ret
+        (memo_size, stream.memo_size) = (stream.memo_size, 100)
+        stream.idify = idify_recording
+        try:
+            res = idify_streaming(path)
+            chunks = list(stream.iter_idified_results(path, 500))
+        finally:
+            (stream.memo_size, stream.idify) = (memo_size, idify)
+            shutil.rmtree(os.path.dirname(path))
+        assert res[2] == idify(analysis)[1]
+        assert [result.id for chunk in chunks for result in chunk] == \
+            [result.id for result in analysis.results]
+        assert max(sizes) <= 110
+    
+    def test_json_ids(self):
+        for (filename, analysis_id) in self.analysis_ids:
+            analysis = orm.Analysis.from_xml(
+                os.path.join(testsdir, "data", filename))
+            member = Member(filename, json.dumps(analysis.to_json()))
+            (analysis, error) = firewoes_fill_db.prepare_analysis(member)
+            assert analysis.id == analysis_id
+
+class UniqueCacheTestCase(unittest.TestCase):
+    def test_trim(self):
+        cache = UniqueCache(capacity=2)
+        for i in range(4):
+            cache[(orm.Message, i)] = i
+        # nothing is evicted before trim()
+        assert len(cache) == 4
+        cache.get((orm.Message, 0))
+        cache.trim()
+        assert sorted(key[1] for key in cache) == [0, 3]
+        assert cache.evictions == 2
+        assert cache.get((orm.Message, 1)) is None
+        assert (cache.hits, cache.misses) == (1, 1)
+    
+    def test_pinned(self):
+        cache = UniqueCache(capacity=0, pinned_capacity=1)
+        cache[(orm.Generator, 0)] = 0
+        cache[(orm.Generator, 1)] = 1
+        cache.trim()
+        assert list(cache) == [(orm.Generator, 0)]
+    
+    def test_rollback(self):
+        cache = UniqueCache()
+        cache[(orm.Message, 0)] = 0
+        mark = cache.mark()
+        cache[(orm.Message, 0)] = 0
+        cache[(orm.Message, 1)] = 1
+        # only the keys added since the mark are forgotten
+        cache.rollback(mark)
+        assert list(cache) == [(orm.Message, 0)]
+        cache.trim()
+        assert cache.mark() == 0
+        cache.rollback()
+        assert list(cache) == [(orm.Message, 0)]
+
+class BulkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        self.engine, self.session = get_engine_session(self.url)
+        orm.metadata.create_all(self.engine)
+    
+    def tearDown(self):
+        self.session.remove()
+        shutil.rmtree(self.tmpdir)
+    
+    def analysis(self):
+        analysis = orm.Analysis(
+            orm.Metadata(orm.Generator("generator"), None, None, None),
+            [orm.Failure("bad-exit", None, orm.Message("failure"), None),
+             orm.Info("stats", None, orm.Message("info"), None)])
+        return idify(analysis)[0]
+    
+    def test_same_rows_as_orm(self):
+        query = select([orm.t_result.c.id, orm.t_result.c.type,
+                        orm.t_result.c.testid]).order_by(orm.t_result.c.id)
+        self.session.merge(self.analysis())
+        self.session.commit()
+        with self.engine.begin() as connection:
+            expected = connection.execute(query).fetchall()
+            connection.execute(orm.t_result.delete())
+            insert_rows(connection, analysis_rows(self.analysis()))
+            assert connection.execute(query).fetchall() == expected
+    
+    def test_bound_parameters(self):
+        rows = dict()
+        for i in range(1000):
+            message = orm.Message("message %d" % i)
+            idify(message)
+            analysis_rows(message, rows)
+        params = []
+        def count_params(conn, cursor, statement, parameters, context,
+                         executemany):
+            params.append(len(parameters))
+        event.listen(self.engine, "before_cursor_execute", count_params)
+        try:
+            with self.engine.begin() as connection:
+                assert insert_rows(connection, rows) == 1000
+                assert connection.execute(
+                    orm.t_message.count()).scalar() == 1000
+        finally:
+            event.remove(self.engine, "before_cursor_execute", count_params)
+        assert max(params) <= 999
+
+class GarbageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def row_counts(self, url, xml_files, deleted_id=None):
+        engine, session = get_engine_session(url)
+        firewoes_fill_db.read_and_create(url, xml_files, drop=True,
+                                         bulk=True)
+        with engine.begin() as connection:
+            collector = Collector(connection)
+            if deleted_id is not None:
+                collector.delete_analyses(
+                    select([orm.t_analysis.c.id])
+                    .where(orm.t_analysis.c.id == deleted_id))
+            collector.collect()
+            return dict((table.name, connection.execute(
+                        table.count()).scalar())
+                        for table in orm.metadata.sorted_tables)
+    
+    def test_collect(self):
+        (kept, deleted) = [os.path.join(testsdir, "data", filename)
+                           for (filename, analysis_id)
+                           in IdifyTestCase.analysis_ids[3:5]]
+        url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        expected = self.row_counts(url, [kept])
+        assert self.row_counts(url, [kept, deleted])["result"] > 0
+        # only the rows shared with the kept analysis are left
+        counts = self.row_counts(url, [kept, deleted],
+                                 IdifyTestCase.analysis_ids[4][1])
+        assert counts == expected
+
+    def test_inline_locations(self):
+        url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        engine, session = get_engine_session(url)
+        firewoes_fill_db.read_and_create(url, glob(testsdir + "/data/*.xml"),
+                                         drop=True)
+        t = orm.t_location
+        with engine.begin() as connection:
+            coordinates = connection.execute(
+                select([t.c.id, orm.t_point.c.line, orm.t_point.c.column])
+                .select_from(t.join(orm.t_point))).fetchall()
+            assert coordinates
+            collector = Collector(connection)
+            assert collector.inline_locations() == len(coordinates)
+            collector.collect()
+            assert connection.execute(orm.t_point.count()).scalar() == 0
+            assert sorted(connection.execute(
+                    select([t.c.id, t.c.start_line, t.c.start_column])
+                    .where(t.c.start_line != None))) == sorted(coordinates)
+
+    def test_inline_locations_mode(self):
+        xml_files = glob(testsdir + "/data/*.xml")
+        t = orm.t_location
+        query = select([t.c.id, t.c.point_id, t.c.range_id, t.c.start_line,
+                        t.c.start_column, t.c.end_line, t.c.end_column])
+        url = "sqlite:///" + os.path.join(self.tmpdir, "legacy.db")
+        engine, session = get_engine_session(url)
+        firewoes_fill_db.read_and_create(url, xml_files, drop=True)
+        with engine.begin() as connection:
+            assert connection.execute(orm.t_point.count()).scalar() > 0
+            expected = sorted((row[0],) + tuple(row[3:])
+                              for row in connection.execute(query))
+        for (name, options) in [("orm", dict()), ("bulk", dict(bulk=True)),
+                                ("stream", dict(stream=True)),
+                                ("jobs", dict(jobs=2))]:
+            url = "sqlite:///" + os.path.join(self.tmpdir, name + ".db")
+            engine, session = get_engine_session(url)
+            orm.metadata.create_all(engine)
+            with engine.begin() as connection:
+                assert not orm.stores_inline_locations(connection)
+                orm.store_inline_locations(connection)
+                assert orm.stores_inline_locations(connection)
+            firewoes_fill_db.read_and_create(url, xml_files, **options)
+            with engine.begin() as connection:
+                assert connection.execute(orm.t_point.count()).scalar() \
+                    == connection.execute(orm.t_range.count()).scalar() == 0
+                rows = connection.execute(query).fetchall()
+            assert all(row.point_id is row.range_id is None for row in rows)
+            # the same locations, without the joins
+            assert sorted((row[0],) + tuple(row[3:]) for row in rows) \
+                == expected, name
+
+class BinaryIdsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_binary_ids(self):
+        (filename, analysis_id) = IdifyTestCase.analysis_ids[4]
+        url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        engine, session = get_engine_session(url)
+        engine.dialect.binary_ids = True
+        orm.metadata.create_all(engine)
+        firewoes_fill_db.read_and_create(
+            url, [os.path.join(testsdir, "data", filename)], bulk=True)
+        t = orm.t_analysis
+        with engine.begin() as connection:
+            assert connection.execute(
+                "SELECT length(id) FROM analysis").scalar() == 20
+            assert connection.execute(
+                select([t.c.id]).where(t.c.id == analysis_id)).scalar() \
+                == analysis_id
+            # not an id: matches nothing
+            assert connection.execute(
+                select([t.c.id]).where(t.c.id == "xyz")).scalar() is None
+    
+    def test_detection(self):
+        # no connection is made before the db is used
+        engine, session = get_engine_session(
+            "sqlite:///" + os.path.join(self.tmpdir, "nope", "test.db"))
+        url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        engine, session = get_engine_session(url)
+        engine.dialect.binary_ids = True
+        orm.metadata.create_all(engine)
+        engine, session = get_engine_session(url)
+        assert getattr(engine.dialect, "binary_ids", None) is None
+        with engine.begin() as connection:
+            assert connection.execute(orm.t_analysis.count()).scalar() == 0
+        assert engine.dialect.binary_ids is True
+
+class CompactTracesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_compact_traces(self):
+        path = os.path.join(testsdir, "data", IdifyTestCase.analysis_ids[4][0])
+        traces = dict((result.id, result.trace)
+                      for result in idify(orm.Analysis.from_xml(path))[0]
+                      .results if result.trace is not None)
+        assert traces
+        url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        engine, session = get_engine_session(url)
+        firewoes_fill_db.read_and_create(url, [path], drop=True)
+        with engine.begin() as connection:
+            assert connection.execute(orm.t_state.count()).scalar() == 0
+        for (result_id, trace) in traces.items():
+            result = session.query(orm.Result).get(result_id)
+            assert result.trace.id == trace.id
+            # in the order of the file
+            assert [(state.location.file.givenpath, state.location.point,
+                     state.notes) for state in result.trace.states] == \
+                [(state.location.file.givenpath, state.location.point,
+                  state.notes) for state in trace.states]
+            assert [state.location.start_line
+                    for state in result.trace.states] == \
+                [state.location.point.line for state in trace.states]
+        session.remove()
+    
+    def test_api_result(self):
+        path = os.path.join(testsdir, "data", IdifyTestCase.analysis_ids[4][0])
+        url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        engine, session = get_engine_session(url)
+        # a db of the legacy form, with a row for each state
+        compact_traces = orm.compact_traces
+        orm.compact_traces = lambda results: None
+        try:
+            firewoes_fill_db.read_and_create(url, [path], drop=True)
+        finally:
+            orm.compact_traces = compact_traces
+        with engine.begin() as connection:
+            assert connection.execute(orm.t_state.count()).scalar() > 0
+            ids = [row.id for row in connection.execute(
+                    select([orm.t_result.c.id])
+                    .where(orm.t_result.c.trace_id != None))]
+        assert ids
+        client = app.test_client()
+        web_session = firewoes.web.app.session
+        web_session.remove()
+        web_session.configure(bind=engine)
+        try:
+            before = [json.loads(client.get('/api/result/%s/' % id_).data)
+                      for id_ in ids]
+            with engine.begin() as connection:
+                compact_stored_traces(connection)
+                assert connection.execute(orm.t_state.count()).scalar() == 0
+            web_session.remove()
+            after = [json.loads(client.get('/api/result/%s/' % id_).data)
+                     for id_ in ids]
+        finally:
+            web_session.remove()
+            web_session.configure(bind=firewoes.web.app.engine)
+        assert before == after
+        assert all(rv["result"]["trace"]["states"] for rv in after)
+        assert all("compact_states" not in rv["result"]["trace"]
+                   for rv in after)
+
+class FillDbTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        self.xml_files = [os.path.join(testsdir, "data", filename)
+                          for (filename, analysis_id)
+                          in IdifyTestCase.analysis_ids]
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def run_script(self, *args, **kwargs):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+                path for path in sys.path if path))
+        process = subprocess.Popen(
+            [sys.executable, firewoes_fill_db.__file__.rstrip("c")]
+            + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            env=env, stdin=kwargs.get("stdin"))
+        output = process.communicate()[0]
+        return (process.returncode, output)
+    
+    def analysis_ids(self):
+        engine, session = get_engine_session(self.url)
+        with engine.begin() as connection:
+            return sorted(row.id for row in connection.execute(
+                    select([orm.t_analysis.c.id])))
+    
+    def test_command_line(self):
+        # the options can be given between the URL and the files
+        (returncode, output) = self.run_script(self.url, "--drop",
+                                               *self.xml_files[:2])
+        assert returncode == 0, output
+        assert self.analysis_ids() == sorted(
+            analysis_id for (filename, analysis_id)
+            in IdifyTestCase.analysis_ids[:2])
+        (returncode, output) = self.run_script(
+            "--force", self.url, self.xml_files[2], "--bulk",
+            self.xml_files[3])
+        assert returncode == 0, output
+        assert len(self.analysis_ids()) == 4
+        (returncode, output) = self.run_script(self.url, "--nope",
+                                               self.xml_files[0])
+        assert returncode == 2
+        assert "unrecognized arguments: --nope" in output
+    
+    def table_rows(self, url=None):
+        # the order and time of the ingestions are left out
+        engine, session = get_engine_session(url or self.url)
+        with engine.begin() as connection:
+            return dict(
+                (table.name, sorted(connection.execute(select(
+                                [column for column in table.columns
+                                 if column.name not in
+                                 ("seq", "ingested_at")]))))
+                for table in orm.metadata.sorted_tables)
+    
+    def test_commit_every_failure(self):
+        failing = IdifyTestCase.analysis_ids[1][1]
+        store_analysis = firewoes_fill_db.store_analysis
+        def store(session, analysis, **kwargs):
+            self.session = session
+            ret = store_analysis(session, analysis, **kwargs)
+            if analysis.id == failing:
+                raise ValueError("cannot store %s" % analysis.id)
+            return ret
+        firewoes_fill_db.store_analysis = store
+        try:
+            stats = firewoes_fill_db.read_and_create(
+                self.url, self.xml_files, drop=True, commit_every=3)
+        finally:
+            firewoes_fill_db.store_analysis = store_analysis
+        assert stats.failed == 1
+        # the objects of the failed file are not left in the cache
+        committed = set(row[0] for rows in self.table_rows().values()
+                        for row in rows)
+        assert all(id_ in committed
+                   for (cls, id_) in self.session._unique_cache)
+        # the other files of the batch are kept, and only refer to rows
+        # which were committed
+        expected_url = "sqlite:///" + os.path.join(self.tmpdir, "expected.db")
+        firewoes_fill_db.read_and_create(
+            expected_url, self.xml_files[:1] + self.xml_files[2:], drop=True)
+        assert self.table_rows() == self.table_rows(expected_url)
+        # the failed file is ingested by the next run
+        firewoes_fill_db.read_and_create(self.url, self.xml_files,
+                                         commit_every=3)
+        firewoes_fill_db.read_and_create(expected_url, self.xml_files[1:2])
+        assert self.table_rows() == self.table_rows(expected_url)
+    
+    def test_uniquify_round_trips(self):
+        firewoes_fill_db.read_and_create(self.url, self.xml_files[4:5],
+                                         drop=True)
+        engine, session = get_engine_session(self.url)
+        statements = []
+        def record(conn, cursor, statement, parameters, context,
+                   executemany):
+            if statement.startswith("SELECT"):
+                statements.append(statement)
+        event.listen(engine, "before_cursor_execute", record)
+        # an analysis already in the db, and a new one sharing most nodes
+        for new in (False, True):
+            analysis = orm.Analysis.from_xml(self.xml_files[4])
+            if new:
+                analysis.results[0].message.text += " (changed)"
+            (analysis, analysis_id) = idify(analysis)
+            ids = ids_by_class(analysis)
+            nodes = sorted((result.id, result.message.id, result.location
+                            and result.location.id)
+                           for result in analysis.results)
+            del statements[:]
+            analysis = uniquify(session, analysis)
+            # one query per class instead of one per node, and the same ids
+            assert len(statements) <= len(ids)
+            assert len(statements) < sum(len(cls_ids)
+                                         for cls_ids in ids.values())
+            assert analysis.id == analysis_id
+            assert (analysis in session.new) == new
+            if new:
+                # the results of the existing analyses aren't loaded
+                assert sorted((result.id, result.message.id,
+                               result.location and result.location.id)
+                              for result in analysis.results) == nodes
+        session.remove()
+    
+    def test_compressed_inputs(self):
+        def path(name):
+            return os.path.join(self.tmpdir, name)
+        def compress(open_, xml_file, name):
+            with open(xml_file, "rb") as f:
+                data = f.read()
+            with closing(open_(path(name), "wb")) as f:
+                f.write(data)
+            return path(name)
+        # the analyses of plain XML files
+        expected_url = "sqlite:///" + path("expected.db")
+        firewoes_fill_db.read_and_create(expected_url, self.xml_files,
+                                         drop=True)
+        # the same files compressed, in a tar archive (one of them
+        # compressed), and on stdin
+        gzipped = compress(gzip.open, self.xml_files[4], "a.xml.gz")
+        bzipped = compress(bz2.BZ2File, self.xml_files[0], "b.xml.bz2")
+        with closing(tarfile.open(path("c.tar"), "w")) as archive:
+            archive.add(self.xml_files[1], "c1.xml")
+            archive.add(compress(gzip.open, self.xml_files[2], "c2.xml.gz"),
+                        "c2.xml.gz")
+            archive.add(self.xml_files[3], "c3.xml")
+        stats = firewoes_fill_db.read_and_create(
+            self.url, [gzipped, bzipped, path("c.tar")], drop=True)
+        assert (stats.files, stats.failed) == (5, 0)
+        with open(self.xml_files[5], "rb") as stdin:
+            (returncode, output) = self.run_script(self.url, "-",
+                                                   stdin=stdin)
+        assert returncode == 0, output
+        rows = self.table_rows()
+        expected = self.table_rows(expected_url)
+        # only the paths of the manifest differ
+        assert len(rows.pop("ingested_file")) == \
+            len(expected.pop("ingested_file"))
+        assert rows == expected
+    
+    def test_jobs(self):
+        # the same rows as a serial run, with each loader
+        for kwargs in (dict(), dict(bulk=True)):
+            serial_url = "sqlite:///" + os.path.join(self.tmpdir,
+                                                     "serial.db")
+            firewoes_fill_db.read_and_create(serial_url, self.xml_files,
+                                             drop=True, **kwargs)
+            stats = firewoes_fill_db.read_and_create(
+                self.url, self.xml_files, drop=True, jobs=3, **kwargs)
+            assert (stats.files, stats.failed) == (len(self.xml_files), 0)
+            assert self.table_rows() == self.table_rows(serial_url)
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_parse_errors(self):
+        with open(os.path.join(testsdir, "data",
+                               IdifyTestCase.analysis_ids[4][0])) as f:
+            xml = f.read()
+        empty = os.path.join(self.tmpdir, "empty.xml")
+        truncated = os.path.join(self.tmpdir, "truncated.xml")
+        with open(empty, "w") as f:
+            f.write("\n")
+        with open(truncated, "w") as f:
+            f.write(xml[:len(xml) // 2])
+        url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        stats = firewoes_fill_db.read_and_create(url, [empty, truncated],
+                                                 drop=True)
+        assert (stats.files, stats.failed) == (2, 1)
+        engine, session = get_engine_session(url)
+        t = t_ingested_file
+        with engine.begin() as connection:
+            assert connection.execute(
+                select([t.c.path, t.c.analysis_id])).fetchall() \
+                == [(empty, None)]
+        # the truncated file is ingested once it's complete
+        with open(truncated, "w") as f:
+            f.write(xml)
+        stats = firewoes_fill_db.read_and_create(url, [empty, truncated])
+        assert (stats.skipped, stats.files, stats.failed) == (1, 1, 0)
+        assert stats.results > 0
+
+class OptimizeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_measure(self):
+        url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        engine, session = get_engine_session(url)
+        firewoes_fill_db.read_and_create(url, glob(testsdir + "/data/*.xml"),
+                                         drop=True, bulk=True)
+        # the dbs created from scratch already have the indexes
+        assert upgrade(engine) == []
+        for flat in (False, True):
+            app.config["SEARCH_USE_FLAT_TABLE"] = flat
+            try:
+                with engine.connect() as connection:
+                    searches = optimize.find_searches(connection)
+                    measures = optimize.measure(connection, searches,
+                                                repeat=1)
+            finally:
+                app.config["SEARCH_USE_FLAT_TABLE"] = False
+            assert len(searches) == len(optimize.standard_searches)
+            assert all(plan for (url, label, seconds, plan) in measures)
+            assert optimize.report(measures, measures).count("plan") == 0
+            # the queries of the web app, with its configuration
+            labels = [label for (url, label, seconds, plan) in measures
+                      if url == "/search/?"]
+            # with the flat table, the ids of the page are selected first
+            expected = ["count", "page", "page"] if flat else ["count", "page"]
+            assert labels[-len(expected):] == expected
+            assert ("menu result_search.sut_name" in labels) == flat
+    
+    def test_text_indexes(self):
+        url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        engine, session = get_engine_session(url)
+        orm.metadata.create_all(engine)
+        query = ("SELECT name FROM sqlite_master WHERE type = 'index' "
+                 "AND name LIKE 'ix_%_text%' ORDER BY name")
+        with engine.begin() as connection:
+            assert [row.name for row in connection.execute(query)] == \
+                ["ix_message_text", "ix_notes_text"]
+            connection.execute("DROP INDEX ix_notes_text")
+        # the plain text indexes are kept, or created again
+        assert upgrade(engine) == ["search_indexes"]
+        with engine.begin() as connection:
+            assert [row.name for row in connection.execute(query)] == \
+                ["ix_message_text", "ix_notes_text"]
+
+class KnownIdsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        self.store = os.path.join(self.tmpdir, "known")
+        self.xml_files = sorted(glob(testsdir + "/data/*.xml"))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def count(self, table):
+        engine, session = get_engine_session(self.url)
+        with engine.connect() as connection:
+            return connection.execute(table.count()).scalar()
+    
+    def test_stale_store(self):
+        # the ids which aren't in the store are sent
+        firewoes_fill_db.read_and_create(self.url, self.xml_files[:3],
+                                         drop=True)
+        firewoes_fill_db.read_and_create(self.url, self.xml_files, bulk=True,
+                                         known_ids_path=self.store)
+        assert self.count(orm.t_analysis) == len(self.xml_files)
+        # the ORM loader looks up every object
+        self.assertRaises(ValueError, firewoes_fill_db.read_and_create,
+                          self.url, self.xml_files, known_ids_path=self.store)
+    
+    def test_save(self):
+        known_ids = KnownIds(self.store)
+        for i in range(100):
+            known_ids.add("message", "%040x" % i)
+        known_ids.save()
+        known_ids.add("message", "%040x" % 100)
+        known_ids.add("message", "%040x" % 0)
+        known_ids.save()
+        with open(self.store + ".ids") as f:
+            lines = f.readlines()
+        assert KnownIds(self.store).count == known_ids.count == len(lines)
+        assert len(lines) == 101
+        assert ("message", "%040x" % 100) in KnownIds(self.store)
+        # the temporary files are renamed
+        assert sorted(os.listdir(self.tmpdir)) == ["known.bloom", "known.ids"]
+    
+    def test_collected_rows(self):
+        firewoes_fill_db.read_and_create(self.url, self.xml_files, drop=True,
+                                         bulk=True, known_ids_path=self.store)
+        results = self.count(orm.t_result)
+        engine, session = get_engine_session(self.url)
+        with engine.begin() as connection:
+            collector = Collector(connection)
+            collector.delete_analyses(select([orm.t_analysis.c.id]))
+            collector.collect()
+        assert self.count(orm.t_result) == 0
+        # the store lists the deleted rows: it has to be rebuilt
+        firewoes_fill_db.read_and_create(self.url, self.xml_files, bulk=True,
+                                         known_ids_path=self.store,
+                                         force=True)
+        assert self.count(orm.t_result) == results
+        assert self.count(orm.t_message) > 0
+
+class WorkQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine, session = get_engine_session(
+            "sqlite:///" + os.path.join(self.tmpdir, "test.db"))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_claim(self):
+        queue = WorkQueue(self.engine, "w1")
+        assert queue.enqueue(["a", "b", "c"]) == 3
+        assert queue.enqueue(["c", "d"]) == 1
+        assert queue.claim(2) == ["a", "b"]
+        assert WorkQueue(self.engine, "w2").claim(5) == ["c", "d"]
+        assert queue.claim(2) == []
+        queue.finish("a")
+        queue.finish("b", "error")
+        assert queue.counts() == dict(claimed=2, done=1, failed=1)
+        assert queue.requeue(failed=True) == 1
+        assert queue.requeue(older_than=0) == 2
+        assert queue.claim(5) == ["b", "c", "d"]
+
+class IngestionApiTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        spool.make_dirs(self.tmpdir)
+        app.config["INGEST_SPOOL_DIR"] = self.tmpdir
+        app.config["INGEST_TOKENS"] = ["secret"]
+        self.app = app.test_client()
+        self.headers = dict(Authorization="Token secret")
+        with open(os.path.join(testsdir, "data",
+                               IdifyTestCase.analysis_ids[4][0])) as f:
+            self.xml = f.read()
+    
+    def tearDown(self):
+        app.config["INGEST_SPOOL_DIR"] = ""
+        shutil.rmtree(self.tmpdir)
+    
+    def test_post(self):
+        rv = self.app.post('/api/analysis/', data=self.xml,
+                           headers=self.headers)
+        assert rv.status_code == 202
+        ticket = json.loads(rv.data)["ticket"]
+        assert os.path.exists(os.path.join(self.tmpdir, ticket + ".xml"))
+        rv = self.app.get('/api/analysis/%s/' % ticket, headers=self.headers)
+        assert json.loads(rv.data)["status"] == "pending"
+        spool.finish(self.tmpdir, os.path.join(self.tmpdir, ticket + ".xml"))
+        rv = self.app.get('/api/analysis/%s/' % ticket, headers=self.headers)
+        assert json.loads(rv.data)["status"] == "done"
+    
+    def test_post_truncated(self):
+        truncated = self.xml[:len(self.xml) // 2]
+        rv = self.app.post('/api/analysis/', data=truncated,
+                           headers=self.headers)
+        ticket = json.loads(rv.data)["ticket"]
+        url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        engine, session = get_engine_session(url)
+        orm.metadata.create_all(engine)
+        t_ingested_file.create(bind=engine, checkfirst=True)
+        errors = firewoes_fill_db._ingest_spooled(
+            session, Manifest(session), self.tmpdir,
+            os.path.join(self.tmpdir, ticket + ".xml"))
+        session.remove()
+        assert len(errors) == 1
+        rv = json.loads(self.app.get('/api/analysis/%s/' % ticket,
+                                     headers=self.headers).data)
+        assert rv["status"] == "failed"
+        assert "ERROR while parsing" in rv["error"]
+    
+    def test_spool_db_outage(self):
+        tickets = [spool.submit(self.tmpdir, StringIO(self.xml)),
+                   spool.submit(self.tmpdir, StringIO(self.xml.replace(
+                        "python-ethtool", "python-ethtool2")))]
+        url = "sqlite:///" + os.path.join(self.tmpdir, "test.db")
+        engine, session = get_engine_session(url)
+        orm.metadata.create_all(engine)
+        t_ingested_file.create(bind=engine, checkfirst=True)
+        (calls, stopping) = ([], [])
+        def store(session, analysis, **kwargs):
+            calls.append(analysis.id)
+            if len(calls) <= 2:
+                raise OperationalError("INSERT", {},
+                                       Exception("connection lost"))
+            res = firewoes_fill_db.store_analysis(session, analysis, **kwargs)
+            if len(calls) == 4:
+                stopping.append(True)
+            return res
+        firewoes_fill_db._watch_spool(session, Manifest(session), self.tmpdir,
+                                      store, interval=0.01, stopping=stopping,
+                                      max_backoff=0.02)
+        session.remove()
+        # the files stayed in the spool until the db could be used
+        assert len(calls) == 4
+        for ticket in tickets:
+            rv = json.loads(self.app.get('/api/analysis/%s/' % ticket,
+                                         headers=self.headers).data)
+            assert rv["status"] == "done"
+        with engine.begin() as connection:
+            assert connection.execute(orm.t_analysis.count()).scalar() == 2
+    
+    def test_post_gzip(self):
+        data = StringIO()
+        with gzip.GzipFile(fileobj=data, mode="wb") as f:
+            f.write(self.xml)
+        rv = self.app.post('/api/analysis/', data=data.getvalue(),
+                           headers=self.headers)
+        assert rv.status_code == 202
+        ticket = json.loads(rv.data)["ticket"]
+        assert os.path.exists(os.path.join(self.tmpdir, ticket + ".xml.gz"))
+    
+    def test_post_refused(self):
+        rv = self.app.post('/api/analysis/', data=self.xml)
+        assert rv.status_code == 401
+        rv = self.app.post('/api/analysis/', data=self.xml,
+                           headers=dict(Authorization="Token wrong"))
+        assert rv.status_code == 401
+        rv = self.app.post('/api/analysis/', data="not xml",
+                           headers=self.headers)
+        assert rv.status_code == 400
+        assert spool.spooled_files(self.tmpdir) == []
+
 if __name__ == '__main__':
     unittest.main()